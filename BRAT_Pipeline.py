@@ -0,0 +1,210 @@
+# -------------------------------------------------------------------------------
+# Name:        BRAT Pipeline
+# Purpose:     Runs iHyd, the vegetation and combined capacity models, conflict potential and the constraints and
+#              opportunities model on the BRAT table in memory, writing the outputs once
+#
+# Created:     10/2026
+# -------------------------------------------------------------------------------
+
+import arcpy
+import numpy as np
+import sys
+from SupportingFunctions import load_columns, write_columns
+from FuzzyEngine import make_evaluator, DEFAULT_CHUNK_SIZE
+import iHyd
+import Veg_FIS
+import Comb_FIS
+import Capacity_FIS
+import Conflict_Potential
+import Constraints_Opportunities
+reload(iHyd)
+reload(Veg_FIS)
+reload(Comb_FIS)
+reload(Capacity_FIS)
+reload(Conflict_Potential)
+reload(Constraints_Opportunities)
+
+INPUT_FIELDS = ["ReachID", "iGeo_DA", "iGeo_Slope", "iGeo_Len", "iVeg100Hpe", "iVeg_30Hpe", "iVeg100EX", "iVeg_30EX"]
+CONFLICT_FIELDS = ["iPC_RoadX", "iPC_RoadAd", "iPC_Canal", "iPC_RR", "iPC_LU"]
+CONSTRAINTS_FIELDS = ["iPC_VLowLU", "iPC_HighLU", "oPC_Dist", "iPC_LU"]
+
+OUTPUT_FIELD_TYPES = dict(Constraints_Opportunities.FIELD_TYPES, mCC_HPE_CT='SHORT', mCC_EX_CT='SHORT',
+                          mCC_HisDep='SHORT')
+
+
+def main(proj_path, in_network, max_da_thresh, out_name=None, region=None, q_low_eqtn=None, q2_eqtn=None,
+         crossing_low=None, crossing_high=None, adj_low=None, adj_high=None, canal_low=None, canal_high=None,
+         rr_low=None, rr_high=None, surveyed_dams=None, conservation_areas=None, conservation_easements=None, workers=1,
+         chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Runs every model after the BRAT table on the network attributes in memory, then writes all of their outputs
+    with one pass over the network
+    :param proj_path: The path to the project folder for this BRAT run
+    :param in_network: The input BRAT table
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+    :param out_name: The name of the output network to make in 02_Analyses. If not given, the outputs are written
+        to the input network
+    :param region: The optional region code to identify an already existing streamflow equation
+    :param q_low_eqtn: The Qlow equation to be calculated
+    :param q2_eqtn: The Q2 equation to be calculated
+    :param crossing_low: The road crossing distance below which conflict potential is highest
+    :param crossing_high: The road crossing distance above which conflict potential is lowest
+    :param adj_low: The adjacent road distance below which conflict potential is highest
+    :param adj_high: The adjacent road distance above which conflict potential is lowest
+    :param canal_low: The canal distance below which conflict potential is highest
+    :param canal_high: The canal distance above which conflict potential is lowest
+    :param rr_low: The railroad distance below which conflict potential is highest
+    :param rr_high: The railroad distance above which conflict potential is lowest. Thresholds that aren't given
+        default to Conflict_Potential.DEFAULT_THRESHOLDS
+    :param surveyed_dams: The dams shapefile, used with the conservation areas to find dam management strategies
+    :param conservation_areas: The conservation areas shapefile
+    :param conservation_easements: The conservation easements shapefile
+    :param workers: How many processes to run the FIS in. 1 runs it in this process
+    :param chunk_size: How many reaches are given to a worker at a time
+    :return: The network the outputs were written to
+    """
+    arcpy.env.overwriteOutput = True
+    if region is None or region == "None":
+        region = 0
+    else:
+        region = int(float(region))
+    if q_low_eqtn == "None":
+        q_low_eqtn = None
+    if q2_eqtn == "None":
+        q2_eqtn = None
+    workers = int(workers) if workers else 1
+    chunk_size = int(chunk_size) if chunk_size else DEFAULT_CHUNK_SIZE
+    conflict_thresholds = [float(default if threshold is None or threshold == "None" or threshold == "" else threshold)
+                           for threshold, default in zip([crossing_low, crossing_high, adj_low, adj_high, canal_low,
+                                                          canal_high, rr_low, rr_high],
+                                                         Conflict_Potential.DEFAULT_THRESHOLDS)]
+
+    arcpy.AddMessage("Reading the BRAT table...")
+    columns = read_reach_table(in_network)
+
+    columns = run_models(columns, max_da_thresh, region, q_low_eqtn, q2_eqtn, conflict_thresholds, workers, chunk_size)
+
+    if out_name:
+        out_network = Comb_FIS.make_output_network(in_network, out_name)
+    else:
+        out_network = in_network
+
+    if surveyed_dams and conservation_areas:
+        arcpy.AddMessage("Finding dam management strategies...")
+        columns.update(find_dam_strategies(proj_path, out_network, columns, surveyed_dams, conservation_areas,
+                                           conservation_easements))
+
+    arcpy.AddMessage("Writing model outputs...")
+    write_columns(out_network, columns["ReachID"], output_columns(columns), OUTPUT_FIELD_TYPES)
+
+    make_layers(out_network)
+    if out_network != in_network:
+        Comb_FIS.add_xml_output(in_network, out_network)
+
+    return out_network
+
+
+def read_reach_table(in_network):
+    """
+    Reads every field the models need from the BRAT table with one scan
+    :param in_network: The input BRAT table
+    :return: A dictionary of arrays, keyed by field name
+    """
+    fields = [f.name for f in arcpy.ListFields(in_network)]
+    missing_fields = [field for field in INPUT_FIELDS + CONSTRAINTS_FIELDS if field not in fields]
+    if len(missing_fields) > 0:
+        raise Exception("The BRAT table is missing fields needed by the models: " + ", ".join(missing_fields))
+
+    optional_fields = [field for field in CONFLICT_FIELDS if field in fields and field not in CONSTRAINTS_FIELDS]
+    return load_columns(in_network, INPUT_FIELDS + CONSTRAINTS_FIELDS + optional_fields)
+
+
+def run_models(columns, max_da_thresh, region, q_low_eqtn, q2_eqtn, conflict_thresholds, workers=1,
+               chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Runs each model in turn on the reach table, adding their outputs to it
+    :param columns: A dictionary of arrays from read_reach_table()
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+    :param region: The region code to identify an already existing streamflow equation
+    :param q_low_eqtn: The Qlow equation to be calculated
+    :param q2_eqtn: The Q2 equation to be calculated
+    :param conflict_thresholds: The low and high distances for road crossings, adjacent roads, canals and railroads
+    :param workers: How many processes to run the FIS in. 1 runs it in this process
+    :param chunk_size: How many reaches are given to a worker at a time
+    :return: The dictionary of arrays, with the model outputs added
+    """
+    arcpy.AddMessage("Adding Qlow and Q2 to network...")
+    q_low, q2 = iHyd.calculate_discharge(columns["iGeo_DA"].astype(np.float32), region, q_low_eqtn, q2_eqtn)
+    arcpy.AddMessage("Adding stream power to network...")
+    columns["iHyd_Q2"], columns["iHyd_SPLow"], columns["iHyd_SP2"] = \
+        iHyd.calculate_stream_power(q_low, q2, columns["iGeo_Slope"])
+    columns["iHyd_QLow"] = q_low
+
+    evaluate_veg = make_evaluator(Veg_FIS.build_veg_fis, workers=workers, chunk_size=chunk_size)
+    columns.update(Capacity_FIS.run_capacity_models(columns, max_da_thresh, evaluate_veg,
+                                                    Comb_FIS.CombFISProfiles(workers=workers, chunk_size=chunk_size)))
+
+    arcpy.AddMessage("Finding conflict potential...")
+    columns["oPC_Score"] = Conflict_Potential.calculate_oPC_Score(columns, *conflict_thresholds)
+
+    arcpy.AddMessage("Running the constraints and opportunities model...")
+    # add arbitrarily large value to avoid error
+    if "iPC_Canal" not in columns:
+        columns["iPC_Canal"] = np.ones(len(columns["ReachID"])) * 500000
+    columns.update(Constraints_Opportunities.classify_constraints(columns))
+
+    return columns
+
+
+def find_dam_strategies(proj_path, out_network, columns, surveyed_dams, conservation_areas,
+                        conservation_easements=None):
+    """
+    Finds the beaver dam management strategy of each reach, from the surveyed dams and conservation areas on it
+    :param proj_path: The path to the project folder for this BRAT run
+    :param out_network: The network the outputs will be written to
+    :param columns: A dictionary of arrays with the outputs of run_models()
+    :param surveyed_dams: The dams shapefile
+    :param conservation_areas: The conservation areas shapefile
+    :param conservation_easements: The conservation easements shapefile
+    :return: A dictionary of arrays, keyed by DamStrat, ObsDam, ConsArea and ConsEase
+    """
+    obs_dam, cons_area, cons_ease = Constraints_Opportunities.find_dam_locations(
+        proj_path, out_network, columns["ReachID"], surveyed_dams, conservation_areas, conservation_easements)
+    strategies = {"DamStrat": Constraints_Opportunities.classify_dam_strategies(columns, obs_dam, cons_area,
+                                                                                cons_ease)}
+    for field, selected in [("ObsDam", obs_dam), ("ConsArea", cons_area), ("ConsEase", cons_ease)]:
+        strategies[field] = Constraints_Opportunities.yes_no(selected)
+    return strategies
+
+
+def output_columns(columns):
+    """
+    Lists the model outputs to write to the network
+    :param columns: A dictionary of arrays with the outputs of run_models()
+    :return: A list of (field name, array of values) tuples
+    """
+    output_fields = ["iHyd_QLow", "iHyd_Q2", "iHyd_SPLow", "iHyd_SP2", "oVC_HPE", "oVC_EX", "oCC_HPE", "oCC_EX",
+                     "mCC_HPE_CT", "mCC_EX_CT", "mCC_HisDep", "oPC_Score", "oPBRC_UI", "oPBRC_UD", "oPBRC_CR",
+                     "DamStrat", "ObsDam", "ConsArea", "ConsEase"]
+    # the constraints and opportunities classes are kept as codes until they're written
+    return [(field, Constraints_Opportunities.decode_classes(field, columns[field])) for field in output_fields
+            if field in columns]
+
+
+def make_layers(out_network):
+    """
+    Makes the layers for every model's output
+    :param out_network: The network the outputs were written to
+    :return:
+    """
+    iHyd.make_layers(out_network)
+    Veg_FIS.make_layers(out_network)
+    Comb_FIS.make_layers(out_network)
+    Constraints_Opportunities.make_layers(out_network)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1],
+         sys.argv[2],
+         sys.argv[3],
+         sys.argv[4])
@@ -11,21 +11,32 @@
 
 import arcpy
 from arcpy.sa import *
+import numpy as np
 import os
 import sys
 import datetime
 import time
 import FindBraidedNetwork
 import BRAT_Braid_Handler
-from SupportingFunctions import make_layer, make_folder, getUUID, find_relative_path, write_xml_element_with_path
+from SupportingFunctions import make_layer, make_folder, getUUID, find_relative_path, write_xml_element_with_path, \
+    parse_input_bool, load_columns, write_columns
 import XMLBuilder
 import SupportingFunctions
+import ZonalEngine
+import DistanceEngine
+import ProjectCache
 
 reload(XMLBuilder)
 XMLBuilder = XMLBuilder.XMLBuilder
 
 reload(FindBraidedNetwork)
 reload(BRAT_Braid_Handler)
+reload(ZonalEngine)
+reload(DistanceEngine)
+reload(ProjectCache)
+
+# the most times a raster cell is split along each side to find how much of it is in a buffer
+MAX_SUBCELLS = 10
 
 
 def main(
@@ -47,7 +58,8 @@ def main(
     find_clusters,
     should_segment_network,
     segment_by_ownership,
-    is_verbose):
+    is_verbose,
+    check_distances=False):
 
     """
     Calculates, for each stream network segment, the attributes needed to trun the BRAT tools.
@@ -70,6 +82,8 @@ def main(
     :param should_segment_network: If true, this option divides reaches based on the roads input.
     :param segment_by_ownership: If true, this option divides reaches based on the land ownership input.
     :param is_verbose:  If true, this option enables ArcMap to provide messages for each step conducted by the tool.
+    :param check_distances: If true, the distance fields are checked against distance rasters, the way BRAT used to
+        find them, once the table is made
     :return:
     """
 
@@ -82,6 +96,7 @@ def main(
     should_segment_network = parse_input_bool(should_segment_network)
     segment_by_ownership = parse_input_bool(segment_by_ownership)
     is_verbose = parse_input_bool(is_verbose)
+    check_distances = parse_input_bool(check_distances)
 
     scratch = 'in_memory'
     #arcpy.env.workspace = scratch
@@ -115,25 +130,14 @@ def main(
     # --create network buffers for analyses--
     # create 'Buffers' folder if it doesn't exist
     buffers_folder = make_folder(intermediate_folder, "01_Buffers")
-
-    # create network segment midpoints
-    if is_verbose:
-        arcpy.AddMessage("Finding network segment midpoints...")
-    midpoints = arcpy.FeatureVerticesToPoints_management(seg_network_copy, scratch + "/midpoints", "MID")
-    # remove unwanted fields from midpoints
-    fields = arcpy.ListFields(midpoints)
-    keep = ['ReachID']
-    drop = []
-    for field in fields:
-        if not field.required and field.name not in keep and field.type != 'Geometry':
-            drop.append(field.name)
-    if len(drop) > 0:
-        arcpy.DeleteField_management(midpoints, drop)
+    # the zonal indexes of which raster cells are in each buffer are kept with the buffers
+    index_folder = make_folder(buffers_folder, "ZonalIndex")
+    # rasters and feature classes derived from the inputs are kept in the project's cache, so later runs on the same
+    # inputs can reuse them
+    cache = ProjectCache.ProjectCache(os.path.join(proj_path, "Cache"))
 
     if is_verbose:
         arcpy.AddMessage("Making buffers...")
-    # create midpoint 100 m buffer
-    midpoint_buffer = arcpy.Buffer_analysis(midpoints, scratch + "/midpoint_buffer", "100 Meters")
     # create network 30 m buffer
     buf_30m = os.path.join(buffers_folder, "buffer_30m.shp")
     arcpy.Buffer_analysis(seg_network_copy, buf_30m, "30 Meters", "", "ROUND")
@@ -143,11 +147,11 @@ def main(
 
     # run geo attributes function
     arcpy.AddMessage('Adding "iGeo" attributes to network...')
-    igeo_attributes(seg_network_copy, in_DEM, flow_acc, midpoint_buffer, scratch, is_verbose)
+    igeo_attributes(seg_network_copy, in_DEM, flow_acc, cache, is_verbose)
 
     # run vegetation attributes function
     arcpy.AddMessage('Adding "iVeg" attributes to network...')
-    iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, seg_network_copy, scratch, is_verbose)
+    iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, seg_network_copy, scratch, index_folder, is_verbose)
 
     # find points of diversion if canals are defined
     if canal is not None:
@@ -158,7 +162,7 @@ def main(
     # run ipc attributes function if conflict layers are defined by user
     if road is not None and valley_bottom is not None:
         arcpy.AddMessage('Adding "iPC" attributes to network...')
-        ipc_attributes(seg_network_copy, road, railroad, canal, valley_bottom, ownership, diversion_pts, buf_30m, buf_100m, landuse, scratch, proj_path, is_verbose)
+        ipc_attributes(seg_network_copy, road, railroad, canal, valley_bottom, ownership, diversion_pts, buf_30m, buf_100m, landuse, scratch, index_folder, proj_path, is_verbose)
 
     if perennial_network is not None:
         find_is_perennial(seg_network_copy, perennial_network)
@@ -178,7 +182,14 @@ def main(
     write_xml(new_output_folder, coded_veg, coded_hist, seg_network, in_DEM, valley_bottom, landuse, DrAr,
               road, railroad, canal, buf_30m, buf_100m, seg_network_copy, description)
 
-    run_tests(seg_network_copy, is_verbose)
+    if check_distances and road is not None and valley_bottom is not None:
+        distance_checks = [(feature, buf_30m, index_folder) for feature in [road, railroad, canal] if feature is not None]
+    else:
+        distance_checks = None
+    run_tests(seg_network_copy, is_verbose, distance_checks)
+
+    # nothing made from the cache is used past this point, so its entries can be deleted to fit its size limit again
+    cache.end_session()
 
     arcpy.CheckInExtension("spatial")
 
@@ -383,110 +394,61 @@ def add_reach_dist(seg_network, seg_network_copy, is_verbose):
 
 
 
-def zonalStatsWithinBuffer(buffer, ras, stat_type, stat_field, out_fc, out_FC_field, scratch):
+def zonalStatsWithinBuffers(stat_requests, out_fc, index_folder):
     """
-    Calculate zonal statistics within buffer function
-    :param buffer: The buffer around the stream
-    :param ras: The DEM raster
-    :param stat_type: The type of statistic to be calculated (MAXIMUM, MINIMUM, etc.)
-    :param stat_field: The name of the field containing statistics to be calculated
+    Calculates zonal statistics of several rasters within several buffers, reading each raster once
+    :param stat_requests: A list of (ZonalEngine.ZonalRequest, fields) tuples, where fields lists the field within the
+        output feature class to output each of the request's statistics to
     :param out_fc: The feature class to output to.
-    :param out_FC_field: The field within the output feature class to output to.
-    :param scratch: The current workspace
-    :return:
-    """
-    # get input raster stat value within each buffer
-    # note: zonal stats as table does not support overlapping polygons so we will check which
-    #       reach buffers output was produced for and which we need to run tool on again
-    stat_tbl = arcpy.sa.ZonalStatisticsAsTable(buffer, 'ReachID', ras, os.path.join(scratch, 'statTbl'), 'DATA', stat_type)
-
-    # get list of segment buffers where zonal stats tool produced output
-    have_stat_list = [row[0] for row in arcpy.da.SearchCursor(stat_tbl, 'ReachID')]
-    # create dictionary to hold all reach buffer min dem z values
-    stat_dict = {}
-    # add buffer raster stat values to dictionary
-    with arcpy.da.SearchCursor(stat_tbl, ['ReachID', stat_field]) as cursor:
-        for row in cursor:
-            stat_dict[row[0]] = row[1]
-    # create list of overlapping buffer reaches (i.e., where zonal stats tool did not produce output)
-    need_stat_list = []
-    with arcpy.da.SearchCursor(buffer, ['ReachID']) as cursor:
-        for row in cursor:
-            if row[0] not in have_stat_list:
-                need_stat_list.append(row[0])
-    # run zonal stats until we have output for each overlapping buffer segment
-    stat = None
-    tmp_buff_lyr = None
-    num_broken_repetitions = 0
-    BROKEN_REPS_ALLOWED = 5
-    while len(need_stat_list) > 0:
-        # create tuple of segment ids where still need raster values
-        need_stat = ()
-        for reach in need_stat_list:
-            if reach not in need_stat:
-                need_stat += (reach,)
-        # use the segment id tuple to create selection query and run zonal stats tool
-        if len(need_stat) == 1:
-            quer = '"ReachID" = ' + str(need_stat[0])
-        else:
-            quer = '"ReachID" IN ' + str(need_stat)
-        tmp_buff_lyr = arcpy.MakeFeatureLayer_management(buffer, 'tmp_buff_lyr')
-        arcpy.SelectLayerByAttribute_management(tmp_buff_lyr, 'NEW_SELECTION', quer)
-        stat = arcpy.sa.ZonalStatisticsAsTable(tmp_buff_lyr, 'ReachID', ras, os.path.join(scratch, 'stat'), 'DATA', stat_type)
-        # add segment stat values from zonal stats table to main dictionary
-        with arcpy.da.SearchCursor(stat, ['ReachID', stat_field]) as cursor:
-            for row in cursor:
-                stat_dict[row[0]] = row[1]
-        # create list of reaches that were run and remove from 'need to run' list
-        have_stat_list2 = [row[0] for row in arcpy.da.SearchCursor(stat, 'ReachID')]
-
-        if len(have_stat_list2) == 0:
-            num_broken_repetitions += 1
-            if num_broken_repetitions >= BROKEN_REPS_ALLOWED:
-                warning_message = "While calculating " + out_FC_field + ", the tool ran into an error. The following "
-                warning_message += "ReachIDs did not recieve correct values:\n"
-                for reach_id in need_stat_list:
-                    if reach_id == need_stat_list[-1]:
-                        warning_message += "and "
-                    warning_message += str(reach_id)
-                    if reach_id != need_stat_list[-1]:
-                        warning_message += ", "
-                warning_message += "\n"
-                arcpy.AddWarning(warning_message)
-                for reach_id in need_stat_list:
-                    stat_dict[reach_id] = 0
-                need_stat_list = []
-        for reach in have_stat_list2:
-            need_stat_list.remove(reach)
-
-    # populate dictionary value to output field by ReachID
-    with arcpy.da.UpdateCursor(out_fc, ['ReachID', out_FC_field]) as cursor:
-        for row in cursor:
-            try:
-                aKey = row[0]
-                row[1] = stat_dict[aKey]
-                cursor.updateRow(row)
-            except:
-                pass
-    stat_dict.clear()
-
-    # delete temp fcs, tbls, etc.
-    #items = [statTbl, haveStatList, haveStatList2, needStatList, stat, tmp_buff_lyr, needStat]
-    items = [stat_tbl, stat, tmp_buff_lyr]
-    for item in items:
-        if item is not None:
-            arcpy.Delete_management(item)
-
-
-
-def igeo_attributes(out_network, in_DEM, flow_acc, midpoint_buffer, scratch, is_verbose):
+    :param index_folder: The folder that the zonal indexes of the buffers are saved in
+    :return: A list with an array for each request of the ReachIDs that no values were written for, because their
+        buffer has no raster data
+    """
+    # every statistic is found in one scan of each raster, and overlapping buffers each get all of their cells
+    results = ZonalEngine.run_zonal_requests([request for request, fields in stat_requests], index_folder)
+
+    all_missing_reach_ids = []
+    for (request, fields), (reach_ids, stats) in zip(stat_requests, results):
+        columns = [(field, empty_missing_values(reach_ids, stats[stat_type], field))
+                   for stat_type, field in zip(request.stat_types, fields)]
+        write_columns(out_fc, reach_ids, columns)
+        has_data = np.ones(len(reach_ids), dtype=bool)
+        for stat_type in request.stat_types:
+            if stat_type != "COUNT":
+                has_data &= ~np.isnan(stats[stat_type])
+        all_missing_reach_ids.append(reach_ids[~has_data])
+    return all_missing_reach_ids
+
+
+def empty_missing_values(reach_ids, values, field):
+    """
+    Warns about the reaches that have no value for a field, so that they can be left empty rather than given a made
+    up value. Empty values are written as NULL in a geodatabase, but a shapefile can't store NULL numbers, so they're
+    written as 0 there, and can't be told apart from a real 0 except by the ReachIDs in the warning
+    :param reach_ids: An array of ReachIDs
+    :param values: An array of the field's value for each reach, which is NaN where a reach has no value
+    :param field: The name of the field
+    :return: An array of the values, with None where a reach has no value
+    """
+    missing = np.isnan(values)
+    if missing.any():
+        warning_message = str(np.count_nonzero(missing)) + " reaches have no data to find " + field
+        warning_message += " from, so it was left empty for them. A shapefile can't store empty numbers, so if the "
+        warning_message += "network is a shapefile, they will read as 0. Their ReachIDs are:\n"
+        warning_message += ", ".join(str(reach_id) for reach_id in reach_ids[missing])
+        arcpy.AddWarning(warning_message)
+    values = np.asarray(values, dtype=object)
+    values[missing] = None
+    return values
+
+
+def igeo_attributes(out_network, in_DEM, flow_acc, cache, is_verbose):
     """
     calculates min and max elevation, length, slope, and drainage area for each flowline segment
     :param out_network: The output netwrok to add fields to.
     :param in_DEM: The DEM raster.
     :param flow_acc: Th eflow accumulation raster
-    :param midpoint_buffer: The buffer created from midpoints
-    :param scratch: The current workspace
+    :param cache: The ProjectCache that the smoothed DEM and drainage area are kept in
     :param is_verbose: If true, this option enables ArcMap to provide messages for each step conducted by the tool.
     :return: Drainage Area
     """
@@ -512,55 +474,20 @@ def igeo_attributes(out_network, in_DEM, flow_acc, midpoint_buffer, scratch, is_
     arcpy.env.extent = desc.Extent
     arcpy.env.outputCoordinateSystem = desc.SpatialReference
     arcpy.env.cellSize = desc.meanCellWidth
-    # calculate mean z over 3x3 cell window
-    neighborhood = NbrRectangle(3, 3, "CELL")
-    tmp_dem = FocalStatistics(in_DEM, neighborhood, 'MEAN')
-    # clip smoothed dem to input dem
-    DEM = ExtractByMask(tmp_dem, in_DEM)
-
-    # function to attribute start/end elevation (dem z) to each flowline segment
-    def zSeg(vertex_type, out_field):
-        if is_verbose:
-            arcpy.AddMessage("Calculating values for " + out_field + "...")
-        # create start/end points for each flowline reach segment
-        tmp_pts = os.path.join(scratch, 'tmp_pts')
-        arcpy.FeatureVerticesToPoints_management(out_network, tmp_pts, vertex_type)
-        # create 30 meter buffer around each start/end point
-        tmp_buff = os.path.join(scratch, 'tmp_buff')
-        arcpy.Buffer_analysis(tmp_pts, tmp_buff, '30 Meters')
-        # get min dem z value within each buffer
-        arcpy.AddField_management(out_network, out_field, "DOUBLE")
-        zonalStatsWithinBuffer(tmp_buff, DEM, 'MINIMUM', 'MIN', out_network, out_field, scratch)
-
-        # delete temp fcs, tbls, etc.
-        items = [tmp_pts, tmp_buff]
-        for item in items:
-            arcpy.Delete_management(item)
-
-    # run zSeg function for start/end of each network segment
-    zSeg('START', 'iGeo_ElMax')
-    zSeg('END', 'iGeo_ElMin')
 
-    # calculate network reach slope
-    arcpy.AddField_management(out_network, "iGeo_Len", "DOUBLE")
-    arcpy.CalculateField_management(out_network, "iGeo_Len", '!shape.length@meters!', "PYTHON_9.3")
-    arcpy.AddField_management(out_network, "iGeo_Slope", "DOUBLE")
-    with arcpy.da.UpdateCursor(out_network, ["iGeo_ElMax", "iGeo_ElMin", "iGeo_Len", "iGeo_Slope"]) as cursor:
-        if is_verbose:
-            arcpy.AddMessage("Calculating iGeo_Slope...")
-        for row in cursor:
-            if row[2] == 0:
-                row[3] = 0.0001
-            else:
-                row[3] = (abs(row[0] - row[1]))/row[2]
-            if row[3] == 0.0:
-                row[3] = 0.0001
-            cursor.updateRow(row)
+    def smooth_dem(out_path):
+        # calculate mean z over 3x3 cell window
+        neighborhood = NbrRectangle(3, 3, "CELL")
+        tmp_dem = FocalStatistics(in_DEM, neighborhood, 'MEAN')
+        # clip smoothed dem to input dem
+        ExtractByMask(tmp_dem, in_DEM).save(out_path)
+
+    DEM = cache.fetch("SmoothedDEM", [in_DEM], {"neighborhood": "3x3 CELL", "statistic": "MEAN"}, smooth_dem)
 
     # get DA values
     if flow_acc is None:
         arcpy.AddMessage("Calculating drainage area...")
-        calc_drain_area(DEM, in_DEM)
+        calc_drain_area(DEM, in_DEM, cache)
     elif not os.path.exists(os.path.dirname(in_DEM) + "/Flow"): # if there's no folder for the flow accumulation, make one
         os.mkdir(os.path.dirname(in_DEM) + "/Flow")
         if is_verbose:
@@ -570,24 +497,53 @@ def igeo_attributes(out_network, in_DEM, flow_acc, midpoint_buffer, scratch, is_
     DrArea = find_dr_ar(flow_acc, in_DEM)
     # Todo: check this bc it seems wrong to pull from midpoint buffer
 
-    # add drainage area 'iGeo_DA' field to flowline network
-    arcpy.AddField_management(out_network, "iGeo_DA", "DOUBLE")
-    # get max drainage area within 100 m midpoint buffer
+    # the start, middle and end point of each reach are read from its geometry, and the rasters are sampled around
+    # them directly, so no point or buffer feature classes are needed
+    reach_ids, points = ZonalEngine.read_reach_points(out_network)
+    reach_count = len(reach_ids)
+
+    # get min dem z value within 30 m of each start and end point. Both ends are sampled together, so the smoothed
+    # DEM is read once
+    if is_verbose:
+        arcpy.AddMessage("Calculating iGeo_ElMax and iGeo_ElMin...")
+    elevations = ZonalEngine.point_window_statistics(DEM, np.concatenate([points["START"][0], points["END"][0]]),
+                                                     np.concatenate([points["START"][1], points["END"][1]]),
+                                                     30, ["MINIMUM"])["MINIMUM"]
+    el_max = elevations[:reach_count]
+    el_min = elevations[reach_count:]
+
+    # get max drainage area within 100 m of each midpoint
     if is_verbose:
         arcpy.AddMessage("Calculating iGeo_DA...")
-    zonalStatsWithinBuffer(midpoint_buffer, DrArea, "MAXIMUM", 'MAX', out_network, "iGeo_DA", scratch)
-
+    drainage_area = ZonalEngine.point_window_statistics(DrArea, points["MID"][0], points["MID"][1], 100,
+                                                        ["MAXIMUM"])["MAXIMUM"]
     # replace '0' drainage area values with tiny value
-    with arcpy.da.UpdateCursor(out_network, ["iGeo_DA"]) as cursor:
-        for row in cursor:
-            if row[0] == 0:
-                row[0] = 0.00000001
-            cursor.updateRow(row)
+    drainage_area[drainage_area == 0] = 0.00000001
+
+    # calculate network reach slope
+    for field in ["iGeo_ElMax", "iGeo_ElMin", "iGeo_Len", "iGeo_Slope", "iGeo_DA"]:
+        arcpy.AddField_management(out_network, field, "DOUBLE")
+    arcpy.CalculateField_management(out_network, "iGeo_Len", '!shape.length@meters!', "PYTHON_9.3")
+    if is_verbose:
+        arcpy.AddMessage("Calculating iGeo_Slope...")
+    length = load_columns(out_network, ['ReachID', 'iGeo_Len'])
+    if not np.array_equal(length['ReachID'], reach_ids):
+        raise Exception("The reaches of " + out_network + " changed order while calculating iGeo_Slope")
+    length = length['iGeo_Len']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(length == 0, 0.0001, np.abs(el_max - el_min) / length)
+    slope[slope == 0.0] = 0.0001
+
+    write_columns(out_network, reach_ids,
+                  [("iGeo_ElMax", empty_missing_values(reach_ids, el_max, "iGeo_ElMax")),
+                   ("iGeo_ElMin", empty_missing_values(reach_ids, el_min, "iGeo_ElMin")),
+                   ("iGeo_Slope", empty_missing_values(reach_ids, slope, "iGeo_Slope")),
+                   ("iGeo_DA", empty_missing_values(reach_ids, drainage_area, "iGeo_DA"))])
 
     return DrArea
 
 
-def iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, out_network, scratch, is_verbose):
+def iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, out_network, scratch, index_folder, is_verbose):
     """
     Calculates both existing and potential mean vegetation value within 30 m and 100 m buffer of each stream segment
     :param coded_veg: The coded existing vegetation raster
@@ -596,6 +552,7 @@ def iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, out_network, scrat
     :param buf_30m: The 30m stream buffer
     :param out_network: The output network that data will be added to.
     :param scratch: The current workspace
+    :param index_folder: The folder that the zonal indexes of the buffers are saved in
     :param is_verbose: If true, this option enables ArcMap to provide messages for each step conducted by the tool.
     :return:
     """
@@ -606,52 +563,33 @@ def iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, out_network, scrat
         if field in drop:
             arcpy.DeleteField_management(out_network, field)
 
-    # --existing vegetation values--
+    # --existing and historic (i.e., potential) vegetation values--
+    # the VEG_CODE of each cell comes from each raster's attribute table, the way Lookup gives it, and the mean is
+    # found within both buffers from one read of each raster
     if is_verbose:
-        arcpy.AddMessage("Creating current veg lookup raster...")
-    veg_lookup = Lookup(coded_veg, "VEG_CODE")
-    # add mean veg value 'iVeg100EX' field to flowline network
-    arcpy.AddField_management(out_network, "iVeg100EX", "DOUBLE")
-    # get mean existing veg value within 100 m buffer
-    if is_verbose:
-        arcpy.AddMessage("Calculating iVeg100EX...")
-    zonalStatsWithinBuffer(buf_100m, veg_lookup, 'MEAN', 'MEAN', out_network, "iVeg100EX", scratch)
-
-    # add mean veg value 'iVeg_VT30EX' field to flowline network
-    arcpy.AddField_management(out_network, "iVeg_30EX", "DOUBLE")
-    # get mean existing veg value within 30 m buffer
-    if is_verbose:
-        arcpy.AddMessage("Calculating iVeg_30EX...")
-    zonalStatsWithinBuffer(buf_30m, veg_lookup, 'MEAN', 'MEAN', out_network, "iVeg_30EX", scratch)
-
-    # delete temp fcs, tbls, etc.
-    items = [veg_lookup]
-    for item in items:
-        arcpy.Delete_management(item)
-
-    # --historic (i.e., potential) vegetation values--
-    if is_verbose:
-        arcpy.AddMessage("Creating historic veg lookup raster...")
-    hist_veg_lookup = Lookup(coded_hist, "VEG_CODE")
+        arcpy.AddMessage("Calculating iVeg100EX, iVeg_30EX, iVeg100Hpe and iVeg_30Hpe...")
+    stat_requests = []
+    for veg_raster, buffer_fields in [(coded_veg, ["iVeg100EX", "iVeg_30EX"]), (coded_hist, ["iVeg100Hpe", "iVeg_30Hpe"])]:
+        subcells = cell_subdivisions(veg_raster)
+        for buf, field in zip([buf_100m, buf_30m], buffer_fields):
+            stat_requests.append((ZonalEngine.ZonalRequest(buf, veg_raster, ['MEAN'], "VEG_CODE", subcells), [field]))
+    zonalStatsWithinBuffers(stat_requests, out_network, index_folder)
 
-    # add mean veg value 'iVeg100Hpe' field to flowline network
-    arcpy.AddField_management(out_network, "iVeg100Hpe", "DOUBLE")
-    # get mean potential veg value within 100 m buffer
-    if is_verbose:
-        arcpy.AddMessage("Calculating iVeg100Hpe...")
-    zonalStatsWithinBuffer(buf_100m, hist_veg_lookup, 'MEAN', 'MEAN', out_network, "iVeg100Hpe", scratch)
-
-    # add mean veg value 'iVeg_30Hpe' field to flowline network
-    arcpy.AddField_management(out_network, "iVeg_30Hpe", "DOUBLE")
-    # get mean potential veg value within 30 m buffer
-    if is_verbose:
-        arcpy.AddMessage("Calculating iVeg_30Hpe...")
-    zonalStatsWithinBuffer(buf_30m, hist_veg_lookup, 'MEAN', 'MEAN', out_network, "iVeg_30Hpe", scratch)
 
-    # delete temp fcs, tbls, etc.
-    items = [hist_veg_lookup]
-    for item in items:
-        arcpy.Delete_management(item)
+def cell_subdivisions(raster):
+    """
+    Finds how many times to split each cell of a raster along each side, so that the pieces are about the size of the
+    analysis cell size. Statistics were found from Lookup rasters resampled to that cell size, so splitting cells
+    keeps small buffers getting a share of each cell they partly cover
+    :param raster: The raster to find statistics of
+    :return: A whole number, from 1 to MAX_SUBCELLS
+    """
+    try:
+        cell_size = float(arcpy.env.cellSize)
+    except (TypeError, ValueError):
+        return 1
+    subcells = int(round(ZonalEngine.raster_grid(raster).cell_width / cell_size))
+    return min(max(subcells, 1), MAX_SUBCELLS)
 
 
 def find_points_of_diversion(canal, network, perennial_network, proj_path, is_verbose):
@@ -702,7 +640,7 @@ def find_points_of_diversion(canal, network, perennial_network, proj_path, is_ve
 
         
 
-def ipc_attributes(out_network, road, railroad, canal, valley_bottom, ownership, diversion_points, buf_30m, buf_100m, landuse, scratch, proj_path, is_verbose):
+def ipc_attributes(out_network, road, railroad, canal, valley_bottom, ownership, diversion_points, buf_30m, buf_100m, landuse, scratch, index_folder, proj_path, is_verbose):
     """
     Calculates distances from road intersections, adjacent roads, railroads and canals for each flowline segment
     :param out_network: The output network where fields will be added
@@ -715,6 +653,7 @@ def ipc_attributes(out_network, road, railroad, canal, valley_bottom, ownership,
     :param buf_100m: The 100m stream buffer
     :param landuse: The landuse raster
     :param scratch: The current workspace
+    :param index_folder: The folder that the zonal indexes of the buffers are saved in
     :param projPath: The file path to the project folder
     :param is_verbose: If true, this option enables ArcMap to provide messages for each step conducted by the tool.
     :param perennial_network: The perennial network shapefile
@@ -737,22 +676,22 @@ def ipc_attributes(out_network, road, railroad, canal, valley_bottom, ownership,
         road_crossings = temp_dir + "\\roadx.shp"
         # create points at road-stream intersections
         arcpy.Intersect_analysis([out_network, road], road_crossings, "", "", "POINT")
-        find_distance_from_feature(out_network, road_crossings, valley_bottom, temp_dir, buf_30m, "roadx", "iPC_RoadX", scratch, is_verbose, clip_feature = False)
+        find_distance_from_feature(out_network, road_crossings, valley_bottom, temp_dir, "roadx", "iPC_RoadX", scratch, is_verbose, clip_feature = False)
 
     if road is not None:
-        find_distance_from_feature(out_network, road, valley_bottom, temp_dir, buf_30m, "roadvb", "iPC_RoadVB", scratch, is_verbose, clip_feature = True)
-        find_distance_from_feature(out_network, road, valley_bottom, temp_dir, buf_30m, "road", "iPC_Road", scratch, is_verbose, clip_feature = False)
+        find_distance_from_feature(out_network, road, valley_bottom, temp_dir, "roadvb", "iPC_RoadVB", scratch, is_verbose, clip_feature = True)
+        find_distance_from_feature(out_network, road, valley_bottom, temp_dir, "road", "iPC_Road", scratch, is_verbose, clip_feature = False)
 
     if railroad is not None:
-        find_distance_from_feature(out_network, railroad, valley_bottom, temp_dir, buf_30m, "railroadvb", "iPC_RailVB", scratch, is_verbose, clip_feature = True)
-        find_distance_from_feature(out_network, railroad, valley_bottom, temp_dir, buf_30m, "railroad", "iPC_Rail", scratch, is_verbose, clip_feature = False)
+        find_distance_from_feature(out_network, railroad, valley_bottom, temp_dir, "railroadvb", "iPC_RailVB", scratch, is_verbose, clip_feature = True)
+        find_distance_from_feature(out_network, railroad, valley_bottom, temp_dir, "railroad", "iPC_Rail", scratch, is_verbose, clip_feature = False)
 
     if canal is not None:
         # find distance from canal
-        find_distance_from_feature(out_network, canal, valley_bottom, temp_dir, buf_30m, "canal", "iPC_Canal", scratch, is_verbose, clip_feature=False)
+        find_distance_from_feature(out_network, canal, valley_bottom, temp_dir, "canal", "iPC_Canal", scratch, is_verbose, clip_feature=False)
     if diversion_points is not None:
         # calculate distance from points of diversion
-        find_distance_from_feature(out_network, diversion_points, valley_bottom, temp_dir, buf_30m, "diversion", "iPC_DivPts", scratch, is_verbose, clip_feature = False)
+        find_distance_from_feature(out_network, diversion_points, valley_bottom, temp_dir, "diversion", "iPC_DivPts", scratch, is_verbose, clip_feature = False)
 
     # assign land ownership agency to each reach
     if ownership is not None:
@@ -783,11 +722,11 @@ def ipc_attributes(out_network, road, railroad, canal, valley_bottom, ownership,
         private_lyr = arcpy.MakeFeatureLayer_management(ownership, "private_lyr")
         arcpy.SelectLayerByAttribute_management(private_lyr, 'NEW_SELECTION', """ "ADMIN_AGEN" = 'PVT' OR "ADMIN_AGEN" = 'UND' """)
         arcpy.CopyFeatures_management(private_lyr, private)
-        find_distance_from_feature(out_network, private, valley_bottom, temp_dir, buf_30m, "private_land", "iPC_Privat", scratch, is_verbose, clip_feature=False)
+        find_distance_from_feature(out_network, private, valley_bottom, temp_dir, "private_land", "iPC_Privat", scratch, is_verbose, clip_feature=False)
     
     # calculate mean landuse value ('iPC_LU')
     if landuse is not None:
-        add_landuse_to_table(out_network, landuse, buf_100m, scratch, is_verbose)
+        add_landuse_to_table(out_network, landuse, buf_100m, index_folder, is_verbose)
 
     add_min_distance(out_network)
 
@@ -830,112 +769,54 @@ def add_min_distance(out_network):
             cursor.updateRow(row)
 
 
-def add_landuse_to_table(out_network, landuse, buf_100m, scratch, is_verbose):
+def add_landuse_to_table(out_network, landuse, buf_100m, index_folder, is_verbose):
     """
     Adds landuse fields to the output network[iPC_LU, "iPC_VLowLU", "iPC_LowLU", "iPC_ModLU", "iPC_HighLU"]
     :param out_network: Output network to add fields to.
     :param landuse: The landuse raster.
     :param buf_100m: The 100m stream buffer
-    :param scratch: Th current workspace
+    :param index_folder: The folder that the zonal indexes of the buffers are saved in
     :param is_verbose: If true, this option enables ArcMap to provide messages for each step conducted by the tool.
     :return:
     """
     if is_verbose:
         arcpy.AddMessage("Calculating iPC_LU values...")
     arcpy.AddField_management(out_network, "iPC_LU", "DOUBLE")
-    # create raster with just landuse code values
-    lu_ras = Lookup(landuse, "LU_CODE")
-    # calculate mean landuse value within 100 m buffer of each network segment
-    zonalStatsWithinBuffer(buf_100m, lu_ras, 'MEAN', 'MEAN', out_network, "iPC_LU", scratch)
-    # get percentage of each land use class in 100 m buffer of stream segment
+    # the LU_CODE and LUI_CLASS of each cell are taken from the landuse raster's attribute table, and the mean LU_CODE
+    # and the share of each LUI_CLASS in the 100 m buffer of each network segment are found in one scan of the raster
+    subcells = cell_subdivisions(landuse)
+    requests = [ZonalEngine.ZonalRequest(buf_100m, landuse, ['MEAN'], "LU_CODE", subcells)]
     fields = [f.name.upper() for f in arcpy.ListFields(landuse)]
-
-    if "LUI_CLASS" not in fields:
+    has_classes = "LUI_CLASS" in fields
+    if has_classes:
+        requests.append(ZonalEngine.ZonalRequest(buf_100m, landuse, [ZonalEngine.HISTOGRAM], "LUI_CLASS", subcells,
+                                                 categories=['VeryLow', 'Low', 'Moderate', 'High']))
+    else:
         arcpy.AddWarning("No field named \"LU_CLASS\" in the land use raster. Make sure that this field exists" +
                          " with no typos if you wish to use the data from the land use raster")
-        return
-
-    buf_fields = [f.name for f in arcpy.ListFields(buf_100m)]
-    if 'oArea' not in buf_fields:
-        arcpy.AddField_management(buf_100m, 'oArea', 'DOUBLE')
-        with arcpy.da.UpdateCursor(buf_100m, ['SHAPE@AREA', 'oArea']) as cursor:
-            for row in cursor:
-                row[1] = row[0]
-                cursor.updateRow(row)
-    landuse_poly = arcpy.RasterToPolygon_conversion(landuse, os.path.join(scratch, 'landuse_poly'), 'NO_SIMPLIFY', "LUI_Class")
-    landuse_int = arcpy.Intersect_analysis([landuse_poly, buf_100m], os.path.join(scratch, 'landuse_int'))
-    arcpy.AddField_management(landuse_int, 'propArea', 'DOUBLE')
-    with arcpy.da.UpdateCursor(landuse_int, ['SHAPE@AREA', 'oArea', 'propArea']) as cursor:
-        for row in cursor:
-            row[2] = row[0]/row[1]
-            cursor.updateRow(row)
-    area_tbl = arcpy.Statistics_analysis(landuse_int, os.path.join(scratch, 'areaTbl'), [['propArea', 'SUM']], ['ReachID', 'LUI_CLASS'])
-    area_piv_tbl = arcpy.PivotTable_management(area_tbl, ['ReachID'], 'LUI_CLASS', 'SUM_propArea', os.path.join(scratch, 'areaPivTbl'))
-
-    sanitize_area_piv_tbl(area_piv_tbl)
-    # create empty dictionary to hold input table field values
-    tbl_dict = {}
-    # add values to dictionary
-    with arcpy.da.SearchCursor(area_piv_tbl, ['ReachID', 'VeryLow', 'Low', 'Moderate', 'High']) as cursor:
-        for row in cursor:
-            tbl_dict[row[0]] = [row[1], row[2], row[3], row[4]]
-
-    # populate flowline network out fields
-    arcpy.AddField_management(out_network, "iPC_VLowLU", 'DOUBLE')
-    arcpy.AddField_management(out_network, "iPC_LowLU", 'DOUBLE')
-    arcpy.AddField_management(out_network, "iPC_ModLU", 'DOUBLE')
-    arcpy.AddField_management(out_network, "iPC_HighLU", 'DOUBLE')
-
-    with arcpy.da.UpdateCursor(out_network, ['ReachID', 'iPC_VLowLU', 'iPC_LowLU', 'iPC_ModLU', 'iPC_HighLU']) as cursor:
-        for row in cursor:
-            try:
-                aKey = row[0]
-                row[1] = round(100*tbl_dict[aKey][0], 2)
-                row[2] = round(100*tbl_dict[aKey][1], 2)
-                row[3] = round(100*tbl_dict[aKey][2], 2)
-                row[4] = round(100*tbl_dict[aKey][3], 2)
-                cursor.updateRow(row)
-            except:
-                pass
-    tbl_dict.clear()
-
-    arcpy.Delete_management(lu_ras)
-
-
-def sanitize_area_piv_tbl(area_piv_tbl):
-    """
-    Makes sure that the areaPivTbl has all the fields we need. If it doesn't, we'll add it.
-    :param area_piv_tbl:
-    :return:
-    """
-    fields = [f.name for f in arcpy.ListFields(area_piv_tbl)]
-    check_and_add_zero_fields(area_piv_tbl, fields, 'VeryLow')
-    check_and_add_zero_fields(area_piv_tbl, fields, 'Low')
-    check_and_add_zero_fields(area_piv_tbl, fields, 'Moderate')
-    check_and_add_zero_fields(area_piv_tbl, fields, 'High')
+    results = ZonalEngine.run_zonal_requests(requests, index_folder)
 
+    reach_ids, stats = results[0]
+    write_columns(out_network, reach_ids, [("iPC_LU", empty_missing_values(reach_ids, stats['MEAN'], "iPC_LU"))])
+    if not has_classes:
+        return
 
-def check_and_add_zero_fields(table, fields, field_name):
-    """
-    Checks that a field is in the table. If it isn't, we add it and populate it with zeros
-    :param table: The table that we want to check
-    :param fields: All the fields in the table (more efficient if doing multiple checks)
-    :param field_name: The name of the field we want to check for
-    :return:
-    """
-    if field_name not in fields:
-        arcpy.AddField_management(table, field_name, "DOUBLE")
-        arcpy.CalculateField_management(table, field_name, 0, "PYTHON")
+    # get percentage of each land use class in 100 m buffer of stream segment. Reaches whose buffer has no landuse
+    # data are left empty
+    reach_ids, stats = results[1]
+    percents = np.round(100 * stats[ZonalEngine.HISTOGRAM], 2)
+    class_fields = ["iPC_VLowLU", "iPC_LowLU", "iPC_ModLU", "iPC_HighLU"]
+    write_columns(out_network, reach_ids, [(field, empty_missing_values(reach_ids, percents[:, i], field))
+                                           for i, field in enumerate(class_fields)])
 
 
-def find_distance_from_feature(out_network, feature, valley_bottom, temp_dir, buf, temp_name, new_field_name, scratch, is_verbose, clip_feature = False):
+def find_distance_from_feature(out_network, feature, valley_bottom, temp_dir, temp_name, new_field_name, scratch, is_verbose, clip_feature = False):
     """
     Finds the distance from a given feature to each stream segment and populates a new field
     :param out_network: The output network where new fields will be added
     :param feature: The feature that you want to calculate the distance from
     :param valley_bottom: The valley bottom shapefile
     :param temp_dir: The temporary folder directory
-    :param buf: The 30m stream buffer shapefile
     :param temp_name: The name given to the temporary shapefile created
     :param new_field_name: The name of the new field to be added to the output
     :param scratch: The current workspace
@@ -968,32 +849,28 @@ def find_distance_from_feature(out_network, feature, valley_bottom, temp_dir, bu
                 cursor.updateRow(row)
     # if there are features, calculate distance
     else:
-        # set extent to the stream network
-        arcpy.env.extent = out_network
-        # calculate euclidean distance from input features
-
         sr = arcpy.Describe(feature_subset).spatialReference
         unit = sr.linearUnitName
-        arcpy.AddMessage('Raster units are ' + unit)
+        arcpy.AddMessage('Distance units are ' + unit)
 
-        ed_feature = EucDistance(feature_subset, cell_size = 5) # cell size of 5 m
-        # get min distance from feature in the within 30 m buffer of each network segment
-        if new_field_name == 'iPC_RoadX':
-            zonalStatsWithinBuffer(buf, ed_feature, 'MINIMUM', 'MIN', out_network, new_field_name, scratch)
-        else:
-            zonalStatsWithinBuffer(buf, ed_feature, 'MEAN', 'MEAN', out_network, new_field_name, scratch)
+        # find the distance from points every 5 m along each network segment to the nearest feature, straight from
+        # the features' geometry rather than from a 5 m Euclidean distance raster. For road crossings the min
+        # distance is used, for everything else the mean
+        stat_type = 'MINIMUM' if new_field_name == 'iPC_RoadX' else 'MEAN'
+        reach_ids, distances = DistanceEngine.reach_distances(out_network, str(feature_mts), [stat_type])
+        if distances is None:
+            distances = {stat_type: np.array([10000.0] * len(reach_ids))}
+        write_columns(out_network, reach_ids,
+                      [(new_field_name, empty_missing_values(reach_ids, distances[stat_type], new_field_name))])
 
-        # delete temp fcs, tbls, etc.
-        items = []
-        for item in items:
-            arcpy.Delete_management(item)
 
 # calculate drainage area function
-def calc_drain_area(DEM, input_DEM):
+def calc_drain_area(DEM, input_DEM, cache):
     """
     Calculate drainage area function
     :param DEM: Smoothed DEM
     :param input_DEM: The original input DEM
+    :param cache: The ProjectCache that the drainage area is kept in
     :return:
     """
     #  define raster environment settings
@@ -1007,20 +884,26 @@ def calc_drain_area(DEM, input_DEM):
     width = desc.meanCellWidth
     cell_area = height * width
 
-    # derive drainage area raster (in square km) from input DEM
-    # note: draiange area calculation assumes input dem is in meters
-    filled_DEM = Fill(DEM) # fill sinks in dem
-    flow_direction = FlowDirection(filled_DEM) # calculate flow direction
-    flow_accumulation = FlowAccumulation(flow_direction) # calculate flow accumulation
-    drain_area = flow_accumulation * cell_area / 1000000 # calculate drainage area in square kilometers
-
-    # save drainage area raster
-    if os.path.exists(os.path.dirname(input_DEM) + "/Flow/DrainArea_sqkm.tif"):
-        arcpy.Delete_management(os.path.dirname(input_DEM) + "/Flow/DrainArea_sqkm.tif")
-        arcpy.CopyRaster_management(drain_area, os.path.dirname(input_DEM) + "/Flow/DrainArea_sqkm.tif")
-    else:
-        os.mkdir(os.path.dirname(input_DEM) + "/Flow")
-        arcpy.CopyRaster_management(drain_area, os.path.dirname(input_DEM) + "/Flow/DrainArea_sqkm.tif")
+    def find_drain_area(out_path):
+        # derive drainage area raster (in square km) from input DEM
+        # note: draiange area calculation assumes input dem is in meters
+        filled_DEM = Fill(DEM) # fill sinks in dem
+        flow_direction = FlowDirection(filled_DEM) # calculate flow direction
+        flow_accumulation = FlowAccumulation(flow_direction) # calculate flow accumulation
+        drain_area = flow_accumulation * cell_area / 1000000 # calculate drainage area in square kilometers
+        arcpy.CopyRaster_management(drain_area, out_path)
+
+    drain_area = cache.fetch("DrainArea", [DEM], {"units": "sqkm"}, find_drain_area)
+
+    # save drainage area raster, unless the one there already is the same
+    drain_area_path = os.path.dirname(input_DEM) + "/Flow/DrainArea_sqkm.tif"
+    if os.path.exists(drain_area_path):
+        if cache.dataset_hash(drain_area_path) == cache.dataset_hash(drain_area):
+            return
+        arcpy.Delete_management(drain_area_path)
+    elif not os.path.exists(os.path.dirname(drain_area_path)):
+        os.mkdir(os.path.dirname(drain_area_path))
+    arcpy.CopyRaster_management(drain_area, drain_area_path)
 
 
 def write_xml(output_folder, coded_veg, coded_hist, seg_network, inDEM, valley_bottom, landuse,
@@ -1397,18 +1280,6 @@ def make_buffer_layers(buffers_folder, buffer_30m_symbology, buffer_100m_symbolo
             make_layer(buffers_folder, file_path, new_layer_name, given_symbology)
 
 
-def parse_input_bool(given_input):
-    """
-    Takes an ArcMap bool input and coverts it to be usable in Python
-    :param given_input: The given ArcMap input
-    :return: Converted Bool
-    """
-    if given_input == 'false' or given_input is None:
-        return False
-    else:
-        return True
-
-
 def delete_with_arcpy(stuffToDelete):
     """
     Deletes everything in a list with arcpy.Delete_management()
@@ -1419,10 +1290,13 @@ def delete_with_arcpy(stuffToDelete):
         arcpy.Delete_management(thing)
 
 
-def run_tests(seg_network_copy, is_verbose):
+def run_tests(seg_network_copy, is_verbose, distance_checks=None):
     """
     Runs tests on the tool's output
     :param seg_network_copy: The network that we want to test
+    :param is_verbose: If true, this option enables ArcMap to provide messages for each step conducted by the tool.
+    :param distance_checks: A list of (feature, buffer, zonal index folder) tuples, for each of which the distances
+        from the distance engine are checked against a Euclidean distance raster. If None, distances aren't checked
     :return:
     """
     if is_verbose:
@@ -1430,7 +1304,8 @@ def run_tests(seg_network_copy, is_verbose):
     run_tests = True
     if not run_tests: # don't run tests in execution
         return
-    from Tests import test_reach_id_is_unique, report_exceptions, TestException
+    from Tests import test_reach_id_is_unique, test_zonal_engine, test_point_windows, test_project_cache, \
+        test_distance_parity, report_exceptions, TestException
     test_exceptions = []
 
     try:
@@ -1438,6 +1313,29 @@ def run_tests(seg_network_copy, is_verbose):
     except TestException as e:
         test_exceptions.append(str(e))
 
+    try:
+        test_zonal_engine()
+    except TestException as e:
+        test_exceptions.append(str(e))
+
+    try:
+        test_point_windows()
+    except TestException as e:
+        test_exceptions.append(str(e))
+
+    try:
+        test_project_cache()
+    except TestException as e:
+        test_exceptions.append(str(e))
+
+    for feature, buffer, index_folder in distance_checks or []:
+        if is_verbose:
+            arcpy.AddMessage("Checking the distances to " + str(feature) + " against a distance raster...")
+        try:
+            test_distance_parity(seg_network_copy, feature, buffer, index_folder)
+        except TestException as e:
+            test_exceptions.append(str(e))
+
     report_exceptions(test_exceptions)
 
 
@@ -0,0 +1,131 @@
+# -------------------------------------------------------------------------------
+# Name:        Capacity FIS
+# Purpose:     Runs the vegetation and combined capacity FIS for both historic and existing vegetation, reading the
+#              network once and writing every output once
+#
+# Created:     10/2026
+# -------------------------------------------------------------------------------
+
+import arcpy
+import numpy as np
+import sys
+from SupportingFunctions import load_columns, write_columns
+from FuzzyEngine import make_evaluator, DEFAULT_CHUNK_SIZE
+import Veg_FIS
+import Comb_FIS
+reload(Veg_FIS)
+reload(Comb_FIS)
+
+# the vegetation eras, in the order they're stacked, with their riparian (100 m) and streamside (30 m) fields
+ERAS = ["HPE", "EX"]
+VEG_FIELDS = {"HPE": ("iVeg100Hpe", "iVeg_30Hpe"), "EX": ("iVeg100EX", "iVeg_30EX")}
+
+INPUT_FIELDS = ["ReachID", "iVeg100Hpe", "iVeg_30Hpe", "iVeg100EX", "iVeg_30EX", "iHyd_SP2", "iHyd_SPLow",
+                "iGeo_Slope", "iGeo_DA", "iGeo_Len"]
+OUTPUT_FIELDS = ["oVC_HPE", "oVC_EX", "oCC_HPE", "oCC_EX", "mCC_HPE_CT", "mCC_EX_CT", "mCC_HisDep"]
+OUTPUT_FIELD_TYPES = {"mCC_HPE_CT": 'SHORT', "mCC_EX_CT": 'SHORT', "mCC_HisDep": 'SHORT'}
+
+
+def main(proj_path, in_network, max_da_thresh, out_name=None, profile=None, profile_field=None, profile_folder=None,
+         workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Runs the vegetation and combined capacity models for historic and existing vegetation in one pass
+    :param proj_path: The path to the project folder for this BRAT run
+    :param in_network: The input BRAT network, with the iVeg, iHyd and iGeo fields
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+    :param out_name: The name of the output network to make in 02_Analyses. If not given, the outputs are written
+        to the input network
+    :param profile: An optional combined FIS profile file to use instead of the default FIS
+    :param profile_field: An optional field in the network holding the name of the FIS profile of each reach
+    :param profile_folder: The folder that the profile names in the profile field are looked up in
+    :param workers: How many processes to run the FIS in. 1 runs it in this process. Both eras are run in the same
+        pool, so their reaches are run at the same time
+    :param chunk_size: How many reaches are given to a worker at a time
+    :return: The network the outputs were written to
+    """
+    arcpy.env.overwriteOutput = True
+    workers = int(workers) if workers else 1
+    chunk_size = int(chunk_size) if chunk_size else DEFAULT_CHUNK_SIZE
+    if profile_field == "None" or profile_field == "":
+        profile_field = None
+
+    arcpy.AddMessage("Reading the BRAT network...")
+    fields = [f.name for f in arcpy.ListFields(in_network)]
+    missing_fields = [field for field in INPUT_FIELDS if field not in fields]
+    if len(missing_fields) > 0:
+        raise Exception("The BRAT network is missing fields needed by the capacity models: " +
+                        ", ".join(missing_fields))
+    columns = load_columns(in_network, INPUT_FIELDS + ([profile_field] if profile_field else []))
+
+    evaluate_veg = make_evaluator(Veg_FIS.build_veg_fis, workers=workers, chunk_size=chunk_size)
+    profiles = Comb_FIS.CombFISProfiles(profile, profile_folder, workers=workers, chunk_size=chunk_size)
+    outputs = run_capacity_models(columns, max_da_thresh, evaluate_veg, profiles, columns.get(profile_field))
+
+    if out_name:
+        out_network = Comb_FIS.make_output_network(in_network, out_name)
+    else:
+        out_network = in_network
+
+    arcpy.AddMessage("Writing model outputs...")
+    write_columns(out_network, columns["ReachID"], [(field, outputs[field]) for field in OUTPUT_FIELDS],
+                  OUTPUT_FIELD_TYPES)
+
+    # keep the FIS output, so that other DA thresholds can be tried without running the FIS again
+    outputs.update((field, columns[field]) for field in ["ReachID", "iGeo_DA", "iGeo_Len"])
+    Comb_FIS.save_fis_output(Comb_FIS.fis_output_path(out_network), outputs)
+
+    Veg_FIS.make_layers(out_network)
+    Comb_FIS.make_layers(out_network)
+    if out_network != in_network:
+        Comb_FIS.add_xml_output(in_network, out_network)
+
+    return out_network
+
+
+def run_capacity_models(columns, max_da_thresh, evaluate_veg, profiles=None, profile_names=None):
+    """
+    Runs the vegetation and then the combined capacity FIS for both eras. The eras are stacked into one array, so
+    each FIS is run once over twice as many reaches, rather than once per era
+    :param columns: A dictionary of arrays, keyed by the INPUT_FIELDS
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+    :param evaluate_veg: A function that evaluates the vegetation FIS on a list of input arrays
+    :param profiles: The Comb_FIS.CombFISProfiles to run the combined FIS with. Defaults to the default FIS
+    :param profile_names: An optional array with the combined FIS profile name of each reach
+    :return: A dictionary of arrays, keyed by the OUTPUT_FIELDS, fis_HPE and fis_EX
+    """
+    if profiles is None:
+        profiles = Comb_FIS.CombFISProfiles()
+    reach_count = len(columns["iGeo_DA"])
+
+    def stack(field):
+        return np.tile(columns[field], len(ERAS))
+
+    arcpy.AddMessage("Running the vegetation capacity model...")
+    riparian = np.concatenate([columns[VEG_FIELDS[era][0]] for era in ERAS])
+    streamside = np.concatenate([columns[VEG_FIELDS[era][1]] for era in ERAS])
+    ovc = Veg_FIS.calculate_veg_capacity(riparian, streamside, evaluate_veg)
+
+    arcpy.AddMessage("Running the combined capacity model...")
+    if profile_names is not None:
+        profile_names = np.tile(profile_names, len(ERAS))
+    fis_out = profiles.run_reaches(profile_names, ovc, stack("iHyd_SP2"), stack("iHyd_SPLow"), stack("iGeo_Slope"))
+    profiles.report()
+    occ = Comb_FIS.limit_comb_capacity(fis_out, ovc, stack("iGeo_DA"), max_da_thresh)
+    dam_count = Comb_FIS.count_dams(occ, stack("iGeo_Len"))
+
+    outputs = {}
+    for index, era in enumerate(ERAS):
+        era_reaches = slice(index * reach_count, (index + 1) * reach_count)
+        outputs["oVC_" + era] = ovc[era_reaches]
+        outputs["fis_" + era] = fis_out[era_reaches]
+        outputs["oCC_" + era] = occ[era_reaches]
+        outputs["mCC_" + era + "_CT"] = dam_count[era_reaches]
+    outputs["mCC_HisDep"] = outputs["mCC_HPE_CT"] - outputs["mCC_EX_CT"]
+    return outputs
+
+
+if __name__ == '__main__':
+    main(sys.argv[1],
+         sys.argv[2],
+         sys.argv[3],
+         sys.argv[4])
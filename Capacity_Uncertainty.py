@@ -0,0 +1,294 @@
+# -------------------------------------------------------------------------------
+# Name:        Capacity Uncertainty
+# Purpose:     Finds prediction intervals for existing dam capacity by running the combined FIS on an ensemble of
+#              perturbed inputs for every reach
+#
+# Created:     10/2026
+# -------------------------------------------------------------------------------
+
+import arcpy
+import numpy as np
+from SupportingFunctions import load_columns, write_columns
+from FuzzyEngine import PoolEvaluator, DEFAULT_CHUNK_SIZE
+import Comb_FIS
+reload(Comb_FIS)
+
+# the combined FIS inputs that can be perturbed, in the order the FIS takes them
+ERROR_MODEL_INPUTS = ["oVC_EX", "iHyd_SP2", "iHyd_SPLow", "iGeo_Slope"]
+
+# the distribution and scale of the error in each input. Inputs can't go below 0, and each distribution keeps them there
+# in its own way:
+#   'lognormal' multiplies by exp() of an error with a standard deviation of scale. Values of 0 stay 0, and the
+#       error is the same share of every value
+#   'truncated' adds a normal error with a standard deviation of scale, redrawing any error that would take the value
+#       below 0. Values near 0 can only move up, but they don't pile up at 0
+#   'normal' adds a normal error with a standard deviation of scale and sets values below 0 to 0. Values near 0 can
+#       only move up, and a share of them end up at exactly 0
+#   'uniform' adds an error between -scale and scale and sets values below 0 to 0, like 'normal'
+# oVC_EX is often 0, and an additive error there only ever raises capacity, so it uses a lognormal error by default
+DEFAULT_ERROR_MODELS = {
+    "oVC_EX": ('lognormal', 0.3),
+    "iHyd_SP2": ('lognormal', 0.3),
+    "iHyd_SPLow": ('lognormal', 0.3),
+    "iGeo_Slope": ('lognormal', 0.2)
+}
+
+DEFAULT_PERCENTILES = [5, 50, 95]
+DEFAULT_MEMBERS = 100
+DEFAULT_MEMORY_MB = 512
+
+# how many float64 arrays of (members x reaches) are held at once at the peak, which is while the FIS runs: the four
+# perturbed inputs, the copies of them run_comb_fis() clips into the FIS's range, and the FIS output, plus one for
+# the boolean masks np.where() is given. Finding the capacity and its percentiles afterwards holds fewer, since all but
+# the perturbed oVC_EX are let go first
+ENSEMBLE_ARRAYS = 10
+
+# about how many bytes the FIS's temporary arrays, such as the membership of every term and the aggregated output,
+# take up for each value in a chunk it evaluates
+FIS_BYTES_PER_VALUE = 4096
+
+# about how many more bytes each value of a chunk takes up when the FIS runs in a process pool: the pickled inputs
+# waiting to be sent, the inputs the worker unpickles, and the output sent back
+POOL_BYTES_PER_VALUE = 80
+
+# the most of the memory budget the FIS's temporary arrays can take up, split between the workers running chunks at
+# once. The FIS chunk size is made smaller to fit
+FIS_MEMORY_SHARE = 0.5
+
+
+def main(in_network, max_da_thresh, members=DEFAULT_MEMBERS, error_models=None, percentiles=None, seed=None,
+         memory_mb=DEFAULT_MEMORY_MB, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Runs the existing combined capacity FIS on an ensemble of perturbed inputs for each reach, and writes percentiles
+    of the ensemble's capacity to fields like oCC_EX_p05
+    :param in_network: The combined capacity network, with oVC_EX, iHyd_SP2, iHyd_SPLow, iGeo_Slope and iGeo_DA
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+    :param members: How many ensemble members to run for each reach
+    :param error_models: The error model of each input, as text like "oVC_EX normal 1; iHyd_SP2 lognormal 0.3".
+        Inputs that aren't given use DEFAULT_ERROR_MODELS
+    :param percentiles: The percentiles to write, as a list or as text like "5;50;95"
+    :param seed: The random seed, so that a run can be repeated
+    :param memory_mb: About how many megabytes the ensemble arrays and the FIS's temporary arrays can take up, in this
+        process and the workers together, not counting what each worker takes up to start with. Reaches are run in
+        chunks that fit
+    :param workers: How many processes to run the FIS in. 1 runs it in this process. The workers are started once,
+        and every chunk of reaches is run through them
+    :param chunk_size: How many values the FIS evaluates at once, and how many are given to a worker at a time. It's
+        made smaller if the FIS's temporary arrays in every worker wouldn't fit in half of the memory budget
+    :return:
+    """
+    members = int(members) if members else DEFAULT_MEMBERS
+    memory_mb = float(memory_mb) if memory_mb else DEFAULT_MEMORY_MB
+    workers = int(workers) if workers else 1
+    chunk_size = fis_chunk_size(memory_mb, int(chunk_size) if chunk_size else DEFAULT_CHUNK_SIZE, workers)
+    seed = int(seed) if seed not in [None, "", "None"] else None
+    error_models = read_error_models(error_models)
+    percentiles = read_percentiles(percentiles)
+
+    columns = load_columns(in_network, ["ReachID", "iGeo_DA"] + ERROR_MODEL_INPUTS)
+    arcpy.AddMessage("Running " + str(members) + " ensemble members for " + str(len(columns["ReachID"])) +
+                     " reaches...")
+    evaluator = PoolEvaluator(Comb_FIS.build_comb_fis, workers, chunk_size)
+    try:
+        intervals = prediction_intervals(columns, max_da_thresh, evaluator.evaluate, members, error_models,
+                                         percentiles, seed, memory_mb, chunk_size, workers)
+    finally:
+        evaluator.close()
+
+    write_columns(in_network, columns["ReachID"],
+                  [(percentile_field(percentile), intervals[percentile]) for percentile in percentiles])
+
+
+def prediction_intervals(columns, max_da_thresh, evaluate, members=DEFAULT_MEMBERS, error_models=None,
+                         percentiles=None, seed=None, memory_mb=DEFAULT_MEMORY_MB,
+                         fis_chunk=DEFAULT_CHUNK_SIZE, workers=1):
+    """
+    Finds percentiles of existing dam capacity for each reach, over an ensemble of perturbed inputs. Reaches are run
+    in chunks, and every member of a chunk is run through the FIS as one array
+    :param columns: A dictionary of arrays, keyed by iGeo_DA and the ERROR_MODEL_INPUTS
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+    :param evaluate: A function that evaluates the combined FIS on a list of input arrays
+    :param members: How many ensemble members to run for each reach
+    :param error_models: A dictionary of (distribution, scale) tuples, keyed by input field
+    :param percentiles: A list of the percentiles to find
+    :param seed: The random seed
+    :param memory_mb: About how many megabytes the ensemble arrays and the FIS's temporary arrays can take up
+    :param fis_chunk: How many values the FIS evaluates at once
+    :param workers: How many processes evaluate runs the FIS in
+    :return: A dictionary of arrays of capacity, keyed by percentile
+    """
+    if error_models is None:
+        error_models = DEFAULT_ERROR_MODELS
+    if percentiles is None:
+        percentiles = DEFAULT_PERCENTILES
+    random_state = np.random.RandomState(seed)
+
+    reach_count = len(columns["iGeo_DA"])
+    reaches_per_chunk = ensemble_chunk_size(members, memory_mb, fis_chunk, workers)
+    intervals = dict((percentile, np.zeros(reach_count, dtype=np.float64)) for percentile in percentiles)
+
+    for start in range(0, reach_count, reaches_per_chunk):
+        stop = min(start + reaches_per_chunk, reach_count)
+        chunk = dict((field, values[start:stop]) for field, values in columns.items())
+        capacity = ensemble_capacity(chunk, max_da_thresh, evaluate, members, error_models, random_state)
+        chunk_percentiles = np.percentile(capacity, percentiles, axis=0)
+        # let go of this chunk's ensemble before the next one is made
+        del capacity
+        for percentile, values in zip(percentiles, chunk_percentiles):
+            intervals[percentile][start:stop] = values
+
+    return intervals
+
+
+def ensemble_capacity(columns, max_da_thresh, evaluate, members, error_models, random_state):
+    """
+    Runs the existing combined capacity FIS for every ensemble member of a set of reaches at once
+    :param columns: A dictionary of arrays, keyed by iGeo_DA and the ERROR_MODEL_INPUTS
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+    :param evaluate: A function that evaluates the combined FIS on a list of input arrays
+    :param members: How many ensemble members to run
+    :param error_models: A dictionary of (distribution, scale) tuples, keyed by input field
+    :param random_state: The numpy RandomState to draw errors from
+    :return: An array of capacity, with one row per member and one column per reach
+    """
+    reach_count = len(columns["iGeo_DA"])
+    ovc, sp2, splow, slope = [perturb(columns[field], error_models.get(field), members, random_state)
+                              for field in ERROR_MODEL_INPUTS]
+
+    raw_out = Comb_FIS.run_comb_fis(ovc.ravel(), sp2.ravel(), splow.ravel(), slope.ravel(), evaluate)
+    # only oVC_EX is needed to finish the capacity, so the other inputs are let go before its temporary arrays are made
+    del sp2, splow, slope
+    return Comb_FIS.finish_comb_capacity(raw_out.reshape(members, reach_count), ovc, columns["iGeo_DA"],
+                                         max_da_thresh)
+
+
+def perturb(values, error_model, members, random_state):
+    """
+    Makes an ensemble of values with errors drawn from an error model. Values aren't allowed to go below 0, and how
+    they're kept there depends on the distribution, as described above DEFAULT_ERROR_MODELS
+    :param values: An array of values, one per reach
+    :param error_model: A (distribution, scale) tuple, or None to use the values as they are
+    :param members: How many ensemble members to make
+    :param random_state: The numpy RandomState to draw errors from
+    :return: An array with one row per member and one column per reach
+    """
+    ensemble = np.tile(np.asarray(values, dtype=np.float64), (members, 1))
+    if error_model is None:
+        return ensemble
+
+    np.maximum(ensemble, 0.0, ensemble)
+    distribution, scale = error_model
+    if distribution == 'lognormal':
+        error = random_state.normal(0.0, scale, ensemble.shape)
+        ensemble *= np.exp(error, error)
+        return ensemble
+    elif distribution == 'truncated':
+        error = random_state.normal(0.0, scale, ensemble.shape)
+        # values aren't below 0, so at least half of the errors redrawn each time are kept
+        redraw = np.flatnonzero(ensemble.ravel() + error.ravel() < 0)
+        while len(redraw) > 0:
+            error.ravel()[redraw] = random_state.normal(0.0, scale, len(redraw))
+            redraw = redraw[ensemble.ravel()[redraw] + error.ravel()[redraw] < 0]
+        ensemble += error
+        return ensemble
+    elif distribution == 'normal':
+        ensemble += random_state.normal(0.0, scale, ensemble.shape)
+    elif distribution == 'uniform':
+        ensemble += random_state.uniform(-scale, scale, ensemble.shape)
+    else:
+        raise Exception("Unknown error distribution \"" + str(distribution) + "\". Options are lognormal, " +
+                        "truncated, normal and uniform")
+    return np.maximum(ensemble, 0.0, ensemble)
+
+
+def fis_bytes_per_value(workers=1):
+    """
+    Finds about how many bytes each value of a chunk takes up while the FIS evaluates it
+    :param workers: How many processes the FIS runs in
+    :return: A number of bytes
+    """
+    if workers > 1:
+        return FIS_BYTES_PER_VALUE + POOL_BYTES_PER_VALUE
+    return FIS_BYTES_PER_VALUE
+
+
+def fis_chunk_size(memory_mb, chunk_size=DEFAULT_CHUNK_SIZE, workers=1):
+    """
+    Limits how many values the FIS evaluates at once, so that the temporary arrays of every worker running a chunk
+    at once fit in their share of a memory budget
+    :param memory_mb: About how many megabytes the ensemble arrays and the FIS's temporary arrays can take up
+    :param chunk_size: How many values the FIS would evaluate at once
+    :param workers: How many processes the FIS runs in
+    :return: The number of values the FIS evaluates at once
+    """
+    share_bytes = memory_mb * 1024 * 1024 * FIS_MEMORY_SHARE / max(1, workers)
+    return max(1, min(int(chunk_size), int(share_bytes / fis_bytes_per_value(workers))))
+
+
+def ensemble_chunk_size(members, memory_mb, fis_chunk=DEFAULT_CHUNK_SIZE, workers=1):
+    """
+    Finds how many reaches can be run at once while keeping the ensemble arrays, and the FIS's temporary arrays, within
+    a memory budget
+    :param members: How many ensemble members are run for each reach
+    :param memory_mb: About how many megabytes the ensemble arrays and the FIS's temporary arrays can take up
+    :param fis_chunk: How many values the FIS evaluates at once
+    :param workers: How many processes the FIS runs in, each with a chunk at once
+    :return: The number of reaches to run at once
+    """
+    bytes_per_reach = members * ENSEMBLE_ARRAYS * np.dtype(np.float64).itemsize
+    ensemble_bytes = memory_mb * 1024 * 1024 - max(1, workers) * fis_chunk * fis_bytes_per_value(workers)
+    if ensemble_bytes < bytes_per_reach:
+        raise Exception("A memory budget of " + str(memory_mb) + " MB is too small to run " + str(members) +
+                        " ensemble members of a reach. Raise the memory budget or run fewer members")
+    return int(ensemble_bytes / bytes_per_reach)
+
+
+def read_error_models(text):
+    """
+    Reads error models from text like "oVC_EX normal 1; iHyd_SP2 lognormal 0.3"
+    :param text: The error models, or a dictionary of them, or None to use the defaults
+    :return: A dictionary of (distribution, scale) tuples, keyed by input field
+    """
+    error_models = dict(DEFAULT_ERROR_MODELS)
+    if text is None or text == "None" or text == "":
+        return error_models
+    if isinstance(text, dict):
+        error_models.update(text)
+        return error_models
+
+    for entry in text.split(';'):
+        if entry.strip() == "":
+            continue
+        parts = entry.replace("'", "").split()
+        if len(parts) != 3 or parts[0] not in ERROR_MODEL_INPUTS:
+            raise Exception("Could not read the error model \"" + entry.strip() + "\". Error models are written as " +
+                            "\"field distribution scale\", where field is one of " + ", ".join(ERROR_MODEL_INPUTS))
+        error_models[parts[0]] = (parts[1].lower(), float(parts[2]))
+    return error_models
+
+
+def read_percentiles(text):
+    """
+    Reads the percentiles to write
+    :param text: A list of percentiles, or text like "5;50;95", or None to use the defaults
+    :return: A list of whole number percentiles
+    """
+    if text is None or text == "None" or text == "":
+        return list(DEFAULT_PERCENTILES)
+    if not isinstance(text, list):
+        text = text.split(';')
+    percentiles = [int(round(float(percentile))) for percentile in text]
+    for percentile in percentiles:
+        # oCC_EX_p100 would be too long for a shapefile field name
+        if percentile < 0 or percentile > 99:
+            raise Exception("Percentiles must be between 0 and 99")
+    return percentiles
+
+
+def percentile_field(percentile):
+    """
+    Gets the name of the field a percentile is written to
+    :param percentile: A whole number percentile
+    :return: A field name, like oCC_EX_p05
+    """
+    return "oCC_EX_p" + str(percentile).zfill(2)
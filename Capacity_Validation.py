@@ -21,6 +21,10 @@ import XMLBuilder
 reload(XMLBuilder)
 XMLBuilder = XMLBuilder.XMLBuilder
 
+# the oCC categories, and the upper limit of each one
+CAPACITY_CATEGORIES = ['None', 'Rare', 'Occasional', 'Frequent', 'Pervasive']
+CAPACITY_BREAKS = [0, 1, 5, 15, 40]
+
 
 def main(in_network, output_name, dams=None, da_threshold=None):
     """
@@ -301,6 +305,58 @@ def handle_category(occ_variable):
         return "UNDEFINED"
 
 
+def capacity_categories(occ):
+    """
+    Finds the oCC category of each value the same way handle_category() does, for whole arrays at once
+    :param occ: An array of dam capacity, which can have one row per model version
+    :return: An array of indices into CAPACITY_CATEGORIES, with len(CAPACITY_CATEGORIES) for values over 40
+    """
+    return np.searchsorted(CAPACITY_BREAKS, occ, side='left')
+
+
+def electivity_by_category(length, surveyed_dams, dam_count, occ):
+    """
+    Calculates the electivity table columns for each modeled capacity category, the same way
+    add_electivity_category() does, for one or many model versions at once
+    :param length: An array of reach lengths, in meters
+    :param surveyed_dams: An array of the number of surveyed dams on each reach
+    :param dam_count: An array of modeled dam counts, with one row per model version if occ has them
+    :param occ: An array of dam capacity, with one row per model version if there are several
+    :return: A dictionary of arrays with one row per model version and one column per category, keyed by length,
+        surveyed_dams, modeled_dams, surveyed_density, modeled_density and electivity
+    """
+    occ = np.atleast_2d(occ)
+    dam_count = np.atleast_2d(dam_count) * np.ones(occ.shape)
+    versions = occ.shape[0]
+    category_count = len(CAPACITY_CATEGORIES)
+
+    # give every (version, category) pair its own bin, so each total is a single bincount
+    bins = (capacity_categories(occ) + np.arange(versions).reshape(-1, 1) * (category_count + 1)).ravel()
+    size = versions * (category_count + 1)
+
+    def totals(weights):
+        weights = (np.ones(occ.shape) * weights).ravel()
+        return np.bincount(bins, weights, size).reshape(versions, -1)[:, :category_count]
+
+    category_length = totals(length)
+    category_surveyed = totals(surveyed_dams)
+    category_modeled = totals(dam_count)
+    length_km = category_length / 1000.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        network_prop = category_length / np.sum(length)
+        electivity = (category_surveyed / np.sum(surveyed_dams)) / network_prop
+        surveyed_density = category_surveyed / length_km
+        modeled_density = category_modeled / length_km
+    return {
+        'length': category_length,
+        'surveyed_dams': category_surveyed,
+        'modeled_dams': category_modeled,
+        'surveyed_density': surveyed_density,
+        'modeled_density': modeled_density,
+        'electivity': electivity
+    }
+
+
 def clean_up_fields(brat_network, out_network, new_fields):
     """
     Removes unnecessary fields
@@ -10,30 +10,119 @@
 # -------------------------------------------------------------------------------
 
 import arcpy
-import skfuzzy as fuzz
-from skfuzzy import control as ctrl
+import csv
+import json
 import numpy as np
 import os
 import sys
 from SupportingFunctions import make_layer, make_folder, find_available_num_prefix, \
-                                find_relative_path, write_xml_element_with_path
+                                find_relative_path, write_xml_element_with_path, parse_input_bool, load_columns, \
+                                write_columns
+from FuzzyEngine import MemoizedEvaluator, ProfileFISBuilder, make_evaluator, read_memo_resolutions, fis_definition, \
+    fis_from_definition, DEFAULT_CHUNK_SIZE
+from Veg_FIS import reclassify_capacity
 import XMLBuilder
 reload(XMLBuilder)
 XMLBuilder = XMLBuilder.XMLBuilder
 
+# the fields kept in the saved FIS output, which is everything the DA threshold and dam counts are calculated from.
+# fis_HPE and fis_EX are the FIS output after each profile's 'none' and 'pervasive' reclassification, but before the
+# vegetation capacity limit and the DA threshold
+FIS_OUTPUT_FIELDS = ["ReachID", "oVC_HPE", "oVC_EX", "fis_HPE", "fis_EX", "iGeo_DA", "iGeo_Len"]
 
-def main(proj_path, in_network, max_da_thresh, out_name):
+# the names fis_HPE and fis_EX had in FIS output saved by earlier versions, which held the same values
+OLD_FIS_OUTPUT_FIELDS = {"fis_HPE": "raw_HPE", "fis_EX": "raw_EX"}
+
+# the version of the FIS profile files this code writes, and the newest it can read. Version 1 profiles only hold
+# breakpoints moved from the default FIS, version 2 profiles hold every membership function and rule
+PROFILE_VERSION = 2
+
+# the profile that holds the default combined FIS, and the folder that profile names are looked up in by default
+DEFAULT_PROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "FISProfiles", "Comb_FIS_Default.json")
+
+# the names of the combined FIS inputs, in the order the input arrays are given
+COMB_FIS_INPUTS = ["ovc", "sp2", "splow", "slope"]
+
+# profiles are built into a FIS the first time they're loaded, and kept for the life of the process along with the
+# time the file was changed, so a batch run builds each profile once
+_loaded_profiles = {}
+
+# the columns of the DA threshold sweep summary
+SWEEP_FIELDS = ["MaxDAThresh", "ReachesOver", "oCC_HPE_Tot", "oCC_EX_Tot", "mCC_HPE_CT", "mCC_EX_CT", "mCC_HisDep"]
+
+
+def main(proj_path, in_network, max_da_thresh, out_name, memoize=False, memo_resolutions=None, workers=1,
+         chunk_size=DEFAULT_CHUNK_SIZE, profile=None, profile_field=None, profile_folder=None):
     """
     The main function, runs the combined FIS for the BRAT input table
     :param proj_path: The path to the project folder for this BRAT run
     :param in_network: The input BRAT network
     :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
     :param out_name: The output name for the Combined Capacity Network
+    :param memoize: If True, the FIS is evaluated once per unique set of quantized inputs, shared by both model runs
+    :param memo_resolutions: The resolutions to quantize (oVC, iHyd_SP2, iHyd_SPLow, iGeo_Slope) to when memoizing,
+        as a list or as text like "1;10;1;0.001". Defaults to the step of each input universe. Coarser resolutions give more hits, but where the rule base is
+        steep (e.g., iHyd_SPLow near 190) a small shift in an input can move the output a lot
+    :param workers: How many processes to run the FIS in. 1 runs it in this process
+    :param chunk_size: How many reaches are given to a worker at a time
+    :param profile: An optional FIS profile file, such as one made by the FIS calibration tool, to use instead of
+        the default FIS. When a profile field is given, it is used for reaches that don't name a profile
+    :param profile_field: An optional field in the network holding the name of the FIS profile to use for each
+        reach, so that a network covering several regions can be run at once
+    :param profile_folder: The folder that the profile names in the profile field are looked up in. Defaults to
+        the folder of the profile, or to the FISProfiles folder that comes with BRAT
     :return:
     """
+    workers = int(workers) if workers else 1
+    chunk_size = int(chunk_size) if chunk_size else DEFAULT_CHUNK_SIZE
+    if profile_field == "None" or profile_field == "":
+        profile_field = None
 
     scratch = 'in_memory'
 
+    out_network = make_output_network(in_network, out_name)
+
+    # both model runs share the profiles, so each is loaded (and memoized) once
+    profiles = CombFISProfiles(profile, profile_folder, parse_input_bool(memoize), memo_resolutions, workers,
+                               chunk_size)
+
+    # run the combined fis function for both potential and existing
+    fis_output = comb_cap_fis(out_network, 'hpe', scratch, max_da_thresh, profiles, profile_field)
+    fis_output.update(comb_cap_fis(out_network, 'ex', scratch, max_da_thresh, profiles, profile_field))
+
+    # keep the FIS output, so that other DA thresholds can be tried without running the FIS again
+    save_fis_output(fis_output_path(out_network), fis_output)
+
+    make_layers(out_network)
+
+    add_xml_output(in_network, out_network)
+
+    run_tests()
+
+
+def run_tests():
+    """
+    Makes sure that the vectorized FIS engine gives the same output as skfuzzy, on a small sample of inputs
+    :return:
+    """
+    from Tests import test_comb_fis_parity, report_exceptions, TestException, QUICK_PARITY_SAMPLES
+    test_exceptions = []
+
+    try:
+        test_comb_fis_parity(sample_size=QUICK_PARITY_SAMPLES)
+    except TestException as e:
+        test_exceptions.append(str(e))
+
+    report_exceptions(test_exceptions)
+
+
+def make_output_network(in_network, out_name):
+    """
+    Copies the input network into the project's analyses folder, for the model outputs to be written to
+    :param in_network: The input BRAT table
+    :param out_name: The name of the output network
+    :return: The path to the output network
+    """
     output_folder = os.path.dirname(os.path.dirname(in_network))
     analyses_folder = make_folder(output_folder, "02_Analyses")
 
@@ -45,26 +134,25 @@ def main(proj_path, in_network, max_da_thresh, out_name):
     if os.path.exists(out_network):
         arcpy.Delete_management(out_network)
     arcpy.CopyFeatures_management(in_network, out_network)
+    return out_network
 
-    # run the combined fis function for both potential and existing
-    comb_cap_fis(out_network, 'hpe', scratch, max_da_thresh)
-    comb_cap_fis(out_network, 'ex', scratch, max_da_thresh)
-
-    make_layers(out_network)
 
-    add_xml_output(in_network, out_network)
-
-
-def comb_cap_fis(in_network, model_run, scratch, max_da_thresh):
+def comb_cap_fis(in_network, model_run, scratch, max_da_thresh, profiles=None, profile_field=None):
     """
     The combined capacity FIS function
     :param in_network: The input BRAT network
     :param model_run: The model being run, either 'Hpe' or 'ex" (Potential or Existing)
     :param scratch: The current workspace
     :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
-    :return:
+    :param profiles: The CombFISProfiles to run the reaches with. Defaults to running every reach with the default
+        FIS in this process
+    :param profile_field: An optional field holding the name of the profile to use for each reach
+    :return: A dictionary of the reclassified FIS output and the inputs the final capacity is calculated from, keyed
+        by ReachID, fis_HPE or fis_EX, oVC_HPE or oVC_EX, iGeo_DA and iGeo_Len
     """
     arcpy.env.overwriteOutput = True
+    if profiles is None:
+        profiles = CombFISProfiles()
 
     # get list of all fields in the flowline network
     fields = [f.name for f in arcpy.ListFields(in_network)]
@@ -84,242 +172,423 @@ def comb_cap_fis(in_network, model_run, scratch, max_da_thresh):
         arcpy.DeleteField_management(in_network, out_field)
 
     # get arrays for fields of interest
-    segid_np = arcpy.da.FeatureClassToNumPyArray(in_network, "ReachID")
-    ovc_np = arcpy.da.FeatureClassToNumPyArray(in_network, veg_field)
-    ihydsp2_np = arcpy.da.FeatureClassToNumPyArray(in_network, "iHyd_SP2")
-    ihydsplow_np = arcpy.da.FeatureClassToNumPyArray(in_network, "iHyd_SPLow")
-    igeoslope_np = arcpy.da.FeatureClassToNumPyArray(in_network, "iGeo_Slope")
-
-    segid_array = np.asarray(segid_np, np.int64)
-    ovc_array = np.asarray(ovc_np, np.float64)
-    ihydsp2_array = np.asarray(ihydsp2_np, np.float64)
-    ihydsplow_array = np.asarray(ihydsplow_np, np.float64)
-    igeoslope_array = np.asarray(igeoslope_np, np.float64)
+    input_fields = ["ReachID", veg_field, "iHyd_SP2", "iHyd_SPLow", "iGeo_Slope", "iGeo_DA", "iGeo_Len"]
+    if model_run != 'hpe':
+        input_fields.append("mCC_HPE_CT")
+    if profile_field:
+        input_fields.append(profile_field)
+    columns = load_columns(in_network, input_fields)
+    segid_array = columns["ReachID"]
+
+    # run fuzzy inference system on inputs and defuzzify output, with each reach's profile
+    fis_out = profiles.run_reaches(columns.get(profile_field), columns[veg_field], columns["iHyd_SP2"],
+                                   columns["iHyd_SPLow"], columns["iGeo_Slope"])
+    profiles.report()
+    out = limit_comb_capacity(fis_out, columns[veg_field], columns["iGeo_DA"], max_da_thresh)
 
-    # check that inputs are within range of fis
-    # if not, re-assign the value to just within range
-    ovc_array[ovc_array < 0] = 0
-    ovc_array[ovc_array > 45] = 45
-    ihydsp2_array[ihydsp2_array < 0] = 0.0001
-    ihydsp2_array[ihydsp2_array > 10000] = 10000
-    ihydsplow_array[ihydsplow_array < 0] = 0.0001
-    ihydsplow_array[ihydsplow_array > 10000] = 10000
-    igeoslope_array[igeoslope_array > 1] = 1
-
-    # delete temp arrays
-    items = [segid_np, ovc_np, ihydsp2_np, ihydsplow_np, igeoslope_np]
+    # calculate dam count (mCC_**_CT) for each reach as number of dams * reach length (in km)
+    dam_count = count_dams(out, columns["iGeo_Len"])
+    output_columns = [(out_field, out), (mcc_field, dam_count)]
+    field_types = {mcc_field: 'SHORT'}
+
+    # calculate dam count historic departure as difference between potential count and existing count
+    if model_run != 'hpe':
+        output_columns.append(('mCC_HisDep', columns["mCC_HPE_CT"] - dam_count))
+        field_types['mCC_HisDep'] = 'SHORT'
+
+    # join the fuzzy inference system output to the flowline network
+    write_columns(in_network, segid_array, output_columns, field_types)
+
+    fis_output = {"ReachID": segid_array, "fis_" + model_run.upper(): fis_out, veg_field: columns[veg_field],
+                  "iGeo_DA": columns["iGeo_DA"], "iGeo_Len": columns["iGeo_Len"]}
+
+    # delete temporary arrays
+    items = [columns, out, dam_count]
     for item in items:
         del item
 
-    # create antecedent (input) and consequent (output) objects to hold universe variables and membership functions
-    ovc = ctrl.Antecedent(np.arange(0, 45, 0.01), 'input1')
-    sp2 = ctrl.Antecedent(np.arange(0, 10000, 1), 'input2')
-    splow = ctrl.Antecedent(np.arange(0, 10000, 1), 'input3')
-    slope = ctrl.Antecedent(np.arange(0, 1, 0.0001), 'input4')
-    density = ctrl.Consequent(np.arange(0, 45, 0.01), 'result')
-
-    # build membership functions for each antecedent and consequent object
-    ovc['none'] = fuzz.trimf(ovc.universe, [0, 0, 0.1])
-    ovc['rare'] = fuzz.trapmf(ovc.universe, [0, 0.1, 0.5, 1.5])
-    ovc['occasional'] = fuzz.trapmf(ovc.universe, [0.5, 1.5, 4, 8])
-    ovc['frequent'] = fuzz.trapmf(ovc.universe, [4, 8, 12, 25])
-    ovc['pervasive'] = fuzz.trapmf(ovc.universe, [12, 25, 45, 45])
-
-    sp2['persists'] = fuzz.trapmf(sp2.universe, [0, 0, 1000, 1200])
-    sp2['breach'] = fuzz.trimf(sp2.universe, [1000, 1200, 1600])
-    sp2['oblowout'] = fuzz.trimf(sp2.universe, [1200, 1600, 2400])
-    sp2['blowout'] = fuzz.trapmf(sp2.universe, [1600, 2400, 10000, 10000])
-
-    splow['can'] = fuzz.trapmf(splow.universe, [0, 0, 150, 175])
-    splow['probably'] = fuzz.trapmf(splow.universe, [150, 175, 180, 190])
-    splow['cannot'] = fuzz.trapmf(splow.universe, [180, 190, 10000, 10000])
-
-    slope['flat'] = fuzz.trapmf(slope.universe, [0, 0, 0.0002, 0.005])
-    slope['can'] = fuzz.trapmf(slope.universe, [0.0002, 0.005, 0.12, 0.15])
-    slope['probably'] = fuzz.trapmf(slope.universe, [0.12, 0.15, 0.17, 0.23])
-    slope['cannot'] = fuzz.trapmf(slope.universe, [0.17, 0.23, 1, 1])
-
-    density['none'] = fuzz.trimf(density.universe, [0, 0, 0.1])
-    density['rare'] = fuzz.trapmf(density.universe, [0, 0.1, 0.5, 1.5])
-    density['occasional'] = fuzz.trapmf(density.universe, [0.5, 1.5, 4, 8])
-    density['frequent'] = fuzz.trapmf(density.universe, [4, 8, 12, 25])
-    density['pervasive'] = fuzz.trapmf(density.universe, [12, 25, 45, 45])
-
-    # build fis rule table
-    rule1 = ctrl.Rule(ovc['none'], density['none'])
-    rule2 = ctrl.Rule(splow['cannot'], density['none'])
-    rule3 = ctrl.Rule(slope['cannot'], density['none'])
-    rule4 = ctrl.Rule(ovc['rare'] & sp2['persists'] & splow['can'] & ~slope['cannot'], density['rare'])
-    rule5 = ctrl.Rule(ovc['rare'] & sp2['persists'] & splow['probably'] & ~slope['cannot'], density['rare'])
-    rule6 = ctrl.Rule(ovc['rare'] & sp2['breach'] & splow['can'] & ~slope['cannot'], density['rare'])
-    rule7 = ctrl.Rule(ovc['rare'] & sp2['breach'] & splow['probably'] & ~slope['cannot'], density['rare'])
-    rule8 = ctrl.Rule(ovc['rare'] & sp2['oblowout'] & splow['can'] & ~slope['cannot'], density['rare'])
-    rule9 = ctrl.Rule(ovc['rare'] & sp2['oblowout'] & splow['probably'] & ~slope['cannot'], density['rare'])
-    rule10 = ctrl.Rule(ovc['rare'] & sp2['blowout'] & splow['can'] & ~slope['cannot'], density['none'])
-    rule11 = ctrl.Rule(ovc['rare'] & sp2['blowout'] & splow['probably'] & ~slope['cannot'], density['none'])
-    rule12 = ctrl.Rule(ovc['occasional'] & sp2['persists'] & splow['can'] & ~slope['cannot'], density['occasional'])
-    rule13 = \
-        ctrl.Rule(ovc['occasional'] & sp2['persists'] & splow['probably'] & ~slope['cannot'], density['occasional'])
-    rule14 = ctrl.Rule(ovc['occasional'] & sp2['breach'] & splow['can'] & ~slope['cannot'], density['occasional'])
-    rule15 = ctrl.Rule(ovc['occasional'] & sp2['breach'] & splow['probably'] & ~slope['cannot'], density['occasional'])
-    rule16 = ctrl.Rule(ovc['occasional'] & sp2['oblowout'] & splow['can'] & ~slope['cannot'], density['occasional'])
-    rule17 = \
-        ctrl.Rule(ovc['occasional'] & sp2['oblowout'] & splow['probably'] & ~slope['cannot'], density['occasional'])
-    rule18 = ctrl.Rule(ovc['occasional'] & sp2['blowout'] & splow['can'] & ~slope['cannot'], density['rare'])
-    rule19 = ctrl.Rule(ovc['occasional'] & sp2['blowout'] & splow['probably'] & ~slope['cannot'], density['rare'])
-    rule20 = ctrl.Rule(ovc['frequent'] & sp2['persists'] & splow['can'] & slope['flat'], density['occasional'])
-    rule21 = ctrl.Rule(ovc['frequent'] & sp2['persists'] & splow['can'] & slope['can'], density['frequent'])
-    rule22 = ctrl.Rule(ovc['frequent'] & sp2['persists'] & splow['can'] & slope['probably'], density['occasional'])
-    rule23 = ctrl.Rule(ovc['frequent'] & sp2['persists'] & splow['probably'] & slope['flat'], density['occasional'])
-    rule24 = ctrl.Rule(ovc['frequent'] & sp2['persists'] & splow['probably'] & slope['can'], density['frequent'])
-    rule25 = ctrl.Rule(ovc['frequent'] & sp2['persists'] & splow['probably'] & slope['probably'], density['occasional'])
-    rule26 = ctrl.Rule(ovc['frequent'] & sp2['breach'] & splow['can'] & slope['flat'], density['occasional'])
-    rule27 = ctrl.Rule(ovc['frequent'] & sp2['breach'] & splow['can'] & slope['can'], density['frequent'])
-    rule28 = ctrl.Rule(ovc['frequent'] & sp2['breach'] & splow['can'] & slope['probably'], density['occasional'])
-    rule29 = ctrl.Rule(ovc['frequent'] & sp2['breach'] & splow['probably'] & slope['flat'], density['occasional'])
-    rule30 = ctrl.Rule(ovc['frequent'] & sp2['breach'] & splow['probably'] & slope['can'], density['frequent'])
-    rule31 = ctrl.Rule(ovc['frequent'] & sp2['breach'] & splow['probably'] & slope['probably'], density['occasional'])
-    rule32 = ctrl.Rule(ovc['frequent'] & sp2['oblowout'] & splow['can'] & slope['flat'], density['occasional'])
-    rule33 = ctrl.Rule(ovc['frequent'] & sp2['oblowout'] & splow['can'] & slope['can'], density['frequent'])
-    rule34 = ctrl.Rule(ovc['frequent'] & sp2['oblowout'] & splow['can'] & slope['probably'], density['occasional'])
-    rule35 = ctrl.Rule(ovc['frequent'] & sp2['oblowout'] & splow['probably'] & slope['flat'], density['rare'])
-    rule36 = ctrl.Rule(ovc['frequent'] & sp2['oblowout'] & splow['probably'] & slope['can'], density['occasional'])
-    rule37 = ctrl.Rule(ovc['frequent'] & sp2['oblowout'] & splow['probably'] & slope['probably'], density['rare'])
-    rule38 = ctrl.Rule(ovc['frequent'] & sp2['blowout'] & splow['can'] & slope['flat'], density['rare'])
-    rule39 = ctrl.Rule(ovc['frequent'] & sp2['blowout'] & splow['can'] & slope['can'], density['rare'])
-    rule40 = ctrl.Rule(ovc['frequent'] & sp2['blowout'] & splow['can'] & slope['probably'], density['rare'])
-    rule41 = ctrl.Rule(ovc['frequent'] & sp2['blowout'] & splow['probably'] & slope['flat'], density['rare'])
-    rule42 = ctrl.Rule(ovc['frequent'] & sp2['blowout'] & splow['probably'] & slope['can'], density['rare'])
-    rule43 = ctrl.Rule(ovc['frequent'] & sp2['blowout'] & splow['probably'] & slope['probably'], density['rare'])
-    rule44 = ctrl.Rule(ovc['pervasive'] & sp2['persists'] & splow['can'] & slope['flat'], density['frequent'])
-    rule45 = ctrl.Rule(ovc['pervasive'] & sp2['persists'] & splow['can'] & slope['can'], density['pervasive'])
-    rule46 = ctrl.Rule(ovc['pervasive'] & sp2['persists'] & splow['can'] & slope['probably'], density['frequent'])
-    rule47 = ctrl.Rule(ovc['pervasive'] & sp2['persists'] & splow['probably'] & slope['flat'], density['frequent'])
-    rule48 = ctrl.Rule(ovc['pervasive'] & sp2['persists'] & splow['probably'] & slope['can'], density['pervasive'])
-    rule49 = ctrl.Rule(ovc['pervasive'] & sp2['persists'] & splow['probably'] & slope['probably'], density['frequent'])
-    rule50 = ctrl.Rule(ovc['pervasive'] & sp2['breach'] & splow['can'] & slope['flat'], density['frequent'])
-    rule51 = ctrl.Rule(ovc['pervasive'] & sp2['breach'] & splow['can'] & slope['can'], density['pervasive'])
-    rule52 = ctrl.Rule(ovc['pervasive'] & sp2['breach'] & splow['can'] & slope['probably'], density['frequent'])
-    rule53 = ctrl.Rule(ovc['pervasive'] & sp2['breach'] & splow['probably'] & slope['flat'], density['frequent'])
-    rule54 = ctrl.Rule(ovc['pervasive'] & sp2['breach'] & splow['probably'] & slope['can'], density['pervasive'])
-    rule55 = ctrl.Rule(ovc['pervasive'] & sp2['breach'] & splow['probably'] & slope['probably'], density['frequent'])
-    rule56 = ctrl.Rule(ovc['pervasive'] & sp2['oblowout'] & splow['can'] & slope['flat'], density['frequent'])
-    rule57 = ctrl.Rule(ovc['pervasive'] & sp2['oblowout'] & splow['can'] & slope['can'], density['pervasive'])
-    rule58 = ctrl.Rule(ovc['pervasive'] & sp2['oblowout'] & splow['can'] & slope['probably'], density['frequent'])
-    rule59 = ctrl.Rule(ovc['pervasive'] & sp2['oblowout'] & splow['probably'] & slope['flat'], density['occasional'])
-    rule60 = ctrl.Rule(ovc['pervasive'] & sp2['oblowout'] & splow['probably'] & slope['can'], density['frequent'])
-    rule61 = \
-        ctrl.Rule(ovc['pervasive'] & sp2['oblowout'] & splow['probably'] & slope['probably'], density['occasional'])
-    rule62 = ctrl.Rule(ovc['pervasive'] & sp2['blowout'] & splow['can'] & slope['flat'], density['occasional'])
-    rule63 = ctrl.Rule(ovc['pervasive'] & sp2['blowout'] & splow['can'] & slope['can'], density['occasional'])
-    rule64 = ctrl.Rule(ovc['pervasive'] & sp2['blowout'] & splow['can'] & slope['probably'], density['rare'])
-    rule65 = ctrl.Rule(ovc['pervasive'] & sp2['blowout'] & splow['probably'] & slope['flat'], density['occasional'])
-    rule66 = ctrl.Rule(ovc['pervasive'] & sp2['blowout'] & splow['probably'] & slope['can'], density['occasional'])
-    rule67 = ctrl.Rule(ovc['pervasive'] & sp2['blowout'] & splow['probably'] & slope['probably'], density['rare'])
-
-    comb_ctrl = ctrl.ControlSystem([rule1, rule2, rule3, rule4, rule5, rule6, rule7, rule8, rule9, rule10,
-                                    rule11, rule12, rule13, rule14, rule15, rule16, rule17, rule18, rule19, rule20,
-                                    rule21, rule22, rule23, rule24, rule25, rule26, rule27, rule28, rule29, rule30,
-                                    rule31, rule32, rule33, rule34, rule35, rule36, rule37, rule38, rule39, rule40,
-                                    rule41, rule42, rule43, rule44, rule45, rule46, rule47, rule48, rule49, rule50,
-                                    rule51, rule52, rule53, rule54, rule55, rule56, rule57, rule58, rule59, rule60,
-                                    rule61, rule62, rule63, rule64, rule65, rule66, rule67])
-    comb_fis = ctrl.ControlSystemSimulation(comb_ctrl)
+    return fis_output
+
+
+def calculate_comb_capacity(ovc_array, ihydsp2_array, ihydsplow_array, igeoslope_array, da_array, max_da_thresh,
+                            evaluate):
+    """
+    Runs the combined capacity FIS on arrays of inputs
+    :param ovc_array: An array of vegetation dam capacity
+    :param ihydsp2_array: An array of annual peak stream power
+    :param ihydsplow_array: An array of baseflow stream power
+    :param igeoslope_array: An array of reach slopes
+    :param da_array: An array of drainage areas
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+    :param evaluate: A function that evaluates the combined FIS on a list of input arrays
+    :return: An array of combined dam capacity, in dams per km
+    """
+    raw_out = run_comb_fis(ovc_array, ihydsp2_array, ihydsplow_array, igeoslope_array, evaluate)
+    return finish_comb_capacity(raw_out, ovc_array, da_array, max_da_thresh)
+
+
+def run_comb_fis(ovc_array, ihydsp2_array, ihydsplow_array, igeoslope_array, evaluate):
+    """
+    Runs the combined capacity FIS on arrays of inputs, without any of the post-processing
+    :param ovc_array: An array of vegetation dam capacity
+    :param ihydsp2_array: An array of annual peak stream power
+    :param ihydsplow_array: An array of baseflow stream power
+    :param igeoslope_array: An array of reach slopes
+    :param evaluate: A function that evaluates the combined FIS on a list of input arrays
+    :return: An array of defuzzified FIS output
+    """
+    # check that inputs are within range of fis
+    # if not, re-assign the value to just within range
+    fis_ovc_array = np.clip(ovc_array, 0, 45)
+    ihydsp2_array = np.where(ihydsp2_array < 0, 0.0001, np.minimum(ihydsp2_array, 10000))
+    ihydsplow_array = np.where(ihydsplow_array < 0, 0.0001, np.minimum(ihydsplow_array, 10000))
+    igeoslope_array = np.minimum(igeoslope_array, 1)
 
     # run fuzzy inference system on inputs and defuzzify output
     # TODO Test this using nas instead of zeros
-    out = np.zeros(len(ovc_array))
-    for i in range(len(out)):
-        comb_fis.input['input1'] = ovc_array[i]
-        comb_fis.input['input2'] = ihydsp2_array[i]
-        comb_fis.input['input3'] = ihydsplow_array[i]
-        comb_fis.input['input4'] = igeoslope_array[i]
-        comb_fis.compute()
-        out[i] = comb_fis.output['result']
-
-    # save fuzzy inference system output as table
-    columns = np.column_stack((segid_array, out))
-    out_table = os.path.dirname(in_network) + "/" + out_field + "_Table.txt"
-    # TODO See if possible to skip this step
-    np.savetxt(out_table, columns, delimiter=",", header="ReachID, " + out_field, comments="")
-    occ_table = scratch + "/" + out_field + "Tbl"
-    arcpy.CopyRows_management(out_table, occ_table)
+    return evaluate([fis_ovc_array, ihydsp2_array, ihydsplow_array, igeoslope_array])
 
-    # join the fuzzy inference system output to the flowline network
-    # create empty dictionary to hold input table field values
-    tbl_dict = {}
-    # add values to dictionary
-    with arcpy.da.SearchCursor(occ_table, ['ReachID', out_field]) as cursor:
-        for row in cursor:
-            tbl_dict[row[0]] = row[1]
-    # populate flowline network out field
-    arcpy.AddField_management(in_network, out_field, 'DOUBLE')
-    with arcpy.da.UpdateCursor(in_network, ['ReachID', out_field]) as cursor:
-        for row in cursor:
-            try:
-                a_key = row[0]
-                row[1] = tbl_dict[a_key]
-                cursor.updateRow(row)
-            # TODO There should be no bare excepts. What kind of error is this trying to catch?
-            except:
-                pass
-    tbl_dict.clear()
-
-    # calculate defuzzified centroid value for density 'none' MF group
-    # this will be used to re-classify output values that fall in this group
-    # important: will need to update the array (x) and MF values (mfx) if the
-    #            density 'none' values are changed in the model
-    x = np.arange(0, 45, 0.01)
-    mfx_none = fuzz.trimf(x, [0, 0, 0.1])
-    defuzz_none = round(fuzz.defuzz(x, mfx_none, 'centroid'), 6)
-    mfx_pervasive = fuzz.trapmf(x, [12, 25, 45, 45])
-    defuzz_pervasive = round(fuzz.defuzz(x, mfx_pervasive, 'centroid'))
-
-    # update combined capacity (occ_*) values in stream network
+
+def finish_comb_capacity(raw_out, ovc_array, da_array, max_da_thresh, output=None):
+    """
+    Turns the raw combined FIS output into dam capacity
+    :param raw_out: An array of defuzzified FIS output
+    :param ovc_array: An array of vegetation dam capacity
+    :param da_array: An array of drainage areas
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building. If
+        a list of values is given, each is applied to its own row of the output
+    :param output: The FuzzyVariable of the FIS output, if its 'none' and 'pervasive' terms aren't the defaults
+    :return: An array of combined dam capacity, in dams per km, with one row per threshold if a list was given
+    """
+    # set occ_* to 0 if output falls fully in 'none' category and to 40 if falls fully in 'pervasive' category
+    return limit_comb_capacity(reclassify_capacity(raw_out, output), ovc_array, da_array, max_da_thresh)
+
+
+def limit_comb_capacity(capacity, ovc_array, da_array, max_da_thresh):
+    """
+    Limits reclassified combined FIS output by the vegetation capacity and the drainage area threshold
+    :param capacity: An array of FIS output, after the 'none' and 'pervasive' reclassification
+    :param ovc_array: An array of vegetation dam capacity
+    :param da_array: An array of drainage areas
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building. If
+        a list of values is given, each is applied to its own row of the output
+    :return: An array of combined dam capacity, in dams per km, with one row per threshold if a list was given
+    """
     # correct for occ_* greater than ovc_* as vegetation is most limiting factor in model
     # (i.e., combined fis value should not be greater than the vegetation capacity)
+    out = np.where(capacity > ovc_array, ovc_array, capacity)
     # set occ_* to 0 if the drainage area is greater than the user defined threshold
     # this enforces a stream size threshold above which beaver dams won't persist and/or won't be built
-    # set occ_* to 0 if output falls fully in 'none' category and to 40 if falls fully in 'pervasive' category
+    if np.ndim(max_da_thresh) > 0:
+        thresholds = np.asarray(max_da_thresh, dtype=np.float64).reshape(-1, 1)
+    else:
+        thresholds = float(max_da_thresh)
+    out = np.where(da_array >= thresholds, 0.0, out)
 
-    with arcpy.da.UpdateCursor(in_network, [out_field, veg_field, 'iGeo_DA', 'iGeo_Slope']) as cursor:
-        for row in cursor:
-            if round(row[0], 6) == defuzz_none:
-                row[0] = 0.0
-            if round(row[0]) >= defuzz_pervasive:
-                row[0] = 40.0
-            if row[0] > row[1]:
-                row[0] = row[1]
-            if row[2] >= float(max_da_thresh):
-                row[0] = 0.0
-            cursor.updateRow(row)
-
-    # delete temporary tables and arrays
-    arcpy.Delete_management(out_table)
-    arcpy.Delete_management(occ_table)
-    items = [columns, out, x, mfx_none, defuzz_none]
-    for item in items:
-        del item
+    return out
 
-    # calculate dam count (mCC_**_CT) for each reach as number of dams * reach length (in km)
-    arcpy.AddField_management(in_network, mcc_field, 'SHORT')
-    with arcpy.da.UpdateCursor(in_network, [mcc_field, out_field, 'iGeo_Len']) as cursor:
-        for row in cursor:
-            len_km = row[2] / 1000
-            raw_ct = row[1] * len_km
-            if 1 > raw_ct > 0:
-                row[0] = 1
-            else:
-                row[0] = round(raw_ct)
-            cursor.updateRow(row)
 
-    # calculate dam count historic departure as difference between potential count and existing count
-    if model_run == 'ex':
-        arcpy.AddField_management(in_network, 'mCC_HisDep', 'SHORT')
-        with arcpy.da.UpdateCursor(in_network, ['mCC_HisDep', 'mCC_EX_CT', 'mCC_HPE_CT']) as cursor:
-            for row in cursor:
-                row[0] = row[2] - row[1]
-                cursor.updateRow(row)
+def count_dams(capacity, length):
+    """
+    Calculates the number of dams a reach can hold, rounded to a whole number but at least 1 if it can hold any
+    :param capacity: An array of dam capacity, in dams per km
+    :param length: An array of reach lengths, in meters
+    :return: An array of dam counts
+    """
+    raw_ct = capacity * (length / 1000)
+    # round half away from zero, the way round() does, rather than to the nearest even number
+    dam_count = np.sign(raw_ct) * np.floor(np.abs(raw_ct) + 0.5)
+    dam_count[(raw_ct > 0) & (raw_ct < 1)] = 1
+    return dam_count
+
+
+def fis_output_path(out_network):
+    """
+    Gets where the FIS output for a network is saved
+    :param out_network: The combined capacity network
+    :return: The path to the saved FIS output
+    """
+    return os.path.splitext(out_network)[0] + "_FIS_Output.npz"
+
+
+def save_fis_output(file_path, fis_output):
+    """
+    Saves the reclassified FIS output of both model runs, with the inputs the capacity and dam counts are calculated
+    from
+    :param file_path: Where to save the output
+    :param fis_output: A dictionary of arrays, keyed by the FIS_OUTPUT_FIELDS
+    :return:
+    """
+    np.savez(file_path, **dict((field, fis_output[field]) for field in FIS_OUTPUT_FIELDS))
+
+
+def load_fis_output(file_path):
+    """
+    Loads FIS output saved by save_fis_output(), including output saved with the OLD_FIS_OUTPUT_FIELDS names
+    :param file_path: The saved FIS output
+    :return: A dictionary of arrays, keyed by the FIS_OUTPUT_FIELDS
+    """
+    if not os.path.exists(file_path):
+        raise Exception("The FIS output " + file_path + " does not exist. Run the combined capacity model to make it")
+    saved = np.load(file_path)
+    saved_names = dict((field, field if field in saved.files else OLD_FIS_OUTPUT_FIELDS.get(field, field))
+                       for field in FIS_OUTPUT_FIELDS)
+    missing_fields = [field for field in FIS_OUTPUT_FIELDS if saved_names[field] not in saved.files]
+    if len(missing_fields) > 0:
+        raise Exception("The FIS output " + file_path + " is missing " + ", ".join(missing_fields))
+    return dict((field, saved[saved_names[field]]) for field in FIS_OUTPUT_FIELDS)
+
+
+def sweep_da_thresholds(fis_output, thresholds, out_csv=None):
+    """
+    Finds what the combined capacity and dam counts of the network would be for each of a list of drainage area
+    thresholds, from the saved FIS output. All thresholds are applied at once, so the FIS is never run again
+    :param fis_output: A dictionary of arrays keyed by the FIS_OUTPUT_FIELDS, or the path to saved FIS output
+    :param thresholds: A list of drainage area thresholds, in square kilometers
+    :param out_csv: An optional CSV file to write the summary to
+    :return: A list of dictionaries, one per threshold, summarizing the network
+    """
+    if not isinstance(fis_output, dict):
+        fis_output = load_fis_output(fis_output)
+    thresholds = [float(threshold) for threshold in thresholds]
+    if len(thresholds) == 0:
+        raise Exception("No drainage area thresholds were given to sweep")
+
+    length = fis_output["iGeo_Len"]
+    counts = {}
+    capacity = {}
+    for model_run in ["HPE", "EX"]:
+        occ = limit_comb_capacity(fis_output["fis_" + model_run], fis_output["oVC_" + model_run],
+                                  fis_output["iGeo_DA"], thresholds)
+        capacity[model_run] = np.sum(occ * (length / 1000), axis=1)
+        counts[model_run] = count_dams(occ, length)
+    over_threshold = fis_output["iGeo_DA"] >= np.reshape(thresholds, (-1, 1))
+
+    summary = []
+    for i, threshold in enumerate(thresholds):
+        summary.append({
+            "MaxDAThresh": threshold,
+            "ReachesOver": int(np.sum(over_threshold[i])),
+            "oCC_HPE_Tot": float(capacity["HPE"][i]),
+            "oCC_EX_Tot": float(capacity["EX"][i]),
+            "mCC_HPE_CT": int(np.sum(counts["HPE"][i])),
+            "mCC_EX_CT": int(np.sum(counts["EX"][i])),
+            "mCC_HisDep": int(np.sum(counts["HPE"][i] - counts["EX"][i]))
+        })
+        arcpy.AddMessage("DA threshold " + str(threshold) + ": " + str(summary[-1]["mCC_EX_CT"]) +
+                         " existing dams, " + str(summary[-1]["mCC_HPE_CT"]) + " historic dams, " +
+                         str(summary[-1]["ReachesOver"]) + " reaches over the threshold")
+
+    if out_csv:
+        with open(out_csv, 'wb') as csv_file:
+            writer = csv.DictWriter(csv_file, SWEEP_FIELDS)
+            writer.writeheader()
+            writer.writerows(summary)
+
+    return summary
+
+
+class CombFISProfiles(object):
+    """
+    The combined FIS profiles used on a network. Each profile is loaded and given its own evaluator the first time a
+    reach needs it, and kept so that both model runs share them
+    """
+
+    def __init__(self, default_profile=None, profile_folder=None, memoize=False, memo_resolutions=None, workers=1,
+                 chunk_size=DEFAULT_CHUNK_SIZE, use_skfuzzy=False):
+        """
+        :param default_profile: The profile file used for reaches that don't name one. Defaults to the default FIS
+        :param profile_folder: The folder profile names are looked up in. Defaults to the folder of the default
+            profile, or to the FISProfiles folder that comes with BRAT
+        :param memoize: If True, each profile is evaluated once per unique set of quantized inputs
+        :param memo_resolutions: The resolutions to quantize the inputs to when memoizing, as a list or as text like
+            "1;10;1;0.001". Defaults to the step of each input universe
+        :param workers: How many processes to run the FIS in. 1 runs it in this process
+        :param chunk_size: How many reaches are given to a worker at a time
+        :param use_skfuzzy: If True, runs the FIS through skfuzzy one reach at a time instead of the vectorized engine
+        """
+        if default_profile is None or default_profile == "None" or default_profile == "":
+            default_profile = None
+        if profile_folder is None or profile_folder == "None" or profile_folder == "":
+            profile_folder = os.path.dirname(default_profile or DEFAULT_PROFILE)
+        self.default_profile = default_profile
+        self.profile_folder = profile_folder
+        self.memoize = memoize
+        self.memo_resolutions = memo_resolutions
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.use_skfuzzy = use_skfuzzy
+        self.runs = {}
+
+    def profile_path(self, name):
+        """
+        Finds the profile file a reach's profile name refers to
+        :param name: A profile file, or the name of a profile in the profile folder, or None or an empty string for
+            the default profile
+        :return: The path to the profile file, or None for the default FIS
+        """
+        if name is None or name.strip() == "" or name.strip() == "None":
+            return self.default_profile
+        name = name.strip()
+        if os.path.isfile(name):
+            return name
+        profile_path = os.path.join(self.profile_folder, name)
+        if not profile_path.lower().endswith('.json'):
+            profile_path += '.json'
+        if not os.path.isfile(profile_path):
+            raise Exception("Could not find the combined FIS profile \"" + name + "\" in " + self.profile_folder)
+        return profile_path
+
+    def run(self, profile_path):
+        """
+        Gets the FIS of a profile and the function that evaluates it, making them the first time they're needed
+        :param profile_path: The path to the profile file, or None for the default FIS
+        :return: A dictionary holding the 'fis', the 'evaluate' function and the 'memo', if memoizing
+        """
+        if profile_path not in self.runs:
+            fis_builder = comb_fis_builder(profile_path)
+            fis = fis_builder()
+            evaluate = make_evaluator(fis_builder, self.use_skfuzzy, self.workers, self.chunk_size)
+            memo = None
+            if self.memoize:
+                memo = MemoizedEvaluator(evaluate, read_memo_resolutions(self.memo_resolutions, fis))
+                evaluate = memo.evaluate
+            self.runs[profile_path] = {'fis': fis, 'evaluate': evaluate, 'memo': memo}
+        return self.runs[profile_path]
+
+    def run_reaches(self, profile_names, ovc_array, ihydsp2_array, ihydsplow_array, igeoslope_array):
+        """
+        Runs the combined FIS on every reach with its own profile, one group of reaches per profile, and
+        reclassifies the output with that profile's 'none' and 'pervasive' terms
+        :param profile_names: An array with the profile name of each reach, or None to use the default profile for
+            every reach
+        :param ovc_array: An array of vegetation dam capacity
+        :param ihydsp2_array: An array of annual peak stream power
+        :param ihydsplow_array: An array of baseflow stream power
+        :param igeoslope_array: An array of reach slopes
+        :return: An array of reclassified FIS output
+        """
+        if profile_names is None:
+            run = self.run(self.default_profile)
+            raw_out = run_comb_fis(ovc_array, ihydsp2_array, ihydsplow_array, igeoslope_array, run['evaluate'])
+            return reclassify_capacity(raw_out, run['fis'].output)
+
+        out = np.zeros(len(ovc_array), dtype=np.float64)
+        profile_names = np.array([name.strip() if name else "" for name in profile_names])
+        for name in np.unique(profile_names):
+            in_profile = profile_names == name
+            run = self.run(self.profile_path(name))
+            arcpy.AddMessage("Running the combined FIS on " + str(np.count_nonzero(in_profile)) + " reaches with " +
+                             "the " + (name if name else "default") + " profile...")
+            raw_out = run_comb_fis(ovc_array[in_profile], ihydsp2_array[in_profile], ihydsplow_array[in_profile],
+                                   igeoslope_array[in_profile], run['evaluate'])
+            out[in_profile] = reclassify_capacity(raw_out, run['fis'].output)
+        return out
+
+    def report(self):
+        """
+        Reports how well memoizing worked for each profile
+        :return:
+        """
+        for profile_path, run in self.runs.items():
+            if run['memo'] is not None:
+                arcpy.AddMessage(os.path.basename(profile_path or DEFAULT_PROFILE) + ": " + run['memo'].report())
+
+
+def comb_fis_builder(profile=None):
+    """
+    Gets the function that builds the combined FIS of a profile
+    :param profile: The path to a FIS profile file, or None for the default FIS
+    :return: A function that returns a FuzzyInferenceSystem, which can be given to pool workers
+    """
+    if profile is None or profile == "None" or profile == "":
+        return build_comb_fis
+    arcpy.AddMessage("Using the combined FIS profile " + profile)
+    return ProfileFISBuilder(load_profile, profile)
+
+
+def build_comb_fis():
+    """
+    Builds the default combined capacity fuzzy inference system, from the profile that comes with BRAT
+    :return: A FuzzyInferenceSystem with the inputs oVC, iHyd_SP2, iHyd_SPLow, and iGeo_Slope, in that order
+    """
+    return load_profile(DEFAULT_PROFILE)
+
+
+def load_profile(profile_path):
+    """
+    Builds the combined FIS of a profile, or returns the one already built from it. A profile is built again if its
+    file has changed since it was last loaded
+    :param profile_path: The path to the profile file
+    :return: A FuzzyInferenceSystem with the inputs oVC, iHyd_SP2, iHyd_SPLow, and iGeo_Slope, in that order
+    """
+    if not os.path.isfile(profile_path):
+        raise Exception("The combined FIS profile " + profile_path + " does not exist")
+    key = os.path.normcase(os.path.abspath(profile_path))
+    modified = os.path.getmtime(profile_path)
+    if key not in _loaded_profiles or _loaded_profiles[key][0] != modified:
+        _loaded_profiles[key] = (modified, read_profile(profile_path))
+    return _loaded_profiles[key][1]
+
+
+def read_profile(profile_path):
+    """
+    Reads a combined FIS profile and builds its FIS. Version 1 profiles move breakpoints of the default FIS, and
+    version 2 profiles describe the whole FIS
+    :param profile_path: The path to the profile file
+    :return: A FuzzyInferenceSystem
+    """
+    with open(profile_path) as profile_file:
+        profile = json.load(profile_file)
+    if profile.get("fis") != "comb":
+        raise Exception(profile_path + " is not a combined FIS profile")
+    if profile.get("version", 0) > PROFILE_VERSION:
+        raise Exception(profile_path + " was made by a newer version of BRAT")
+
+    if profile.get("version", 0) < 2:
+        fis = build_comb_fis()
+        variable_names = [variable.name for variable in fis.inputs + [fis.output]]
+        changes = {}
+        for change in profile.get("breakpoints", []):
+            if change["variable"] not in variable_names:
+                raise Exception(profile_path + " changes the variable " + change["variable"] + ", which the " +
+                                "combined FIS doesn't have")
+            changes[(change["variable"], float(change["from"]))] = float(change["to"])
+        return fis.with_breakpoints(changes)
+
+    try:
+        fis = fis_from_definition(profile)
+    except Exception as error:
+        raise Exception(profile_path + ": " + str(error))
+    if [variable.name for variable in fis.inputs] != COMB_FIS_INPUTS:
+        raise Exception(profile_path + " needs the inputs " + ", ".join(COMB_FIS_INPUTS) + ", in that order")
+    missing_terms = [term for term in ['none', 'pervasive'] if term not in fis.output.term_names()]
+    if len(missing_terms) > 0:
+        raise Exception(profile_path + " needs the output terms " + " and ".join(missing_terms) + ", which the " +
+                        "capacity is reclassified with")
+    return fis
+
+
+def save_profile(profile_path, fis, description, details=None):
+    """
+    Writes a combined FIS profile, which Comb_FIS can load in place of the default FIS
+    :param profile_path: Where to write the profile
+    :param fis: The FuzzyInferenceSystem to save
+    :param description: A description of where the profile came from
+    :param details: An optional dictionary of other information to keep with the profile
+    :return:
+    """
+    profile = {
+        "fis": "comb",
+        "version": PROFILE_VERSION,
+        "name": os.path.splitext(os.path.basename(profile_path))[0],
+        "description": description
+    }
+    profile.update(fis_definition(fis))
+    if details:
+        profile["details"] = details
+    with open(profile_path, 'w') as profile_file:
+        json.dump(profile, profile_file, indent=4)
 
 
 def add_xml_output(in_network, out_network):
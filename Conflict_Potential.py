@@ -13,8 +13,15 @@ import arcpy
 import numpy as np
 import os
 import sys
+import csv
 import projectxml
-from SupportingFunctions import getUUID
+from SupportingFunctions import getUUID, load_columns, write_columns
+
+# the names of the distance thresholds, in the order they're given in
+THRESHOLD_NAMES = ["CrossingLow", "CrossingHigh", "AdjLow", "AdjHigh", "CanalLow", "CanalHigh", "RRLow", "RRHigh"]
+
+# the distance thresholds used when none are given, in meters
+DEFAULT_THRESHOLDS = [10, 100, 10, 100, 50, 200, 30, 100]
 
 
 def main(
@@ -27,8 +34,17 @@ def main(
     CanalLow,
     CanalHigh,
     RRLow,
-    RRHigh):
-
+    RRHigh,
+    threshold_scenarios=None):
+    """
+    Adds the conflict potential score to the BRAT capacity output
+    :param projPath: The path to the project folder for this BRAT run
+    :param in_network: The input BRAT capacity network
+    :param threshold_scenarios: An optional CSV of other threshold sets to score, with the columns CrossingLow,
+        CrossingHigh, AdjLow, AdjHigh, CanalLow, CanalHigh, RRLow and RRHigh. Each row's score is written to its own
+        field (oPC_Sc1, oPC_Sc2, ...) so the scenarios can be compared
+    :return:
+    """
     scratch = 'in_memory'
 
     arcpy.env.overwriteOutput = True
@@ -41,14 +57,16 @@ def main(
     # CanalHigh = 200
     # RRLow = 30
     # RRHigh = 100
-    out_network = find_oPC_Score(in_network, CrossingLow, CrossingHigh, AdjLow, AdjHigh, CanalLow, CanalHigh, RRLow, RRHigh, scratch)
+    out_network = find_oPC_Score(in_network, CrossingLow, CrossingHigh, AdjLow, AdjHigh, CanalLow, CanalHigh, RRLow, RRHigh, scratch,
+                                 threshold_scenarios)
 
     add_xml_output(projPath, in_network, out_network)
 
     makeLayers(out_network)
 
 
-def find_oPC_Score(in_network, CrossingLow, CrossingHigh, AdjLow, AdjHigh, CanalLow, CanalHigh, RRLow, RRHigh, scratch):
+def find_oPC_Score(in_network, CrossingLow, CrossingHigh, AdjLow, AdjHigh, CanalLow, CanalHigh, RRLow, RRHigh, scratch,
+                   threshold_scenarios=None):
     # if out_name.endswith('.shp'):
     #     out_network = os.path.join(os.path.dirname(in_network), out_name)
     # else:
@@ -62,162 +80,122 @@ def find_oPC_Score(in_network, CrossingLow, CrossingHigh, AdjLow, AdjHigh, Canal
     if "oPC_Score" in fields:
         arcpy.DeleteField_management(out_network, "oPC_Score")
 
-    # create segid array for joining output
-    segid_np = arcpy.da.FeatureClassToNumPyArray(out_network, "ReachID")
-    segid_array = np.asarray(segid_np, np.int64)
-
-    # road crossing conflict
-    if "iPC_RoadX" in fields:
-        roadx_array = arcpy.da.FeatureClassToNumPyArray(out_network, "iPC_RoadX")
-        roadx = np.asarray(roadx_array, np.float64)
-        roadx_pc = np.empty_like(roadx)
-        m = slopeInt(CrossingLow, CrossingHigh)[0]
-        b = slopeInt(CrossingLow, CrossingHigh)[1]
-        for i in range(len(roadx)):
-            if roadx[i] >= 0 and roadx[i] <= CrossingLow:
-                roadx_pc[i] = 0.99
-            elif roadx[i] > CrossingLow and roadx[i] <= CrossingHigh:
-                roadx_pc[i] = m * roadx[i] + b
-            elif roadx[i] > CrossingHigh:
-                roadx_pc[i] = 0.01
-            else:
-                roadx_pc[i] = 0.01
+    # read the segid array for joining output, and every conflict field in the network, with one scan
+    conflict_fields = [field for field in ["iPC_RoadX", "iPC_RoadAd", "iPC_Canal", "iPC_RR", "iPC_LU"] if field in fields]
+    columns = load_columns(out_network, ["ReachID"] + conflict_fields)
+    segid_array = columns["ReachID"]
 
-        del roadx_array, roadx, m, b
-    else:
-        roadx_pc = np.zeros_like(segid_array)
-
-    # road adjacent conflict
-    if "iPC_RoadAd" in fields:
-        roadad_array = arcpy.da.FeatureClassToNumPyArray(out_network, "iPC_RoadAd")
-        roadad = np.asarray(roadad_array, np.float64)
-        #roadad_pc = np.zeros_like(roadad)
-        roadad_pc = np.empty_like(roadad)
-        m = slopeInt(AdjLow, AdjHigh)[0]
-        b = slopeInt(AdjLow, AdjHigh)[1]
-        for i in range(len(roadad)):
-            if roadad[i] >= 0 and roadad[i] <= AdjLow:
-                roadad_pc[i] = 0.99
-            elif roadad[i] > AdjLow and roadad[i] <= AdjHigh:
-                roadad_pc[i] = m * roadad[i] + b
-            elif roadad[i] > AdjHigh:
-                roadad_pc[i] = 0.01
-            else:
-                roadad_pc[i] = 0.01
+    # score the given thresholds first, followed by any scenarios to compare them with
+    threshold_sets = [[CrossingLow, CrossingHigh, AdjLow, AdjHigh, CanalLow, CanalHigh, RRLow, RRHigh]]
+    if threshold_scenarios:
+        threshold_sets += read_threshold_scenarios(threshold_scenarios)
+    scores = calculate_oPC_Scores(columns, threshold_sets)
 
-        del roadad_array, roadad, m, b
-    else:
-        roadad_pc = np.zeros_like(segid_array)
-
-    # canal conflict
-    if "iPC_Canal" in fields:
-        canal_array = arcpy.da.FeatureClassToNumPyArray(out_network, "iPC_Canal")
-        canal = np.asarray(canal_array, np.float64)
-        #canal_pc = np.zeros_like(canal)
-        canal_pc = np.empty_like(canal)
-        m = slopeInt(CanalLow, CanalHigh)[0]
-        b = slopeInt(CanalLow, CanalHigh)[1]
-        for i in range(len(canal)):
-            if canal[i] >= 0 and canal[i] <= CanalLow:
-                canal_pc[i] = 0.99
-            elif canal[i] > CanalLow and canal[i] <= CanalHigh:
-                canal_pc[i] = m * canal[i] + b
-            elif canal[i] > CanalHigh:
-                canal_pc[i] = 0.01
-            else:
-                canal_pc[i] = 0.01
+    output_columns = [('oPC_Score', scores[0])]
+    for i in range(1, len(threshold_sets)):
+        output_columns.append(('oPC_Sc' + str(i), scores[i]))
+        arcpy.AddMessage("Scenario " + str(i) + " (" + ", ".join(str(t) for t in threshold_sets[i]) + "): mean score " +
+                         str(round(np.mean(scores[i]), 3)) + ", " + str(np.count_nonzero(scores[i] >= 0.5)) +
+                         " reaches scored 0.5 or more")
 
-        del canal_array, canal, m, b
-    else:
-        canal_pc = np.zeros_like(segid_array)
-
-    # railroad conflict
-    if "iPC_RR" in fields:
-        rr_array = arcpy.da.FeatureClassToNumPyArray(out_network, "iPC_RR")
-        rr = np.asarray(rr_array, np.float64)
-        #rr_pc = np.zeros_like(rr)
-        rr_pc = np.empty_like(rr)
-        m = slopeInt(RRLow, RRHigh)[0]
-        b = slopeInt(RRLow, RRHigh)[1]
-        for i in range(len(rr)):
-            if rr[i] >= 0 and rr[i] <= RRLow:
-                rr_pc[i] = 0.99
-            elif rr[i] > RRLow and rr[i] <= RRHigh:
-                rr_pc[i] = m * rr[i] + b
-            elif rr[i] > RRHigh:
-                rr_pc[i] = 0.01
-            else:
-                rr_pc[i] = 0.01
+    # join the output to the flowline network
+    write_columns(out_network, segid_array, output_columns)
+
+    return out_network
 
-        del rr_array, rr, m, b
-    else:
-        rr_pc = np.zeros_like(segid_array)
+
+def calculate_oPC_Score(columns, CrossingLow, CrossingHigh, AdjLow, AdjHigh, CanalLow, CanalHigh, RRLow, RRHigh):
+    """
+    Calculates the conflict potential score from the distances to infrastructure and the landuse intensity of each
+    reach
+    :param columns: A dictionary of arrays keyed by field name, with ReachID and any of iPC_RoadX, iPC_RoadAd,
+        iPC_Canal, iPC_RR and iPC_LU. Missing fields don't add to the score
+    :param CrossingLow: The road crossing distance below which conflict is highest
+    :param CrossingHigh: The road crossing distance above which conflict is lowest
+    :param AdjLow: The adjacent road distance below which conflict is highest
+    :param AdjHigh: The adjacent road distance above which conflict is lowest
+    :param CanalLow: The canal distance below which conflict is highest
+    :param CanalHigh: The canal distance above which conflict is lowest
+    :param RRLow: The railroad distance below which conflict is highest
+    :param RRHigh: The railroad distance above which conflict is lowest
+    :return: An array of conflict potential scores
+    """
+    return calculate_oPC_Scores(columns, [[CrossingLow, CrossingHigh, AdjLow, AdjHigh, CanalLow, CanalHigh, RRLow,
+                                           RRHigh]])[0]
+
+
+def calculate_oPC_Scores(columns, threshold_sets):
+    """
+    Calculates the conflict potential score of each reach for several sets of thresholds at once
+    :param columns: A dictionary of arrays keyed by field name, with ReachID and any of iPC_RoadX, iPC_RoadAd,
+        iPC_Canal, iPC_RR and iPC_LU. Missing fields don't add to the score
+    :param threshold_sets: A list of [CrossingLow, CrossingHigh, AdjLow, AdjHigh, CanalLow, CanalHigh, RRLow,
+        RRHigh] lists
+    :return: A matrix of conflict potential scores, with a row for each threshold set and a column for each reach
+    """
+    thresholds = np.asarray(threshold_sets, np.float64).reshape(-1, 8)
+    oPC_Score = np.zeros((len(thresholds), len(columns["ReachID"])))
+
+    # road crossing, road adjacent, canal and railroad conflict
+    distance_fields = ["iPC_RoadX", "iPC_RoadAd", "iPC_Canal", "iPC_RR"]
+    for i, field in enumerate(distance_fields):
+        if field in columns:
+            low = thresholds[:, 2 * i]
+            high = thresholds[:, 2 * i + 1]
+            oPC_Score = np.fmax(oPC_Score, distance_scores(columns[field], low, high))
 
     # landuse conflict
-    if "iPC_LU" in fields:
-        lu_array = arcpy.da.FeatureClassToNumPyArray(out_network, "iPC_LU")
-        lu = np.asarray(lu_array, np.float64)
-        lu_pc = np.empty_like(lu)
-
-        # for i in range(len(lu)):
-        #     if lu[i] >= 2:
-        #         lu_pc[i] = 0.75
-        #     elif lu[i] >= 1.25 and lu[i] < 2:
-        #         lu_pc[i] = 0.5
-        #     elif lu[i] < 1.25:
-        #         lu_pc[i] = 0.01
-        #     else:
-        #         lu_pc[i] = 0.01
-
-        for i in range(len(lu)):
-            if lu[i] >= 1.0:
-                lu_pc[i] = 0.99
-            elif lu[i] >= 0.66 and lu[i] < 1.0:
-                lu_pc[i] = 0.75
-            elif lu[i] >= 0.33 and lu[i] < 0.66:
-                lu_pc[i] = 0.5
-            elif lu[i] > 0 and lu[i] < 0.33:
-                lu_pc[i] = 0.25
-            else:
-                lu_pc[i] = 0.01
-    else:
-        lu_pc = np.zeros_like(segid_array)
+    if "iPC_LU" in columns:
+        oPC_Score = np.fmax(oPC_Score, landuse_scores(columns["iPC_LU"]))
+
+    return oPC_Score
 
-    # get max of all individual conflict potential scores
-    # this is our conflict potential output
-    oPC_Score = np.fmax(roadx_pc, np.fmax(roadad_pc, np.fmax(canal_pc, np.fmax(rr_pc, lu_pc))))
 
-    # save the output text file
-    columns = np.column_stack((segid_array, oPC_Score))
-    out_table = os.path.dirname(out_network) + "/oPC_Score_Table.txt"
-    np.savetxt(out_table, columns, delimiter = ",", header = "ReachID, oPC_Score", comments = "")
+def distance_scores(distance, low, high):
+    """
+    Scores conflict from the distance to infrastructure, as 0.99 up to the low threshold, falling linearly to 0.01
+    at the high threshold, and 0.01 beyond it
+    :param distance: An array of distances, one for each reach
+    :param low: An array of low thresholds, one for each threshold set
+    :param high: An array of high thresholds, one for each threshold set
+    :return: A matrix of scores, with a row for each threshold set and a column for each reach
+    """
+    low = low[:, np.newaxis]
+    high = high[:, np.newaxis]
+    m, b = slopeInt(low, high)
+    with np.errstate(invalid='ignore'):
+        scores = np.where(distance <= low, 0.99, np.where(distance <= high, m * distance + b, 0.01))
+        # negative or missing distances don't add to the conflict
+        scores[:, ~(distance >= 0)] = 0.01
+    return scores
 
-    opc_score_table = scratch + "/opc_score_table"
-    arcpy.CopyRows_management(out_table, opc_score_table)
 
-    # join the output to the flowline network
-    # create empty dictionary to hold input table field values
-    tblDict = {}
-    # add values to dictionary
-    with arcpy.da.SearchCursor(opc_score_table, ['ReachID', 'oPC_Score']) as cursor:
-        for row in cursor:
-            tblDict[row[0]] = row[1]
-    # populate flowline network out field
-    arcpy.AddField_management(out_network, 'oPC_Score', 'DOUBLE')
-    with arcpy.da.UpdateCursor(out_network, ['ReachID', 'oPC_Score']) as cursor:
-        for row in cursor:
-            try:
-                aKey = row[0]
-                row[1] = tblDict[aKey]
-                cursor.updateRow(row)
-            except:
-                pass
-    tblDict.clear()
-
-    arcpy.Delete_management(out_table)
-    arcpy.Delete_management(opc_score_table)
+def landuse_scores(landuse):
+    """
+    Scores conflict from landuse intensity in bins of 0.99 at 1 and above, 0.75 from 0.66, 0.5 from 0.33 and 0.25
+    above 0. Anything else scores 0.01
+    :param landuse: An array of landuse intensities, one for each reach
+    :return: An array of scores
+    """
+    bin_scores = np.array([0.25, 0.5, 0.75, 0.99])
+    scores = bin_scores[np.digitize(landuse, [0.33, 0.66, 1.0])]
+    with np.errstate(invalid='ignore'):
+        scores[~(landuse > 0)] = 0.01
+    return scores
 
-    return out_network
+
+def read_threshold_scenarios(scenario_csv):
+    """
+    Reads threshold sets to compare from a CSV file
+    :param scenario_csv: The path to a CSV with the columns CrossingLow, CrossingHigh, AdjLow, AdjHigh, CanalLow,
+        CanalHigh, RRLow and RRHigh, and a row for each scenario
+    :return: A list of threshold sets
+    """
+    threshold_sets = []
+    with open(scenario_csv, "rb") as csv_file:
+        for row in csv.DictReader(csv_file):
+            threshold_sets.append([float(row[name]) for name in THRESHOLD_NAMES])
+    return threshold_sets
 
 
 # function to calculate slope-intercept equation based on user inputs
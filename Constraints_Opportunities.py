@@ -10,15 +10,128 @@
 # -------------------------------------------------------------------------------
 
 import arcpy
+import numpy as np
 import sys
 import os
 import projectxml
-from SupportingFunctions import make_layer, make_folder, find_available_num_prefix, find_relative_path, write_xml_element_with_path
+from SupportingFunctions import make_layer, make_folder, find_available_num_prefix, find_relative_path, \
+    write_xml_element_with_path, load_columns, write_columns
 import XMLBuilder
 reload(XMLBuilder)
 XMLBuilder = XMLBuilder.XMLBuilder
 
 
+# each rule table lists (class, clauses) rules in order of priority. A reach gets the class of the first rule whose
+# clauses are all true, or the default class if none are. Clauses are (field, operator, value). Operators can be
+# negated with 'not ', which is also true for null values, and classes from an earlier table can be used as fields
+# with the 'in' operator
+
+# 'oPBRC_UI' (Areas beavers can build dams, but could be undesireable impacts)
+UNDESIRABLE_DAMS_RULES = [
+    # if capacity is none risk is negligible
+    ("Negligible Risk", [('oCC_EX', '<=', 0)]),
+    # if canals are within 20 meters (usually means canal is on the reach)
+    ("Major Risk", [('iPC_Canal', '<=', 20)]),
+    # if infrastructure within 30 m or land use is high
+    # if capacity is frequent or pervasive risk is considerable
+    # if capaicty is rare or ocassional risk is some
+    ("Major Risk", [('oPC_Dist', '<=', 30), ('oCC_EX', '>=', 5.0)]),
+    ("Major Risk", [('iPC_LU', '>=', 0.66), ('oCC_EX', '>=', 5.0)]),
+    ("Considerable Risk", [('oPC_Dist', '<=', 30)]),
+    ("Considerable Risk", [('iPC_LU', '>=', 0.66)]),
+    # if infrastructure within 30 to 100 m
+    # if capacity is frequent or pervasive risk is some
+    # if capacity is rare or ocassional risk is minor
+    ("Considerable Risk", [('oPC_Dist', '<=', 100), ('oCC_EX', '>=', 5.0)]),
+    ("Minor Risk", [('oPC_Dist', '<=', 100)]),
+    # if infrastructure within 100 to 300 m or land use is 0.33 to 0.66 risk is minor
+    ("Minor Risk", [('oPC_Dist', '<=', 300)]),
+    ("Minor Risk", [('iPC_LU', '>=', 0.33)])
+]
+
+# 'oPBRC_UD' (Areas beavers can't build dams and why)
+UNSUITABLE_DAMS_RULES = [
+    # First deal with vegetation limitations
+    # Find places historically veg limited first ('oVC_HPE' None)
+    # 'oVC_EX' Occasional, Frequent, or Pervasive (some areas have oVC_EX > oVC_HPE)
+    ('Potential Reservoir or Landuse Conversion', [('oVC_HPE', '<=', 0), ('oVC_EX', '>', 0)]),
+    ('Naturally Vegetation Limited', [('oVC_HPE', '<=', 0)]),
+    # 'iGeo_Slope' > 23%
+    ('Slope Limited', [('iGeo_Slope', '>', 0.23)]),
+    # 'oCC_EX' None (Primary focus of this layer is the places that can't support dams now... so why?)
+    ("Anthropogenically Limited", [('oCC_EX', '<=', 0), ('iPC_LU', '>', 0.3)]),
+    ("Stream Power Limited", [('oCC_EX', '<=', 0), ('iHyd_SPLow', '>=', 190)]),
+    ("Stream Power Limited", [('oCC_EX', '<=', 0), ('iHyd_SP2', '>=', 2400)]),
+    ("Stream Size Limited", [('oCC_EX', '<=', 0)])
+]
+
+# 'oPBRC_CR' (Conservation & Restoration Opportunties), only for reaches with negligible or minor risk
+LOW_RISK = ('oPBRC_UI', 'in', ['Negligible Risk', 'Minor Risk'])
+CONSERVATION_RESTORATION_RULES = [
+    # 'oCC_EX' Frequent or Pervasive
+    # 'mcc_his_dep' <= 3
+    ('Easiest - Low-Hanging Fruit', [LOW_RISK, ('oCC_EX', '>=', 5), ('mCC_HisDep', '<=', 3)]),
+    # 'oCC_EX' Occasional, Frequent, or Pervasive
+    # 'oCC_HPE' Frequent or Pervasive
+    # 'mcc_his_dep' <= 3
+    # 'ipc_vlow_lu'(i.e., Natural) > 75
+    # 'ipc_high_lu' (i.e., Developed) < 10
+    ('Straight Forward - Quick Return', [LOW_RISK, ('oCC_EX', '>', 1), ('mCC_HisDep', '<=', 3), ('oCC_HPE', '>=', 5),
+                                         ('iPC_VLowLU', '>', 75), ('iPC_HighLU', '<', 10)]),
+    # 'oCC_EX' Rare or Occasional
+    # 'oCC_HPE' Frequent or Pervasive
+    # 'ipc_vlow_lu'(i.e., Natural) > 75
+    # 'ipc_high_lu' (i.e., Developed) < 10
+    ('Strategic - Long-Term Investment', [LOW_RISK, ('oCC_HPE', '>=', 5), ('oCC_EX', '>', 0), ('iPC_VLowLU', '>', 75),
+                                          ('iPC_HighLU', '<', 10)])
+]
+
+# 'DamStrat' (beaver dam management strategies, derived from TNC project)
+# urban landuse is over 0.66, and agricultural landuse is over 0.33 up to 0.66
+DAM_STRATEGY_RULES = [
+    ("1. Beaver conservation", [('ObsDam', '==', 1), ('iPC_LU', 'not >', 0.33)]),
+    ("6. Restoration with urban or agricultural modification", [('oCC_EX', '>=', 1), ('iPC_LU', '>', 0.33)]),
+    ("5. Restoration with infrastructure modification", [('oCC_EX', '>=', 1), ('oPC_Dist', '<=', 30)]),
+    ("4a. Vegetation restoration first-priority", [('oCC_EX', '>=', 1), ('oCC_EX', '<', 5),
+                                                   ('iPC_LU', 'not >', 0.66), ('HistVegDep', '>=', 4)]),
+    ("4. Medium-low restoration potential", [('oCC_EX', '>=', 1), ('oCC_EX', '<', 5), ('iPC_LU', 'not >', 0.66)]),
+    ("2. Highest restoration potential - translocation", [('oCC_EX', '>=', 20), ('ConsArea', '==', 1)]),
+    ("2. Highest restoration potential - translocation", [('oCC_EX', '>=', 20), ('ConsEase', '==', 1)]),
+    ("3a. Vegetation restoration first-priority", [('oCC_EX', '>=', 5), ('iPC_LU', 'not >', 0.66),
+                                                   ('HistVegDep', '>=', 4)]),
+    ("3. High restoration potential", [('oCC_EX', '>=', 5), ('iPC_LU', 'not >', 0.66)])
+]
+
+# the rule table and default class for each output field, in the order they're classified
+CLASSIFICATIONS = [
+    ('oPBRC_UI', UNDESIRABLE_DAMS_RULES, "Negligible Risk"),
+    ('oPBRC_UD', UNSUITABLE_DAMS_RULES, 'Dam Building Possible'),
+    ('oPBRC_CR', CONSERVATION_RESTORATION_RULES, 'NA'),
+    ('DamStrat', DAM_STRATEGY_RULES, 'Other')
+]
+
+FIELD_TYPES = {
+    "oPBRC_UI": ('TEXT', 30),
+    "oPBRC_UD": ('TEXT', 30),
+    "oPBRC_CR": ('TEXT', 40),
+    "DamStrat": ('TEXT', 60),
+    "ObsDam": ('TEXT', 10),
+    "ConsArea": ('TEXT', 10),
+    "ConsEase": ('TEXT', 10)
+}
+
+INPUT_FIELDS = ['oVC_EX', 'oCC_EX', 'iGeo_Slope', 'mCC_HisDep', 'iPC_VLowLU', 'iPC_HighLU', 'oPC_Dist', 'iPC_LU',
+                'iHyd_SPLow', 'iHyd_SP2']
+
+OPERATORS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '==': np.equal
+}
+
+
 def main(proj_path, in_network, out_name, surveyed_dams=None, conservation_areas=None, conservation_easements=None):
     """
     For each stream segment, assigns a conservation and restoration class
@@ -35,260 +148,250 @@ def main(proj_path, in_network, out_name, surveyed_dams=None, conservation_areas
     out_network = os.path.dirname(in_network) + "/" + out_name + ".shp"
     arcpy.CopyFeatures_management(in_network, out_network)
 
+    add_constraint_classes(proj_path, out_network, surveyed_dams, conservation_areas, conservation_easements)
+
+    make_layers(out_network)
+
+    write_xml(in_network, out_network)
+
+    run_tests()
+
+    return out_network
+
+
+def run_tests():
+    """
+    Makes sure that the rule tables give the classes they're meant to for a set of hand-built reaches
+    :return:
+    """
+    from Tests import test_constraints_opportunities, report_exceptions, TestException
+    test_exceptions = []
+
+    try:
+        test_constraints_opportunities()
+    except TestException as e:
+        test_exceptions.append(str(e))
+
+    report_exceptions(test_exceptions)
+
+
+def add_constraint_classes(proj_path, out_network, surveyed_dams=None, conservation_areas=None,
+                           conservation_easements=None):
+    """
+    Classifies every reach of a copy of the combined capacity network, and writes the classes to it
+    :param proj_path: The file path to the BRAT project folder
+    :param out_network: The copy of the combined capacity network to add the classes to
+    :param surveyed_dams: The dams shapefile
+    :param conservation_areas: The conservation areas shapefile
+    :param conservation_easements: The conservation easements shapefile
+    :return: A dictionary of arrays of the class codes written, keyed by field
+    """
     # check for oPBRC fields and delete if exists
     old_fields = [f.name for f in arcpy.ListFields(out_network)]
-    cons_rest_fields = ["oPBRC_UI", "oPBRC_UD", "oPBRC_CR", "DamStrat", "ObsDam", "ConsRest", "ConsEase"]
-    for f in cons_rest_fields:
-        if f in old_fields:
-            arcpy.DeleteField_management(out_network, f)
-
-    # add all new fields
-    arcpy.AddField_management(out_network, "oPBRC_UI", "TEXT", "", "", 30)
-    arcpy.AddField_management(out_network, "oPBRC_UD", "TEXT", "", "", 30)
-    arcpy.AddField_management(out_network, "oPBRC_CR", "TEXT", "", "", 40)
-    arcpy.AddField_management(out_network, "DamStrat", "TEXT", "", "", 60)
-    arcpy.AddField_management(out_network, "ObsDam", "TEXT", "", "", 10)
-    arcpy.AddField_management(out_network, "ConsArea", "TEXT", "", "", 10)
-    arcpy.AddField_management(out_network, "ConsEase", "TEXT", "", "", 10)
+    cons_rest_fields = ["oPBRC_UI", "oPBRC_UD", "oPBRC_CR", "DamStrat", "ObsDam", "ConsArea", "ConsEase"]
+    delete_fields = [f for f in cons_rest_fields if f in old_fields]
+    if len(delete_fields) > 0:
+        arcpy.DeleteField_management(out_network, delete_fields)
 
     # use old historic capacity field names if new ones not in combined capacity output
-    if 'oVC_PT' in old_fields:
-        ovc_hpe = 'oVC_PT'
-    else:
-        ovc_hpe = 'oVC_Hpe'
+    field_names = dict((field.lower(), field) for field in old_fields)
+    ovc_hpe = field_names.get('ovc_pt', field_names.get('ovc_hpe', 'oVC_HPE'))
+    occ_hpe = field_names.get('occ_pt', field_names.get('occ_hpe', 'oCC_HPE'))
+
+    fields = [ovc_hpe, occ_hpe] + INPUT_FIELDS + ['iPC_RoadX', 'iPC_Canal']
+    missing_fields = [field for field in fields if field.lower() not in field_names]
+    for field in missing_fields:
+        arcpy.AddWarning('Missing {} Field!'.format(field))
+    missing_fields = [field for field in missing_fields if field not in ['iPC_RoadX', 'iPC_Canal']]
+    if len(missing_fields) > 0:
+        raise Exception("The constraints and opportunities model needs the fields " + ", ".join(missing_fields))
+
+    # read every field the classes depend on with one scan
+    read_fields = ["ReachID", ovc_hpe, occ_hpe] + INPUT_FIELDS
+    if 'iPC_Canal' in old_fields:
+        read_fields.append('iPC_Canal')
+    columns = load_columns(out_network, read_fields)
+    columns['oVC_HPE'] = columns[ovc_hpe]
+    columns['oCC_HPE'] = columns[occ_hpe]
+    output_columns = []
 
-    if 'oCC_PT' in old_fields:
-        occ_hpe = 'oCC_PT'
-    else:
-        occ_hpe = 'oCC_HPE'
+    # add arbitrarily large value to avoid error
+    if 'iPC_Canal' not in columns:
+        columns['iPC_Canal'] = np.ones(len(columns["ReachID"])) * 500000
+        output_columns.append(('iPC_Canal', columns['iPC_Canal']))
 
-    fields = ['oPBRC_UI', 'oPBRC_UD', 'oPBRC_CR', ovc_hpe, 'oVC_EX', occ_hpe, 'oCC_EX', 'iGeo_Slope', 'mCC_HisDep',
-              'iPC_VLowLU', 'iPC_HighLU', 'oPC_Dist', 'iPC_LU', 'iHyd_SPLow', 'iHyd_SP2', 'DamStrat', 'iPC_RoadX',
-              'iPC_Canal', 'ObsDam', 'ConsArea', 'ConsEase']
+    classes = classify_constraints(columns)
 
-    for field in fields:
-        if field not in [f.name for f in arcpy.ListFields(out_network)]:
-            arcpy.AddWarning('Missing {} Field!'.format(field))
+    if conservation_areas is not None and surveyed_dams is not None:
+        obs_dam, cons_area, cons_ease = find_dam_locations(proj_path, out_network, columns["ReachID"], surveyed_dams,
+                                                           conservation_areas, conservation_easements)
+        classes['DamStrat'] = classify_dam_strategies(columns, obs_dam, cons_area, cons_ease)
+        classes.update({'ObsDam': yes_no(obs_dam), 'ConsArea': yes_no(cons_area), 'ConsEase': yes_no(cons_ease)})
 
-    # add arbitrarily large value to avoid error
-    if 'iPC_Canal' not in old_fields:
-        arcpy.AddField_management(out_network, "iPC_Canal", "DOUBLE")
-        arcpy.CalculateField_management(out_network, 'iPC_Canal', """500000""", "PYTHON")
-
-    # 'oPBRC_UI' (Areas beavers can build dams, but could be undesireable impacts)
-    # arcpy.AddMessage(fields)
-    # field_check = [f.name for f in arcpy.ListFields(out_network)]
-    # arcpy.AddMessage("--------------------")
-    # arcpy.AddMessage(field_check)
-    with arcpy.da.UpdateCursor(out_network, fields) as cursor:
-        for row in cursor:
-
-            occ_ex = row[6]
-            opc_dist = row[11]
-            ipc_lu = row[12]
-            ipc_canal = row[17]
-            
-            if occ_ex <= 0:
-                # if capacity is none risk is negligible
-                row[0] = "Negligible Risk"
-            elif ipc_canal <= 20:
-                # if canals are within 20 meters (usually means canal is on the reach)
-                row[0] = "Major Risk"
-            else:
-                # if infrastructure within 30 m or land use is high
-                # if capacity is frequent or pervasive risk is considerable
-                # if capaicty is rare or ocassional risk is some
-                if opc_dist <= 30 or ipc_lu >= 0.66:
-                    if occ_ex >= 5.0:
-                        row[0] = "Major Risk"
-                    else:
-                        row[0] = "Considerable Risk"
-                # if infrastructure within 30 to 100 m
-                # if capacity is frequent or pervasive risk is some
-                # if capacity is rare or ocassional risk is minor
-                elif opc_dist <= 100:
-                    if occ_ex >= 5.0:
-                        row[0] = "Considerable Risk"
-                    else:
-                        row[0] = "Minor Risk"
-                # if infrastructure within 100 to 300 m or land use is 0.33 to 0.66 risk is minor
-                elif opc_dist <= 300 or ipc_lu >= 0.33:
-                    row[0] = "Minor Risk"
-                else:
-                    row[0] = "Negligible Risk"
-
-            cursor.updateRow(row)
-
-    # 'oPBRC_UD' (Areas beavers can't build dams and why)
-    with arcpy.da.UpdateCursor(out_network, fields) as cursor:
-        for row in cursor:
-
-            ovc_hpe = row[3]
-            ovc_ex = row[4]
-            occ_ex = row[6]
-            slope = row[7]
-            landuse = row[12]
-            splow = row[13]
-            sp2 = row[14]
-
-            # First deal with vegetation limitations
-            # Find places historically veg limited first ('oVC_HPE' None)
-            if ovc_hpe <= 0:
-                # 'oVC_EX' Occasional, Frequent, or Pervasive (some areas have oVC_EX > oVC_HPE)
-                if ovc_ex > 0:
-                    row[1] = 'Potential Reservoir or Landuse Conversion'
-                else:    
-                    row[1] = 'Naturally Vegetation Limited'    
-            # 'iGeo_Slope' > 23%
-            elif slope > 0.23:
-                row[1] = 'Slope Limited'
-            # 'oCC_EX' None (Primary focus of this layer is the places that can't support dams now... so why?)
-            elif occ_ex <= 0:
-                if landuse > 0.3:
-                    row[1] = "Anthropogenically Limited"
-                elif splow >= 190 or sp2 >= 2400:
-                    row[1] = "Stream Power Limited"
-                else:
-                    row[1] = "Stream Size Limited"
-            else:
-                row[1] = 'Dam Building Possible'
-
-            cursor.updateRow(row)
-
-    # 'oPBRC_CR' (Conservation & Restoration Opportunties)
-    with arcpy.da.UpdateCursor(out_network, fields) as cursor:
-        for row in cursor:
-            # 'oPBRC_UI' Negligible Risk or Minor Risk
-            opbrc_ui = row[0]
-            occ_hpe = row[5]
-            occ_ex = row[6]
-            mcc_his_dep = row[8]
-            ipc_vlow_lu = row[9]
-            ipc_high_lu = row[10]
-            if opbrc_ui == 'Negligible Risk' or opbrc_ui == 'Minor Risk':
-                # 'oCC_EX' Frequent or Pervasive
-                # 'mcc_his_dep' <= 3
-                if occ_ex >= 5 and mcc_his_dep <= 3:
-                    row[2] = 'Easiest - Low-Hanging Fruit'
-                # 'oCC_EX' Occasional, Frequent, or Pervasive
-                # 'oCC_HPE' Frequent or Pervasive
-                # 'mcc_his_dep' <= 3
-                # 'ipc_vlow_lu'(i.e., Natural) > 75
-                # 'ipc_high_lu' (i.e., Developed) < 10
-                elif occ_ex > 1 and mcc_his_dep <= 3 and occ_hpe >= 5 and ipc_vlow_lu > 75 and ipc_high_lu < 10:
-                    row[2] = 'Straight Forward - Quick Return'
-                # 'oCC_EX' Rare or Occasional
-                # 'oCC_HPE' Frequent or Pervasive
-                # 'ipc_vlow_lu'(i.e., Natural) > 75
-                # 'ipc_high_lu' (i.e., Developed) < 10
-                elif occ_hpe >= 5 and occ_ex > 0 and ipc_vlow_lu > 75 and ipc_high_lu < 10:
-                    row[2] = 'Strategic - Long-Term Investment'
-                else:
-                    row[2] = 'NA'
-            else:
-                row[2] = 'NA'
-            cursor.updateRow(row)
+    # the classes are only turned into text as they're written
+    for field, values in sorted(classes.items(), key=lambda item: cons_rest_fields.index(item[0])):
+        output_columns.append((field, decode_classes(field, values)))
+    write_columns(out_network, columns["ReachID"], output_columns, dict(FIELD_TYPES, iPC_Canal='DOUBLE'))
+    return classes
 
-    if conservation_areas is not None and surveyed_dams is not None:
-        # beaver dam management strategies (derived from TNC project)
-        with arcpy.da.UpdateCursor(out_network, ["ObsDam", "ConsArea", "ConsEase"]) as cursor:
-            for row in cursor:
-                row[0] = "No"
-                row[1] = "No"
-                row[2] = "No"
-                cursor.updateRow(row)
-
-        network_lyr = arcpy.MakeFeatureLayer_management(out_network, "network_lyr")
-
-        dams = os.path.join(proj_path, 'tmp_snapped_dams.shp')
-        arcpy.CopyFeatures_management(surveyed_dams, dams)
-        arcpy.Snap_edit(dams, [[out_network, 'EDGE', '60 Meters']])
-        arcpy.SelectLayerByLocation_management(network_lyr, "INTERSECT", dams, '', "NEW_SELECTION")
-        with arcpy.da.UpdateCursor(network_lyr, ["ObsDam"]) as cursor:
-            for row in cursor:
-                row[0] = "Yes"
-                cursor.updateRow(row)
-
-        arcpy.SelectLayerByLocation_management(network_lyr, "INTERSECT", conservation_areas, '', "NEW_SELECTION")
-        with arcpy.da.UpdateCursor(network_lyr, ["ConsArea"]) as cursor:
-            for row in cursor:
-                row[0] = "Yes"
-                cursor.updateRow(row)
-
-        arcpy.SelectLayerByLocation_management(network_lyr, "INTERSECT", conservation_easements, '', "NEW_SELECTION")
-        with arcpy.da.UpdateCursor(network_lyr, ["ConsEase"]) as cursor:
-            for row in cursor:
-                row[0] = "Yes"
-                cursor.updateRow(row)
-
-        with arcpy.da.UpdateCursor(out_network, fields) as cursor:
-            for row in cursor:
-                # 'oPBRC_UI' Negligible Risk or Minor Risk
-                opbrc_ui = row[0]
-                hist_veg = row[3]
-                curr_veg = row[4]
-                curr_dams = row[6]
-                infrastructure_dist = row[11]
-                landuse = row[12]
-                obs_dams = row[18]
-                protected = row[19]
-                easement = row[20]
-
-                hist_veg_departure = hist_veg - curr_veg
-                urban = landuse > 0.66
-                ag = 0.33 < landuse <= 0.66
-                no_urban = not urban
-                no_ag = not ag
-
-                # default category is 'Other'
-                row[15] = 'Other'
-
-                if curr_dams >= 5:
-                    if no_urban:
-                        if hist_veg_departure >= 4:
-                            row[15] = "3a. Vegetation restoration first-priority"
-                        else:
-                            row[15] = "3. High restoration potential"
-
-                if curr_dams >= 20 and protected == 'Yes':
-                    row[15] = "2. Highest restoration potential - translocation"
-
-                if curr_dams >= 20 and easement == 'Yes':
-                    row[15] = "2. Highest restoration potential - translocation"
-
-                if 1 <= curr_dams < 5 and no_urban:
-                    if hist_veg_departure >= 4:
-                        row[15] = "4a. Vegetation restoration first-priority"
-                    else:
-                        row[15] = "4. Medium-low restoration potential"
-
-                if curr_dams >= 1 and infrastructure_dist <= 30:
-                    row[15] = "5. Restoration with infrastructure modification"
-
-                if curr_dams >= 1 and urban:
-                    row[15] = "6. Restoration with urban or agricultural modification"
-
-                if curr_dams >= 1 and ag:
-                    row[15] = "6. Restoration with urban or agricultural modification"
-
-                if obs_dams == 'Yes' and no_urban and no_ag:
-                    row[15] = "1. Beaver conservation"
-
-                cursor.updateRow(row)
-
-        arcpy.Delete_management(dams)
-
-    else:  # remove strategies map fields if not running this part of the model
-        arcpy.DeleteField_management(out_network, "DamStrat")
-        arcpy.DeleteField_management(out_network, "ObsDam")
-        arcpy.DeleteField_management(out_network, "ConsRest")
-        arcpy.DeleteField_management(out_network, "ConsEase")
-        
-    make_layers(out_network)
 
-    write_xml(in_network, out_network)
+def classify_constraints(columns):
+    """
+    Assigns the risk of undesirable dams, the reason dams can't be built and the conservation and restoration
+    opportunity of each reach
+    :param columns: A dictionary of arrays keyed by field name, with oVC_HPE, oVC_EX, oCC_HPE, oCC_EX, iGeo_Slope,
+        mCC_HisDep, iPC_VLowLU, iPC_HighLU, oPC_Dist, iPC_LU, iHyd_SPLow, iHyd_SP2 and iPC_Canal
+    :return: A dictionary of arrays of class codes, keyed by oPBRC_UI, oPBRC_UD and oPBRC_CR
+    """
+    classes = {}
+    for field, rules, default in CLASSIFICATIONS:
+        if field != 'DamStrat':
+            classes[field] = classify(columns, rules, default, classes)
+    return classes
 
-    return out_network
+
+def classify_dam_strategies(columns, obs_dam, cons_area, cons_ease):
+    """
+    Assigns the beaver dam management strategy of each reach
+    :param columns: A dictionary of arrays keyed by field name, with oVC_HPE, oVC_EX, oCC_EX, oPC_Dist and iPC_LU
+    :param obs_dam: A boolean array of whether a surveyed dam is on each reach
+    :param cons_area: A boolean array of whether each reach is in a conservation area
+    :param cons_ease: A boolean array of whether each reach is in a conservation easement
+    :return: An array of strategy codes
+    """
+    strategy_columns = dict(columns)
+    strategy_columns.update({'ObsDam': obs_dam, 'ConsArea': cons_area, 'ConsEase': cons_ease,
+                             'HistVegDep': columns['oVC_HPE'] - columns['oVC_EX']})
+    field, rules, default = CLASSIFICATIONS[-1]
+    return classify(strategy_columns, rules, default)
+
+
+def classify(columns, rules, default, classes=None):
+    """
+    Evaluates a rule table, giving each reach the class of the first rule it meets
+    :param columns: A dictionary of arrays keyed by field name
+    :param rules: A list of (class name, clauses) rules, in order of priority
+    :param default: The class name given to reaches that meet no rule
+    :param classes: A dictionary of class code arrays from earlier rule tables, keyed by field name
+    :return: An array of class codes, which are the class's position in class_names(rules, default)
+    """
+    if classes is None:
+        classes = {}
+    names = class_names(rules, default)
+    reach_count = len(columns['oCC_EX'])
+    codes = np.zeros(reach_count, dtype=np.uint8) + names.index(default)
+    unassigned = np.ones(reach_count, dtype=bool)
+
+    # clauses are shared between rules, so each is only evaluated once
+    clause_masks = {}
+    for class_name, clauses in rules:
+        meets_rule = unassigned.copy()
+        for clause in clauses:
+            key = (clause[0], clause[1], str(clause[2]))
+            if key not in clause_masks:
+                clause_masks[key] = evaluate_clause(columns, classes, clause)
+            meets_rule &= clause_masks[key]
+        codes[meets_rule] = names.index(class_name)
+        unassigned &= ~meets_rule
+    return codes
+
+
+def evaluate_clause(columns, classes, clause):
+    """
+    Finds which reaches meet a clause of a rule
+    :param columns: A dictionary of arrays keyed by field name
+    :param classes: A dictionary of class code arrays from earlier rule tables, keyed by field name
+    :param clause: A (field, operator, value) tuple
+    :return: A boolean array
+    """
+    field, operator, value = clause
+    if operator == 'in':
+        names = [class_names(rules, default) for name, rules, default in CLASSIFICATIONS if name == field][0]
+        in_value = np.zeros(len(names), dtype=bool)
+        in_value[[names.index(class_name) for class_name in value]] = True
+        return in_value[classes[field]]
+    if operator.startswith('not '):
+        return ~evaluate_clause(columns, classes, (field, operator[4:], value))
+    with np.errstate(invalid='ignore'):
+        return OPERATORS[operator](columns[field], value)
+
+
+def class_names(rules, default):
+    """
+    Lists the classes of a rule table, which class codes index into
+    :param rules: A list of (class name, clauses) rules
+    :param default: The class name given to reaches that meet no rule
+    :return: A list of class names, with each name once
+    """
+    names = [default]
+    for class_name, clauses in rules:
+        if class_name not in names:
+            names.append(class_name)
+    return names
+
+
+def decode_classes(field, codes):
+    """
+    Turns class codes back into their names
+    :param field: The output field the classes are for
+    :param codes: An array of class codes, or a boolean array for ObsDam, ConsArea and ConsEase
+    :return: An array of class names
+    """
+    for name, rules, default in CLASSIFICATIONS:
+        if name == field:
+            return np.array(class_names(rules, default), dtype=object)[codes]
+    return codes
+
+
+def yes_no(selected):
+    """
+    Turns a boolean array into "Yes" and "No" text
+    :param selected: A boolean array
+    :return: An array of "Yes" and "No"
+    """
+    return np.where(selected, "Yes", "No").astype(object)
+
+
+def find_dam_locations(proj_path, out_network, reach_ids, surveyed_dams, conservation_areas,
+                       conservation_easements=None):
+    """
+    Finds which reaches have a surveyed dam on them, and which are in conservation areas and easements
+    :param proj_path: The file path to the BRAT project folder
+    :param out_network: The output network
+    :param reach_ids: An array of ReachIDs
+    :param surveyed_dams: The dams shapefile
+    :param conservation_areas: The conservation areas shapefile
+    :param conservation_easements: The conservation easements shapefile
+    :return: Boolean arrays of whether each reach has an observed dam, is in a conservation area, and is in a
+        conservation easement
+    """
+    dams = os.path.join(proj_path, 'tmp_snapped_dams.shp')
+    arcpy.CopyFeatures_management(surveyed_dams, dams)
+    arcpy.Snap_edit(dams, [[out_network, 'EDGE', '60 Meters']])
+    obs_dam = find_intersecting_reaches(out_network, dams, reach_ids)
+    arcpy.Delete_management(dams)
+
+    cons_area = find_intersecting_reaches(out_network, conservation_areas, reach_ids)
+    if conservation_easements:
+        cons_ease = find_intersecting_reaches(out_network, conservation_easements, reach_ids)
+    else:
+        cons_ease = np.zeros(len(reach_ids), dtype=bool)
+    return obs_dam, cons_area, cons_ease
+
+
+def find_intersecting_reaches(in_network, features, reach_ids):
+    """
+    Finds which reaches intersect a set of features
+    :param in_network: The network to select reaches from
+    :param features: The features to intersect with the network
+    :param reach_ids: An array of ReachIDs to check
+    :return: A boolean array of whether each ReachID intersects the features
+    """
+    network_lyr = arcpy.MakeFeatureLayer_management(in_network, "intersecting_network_lyr")
+    arcpy.SelectLayerByLocation_management(network_lyr, "INTERSECT", features, '', "NEW_SELECTION")
+    selected_ids = load_columns(network_lyr, ["ReachID"])["ReachID"]
+    arcpy.Delete_management(network_lyr)
+    return np.in1d(reach_ids, selected_ids)
 
 
 def make_layers(out_network):
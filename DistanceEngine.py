@@ -0,0 +1,384 @@
+# -------------------------------------------------------------------------------
+# Name:        Distance Engine
+# Purpose:     Finds the distance from points along each reach to the nearest of a set of features, straight from
+#              the vector geometry with a KD-tree, instead of from a Euclidean distance raster
+#
+# Created:     10/2026
+# -------------------------------------------------------------------------------
+
+import arcpy
+import numpy as np
+from scipy.spatial import cKDTree
+import ZonalEngine
+reload(ZonalEngine)
+
+# how far apart, in meters, points are put along each reach, and along the edges of the features. This is the cell
+# size of the Euclidean distance rasters this replaces
+SAMPLE_SPACING = 5.0
+
+# how many of the nearest points along the features' edges are checked for the nearest edge to each reach point
+NEAREST_POINTS = 8
+
+# about how many (point, edge) pairs are checked at a time when finding which points are inside polygons
+BLOCK_PAIRS = 4 * 1024 * 1024
+
+# about how many points along the reaches are sampled and found the distance of at a time. Each point needs about ten
+# NEAREST_POINTS long arrays while its distance is found
+BLOCK_POINTS = 65536
+
+# the statistics that can be found of the distances along each reach
+DISTANCE_STATS = ["MINIMUM", "MAXIMUM", "MEAN"]
+
+
+class FeatureEdges(object):
+    """
+    The straight edges of a set of features, with a KD-tree of points spaced along them to find the edges near a point
+    quickly. Points are edges with no length
+    """
+    def __init__(self, x1, y1, x2, y2, feature_ids, polygons, spacing):
+        """
+        :param x1: An array of the x coordinate of the start of each edge
+        :param y1: An array of the y coordinate of the start of each edge
+        :param x2: An array of the x coordinate of the end of each edge
+        :param y2: An array of the y coordinate of the end of each edge
+        :param feature_ids: An array of the index of the feature each edge belongs to
+        :param polygons: If true, the edges are the rings of polygons, and points inside them are 0 away
+        :param spacing: How far apart to put points along the edges, in map units
+        """
+        self.x1 = np.asarray(x1, dtype=np.float64)
+        self.y1 = np.asarray(y1, dtype=np.float64)
+        self.x2 = np.asarray(x2, dtype=np.float64)
+        self.y2 = np.asarray(y2, dtype=np.float64)
+        self.feature_ids = np.asarray(feature_ids, dtype=np.int64)
+        self.polygons = polygons
+
+        # put points along each edge no more than the spacing apart, including both of its ends
+        lengths = np.hypot(self.x2 - self.x1, self.y2 - self.y1)
+        steps = np.maximum(np.ceil(lengths / spacing), 1).astype(np.int64)
+        self.point_edges = np.repeat(np.arange(len(lengths)), steps + 1)
+        first_points = np.cumsum(steps + 1) - (steps + 1)
+        fractions = (np.arange(len(self.point_edges)) - np.repeat(first_points, steps + 1)) / \
+            np.repeat(steps, steps + 1).astype(np.float64)
+        points_x = self.x1[self.point_edges] + fractions * (self.x2 - self.x1)[self.point_edges]
+        points_y = self.y1[self.point_edges] + fractions * (self.y2 - self.y1)[self.point_edges]
+        self.tree = cKDTree(np.column_stack((points_x, points_y)))
+
+    def __len__(self):
+        return len(self.x1)
+
+    def distances(self, x, y, block_points=BLOCK_POINTS):
+        """
+        Finds the distance from each point to the nearest edge, or 0 if it is inside a polygon. Points are taken a
+        block at a time, so the arrays made for each are at most a block long
+        :param x: An array of x coordinates
+        :param y: An array of y coordinates
+        :param block_points: How many points are found the distance of at a time
+        :return: An array of distances, in map units
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        distances = np.zeros(len(x), dtype=np.float64)
+        neighbors = min(NEAREST_POINTS, self.tree.n)
+        for start in range(0, len(x), block_points):
+            block_x = x[start:start + block_points]
+            block_y = y[start:start + block_points]
+            nearest = self.tree.query(np.column_stack((block_x, block_y)), k=neighbors)[1]
+            edges = self.point_edges[nearest.reshape(len(block_x), neighbors)]
+            # the nearest edge is nearly always one of the edges of the nearest points, and checking each of them
+            # exactly is never further than the nearest point
+            block_distances = segment_distances(block_x[:, None], block_y[:, None], self.x1[edges], self.y1[edges],
+                                                self.x2[edges], self.y2[edges]).min(axis=1)
+            if self.polygons:
+                block_distances[self.inside(block_x, block_y)] = 0.0
+            distances[start:start + block_points] = block_distances
+        return distances
+
+    def inside(self, x, y):
+        """
+        Finds which points are inside any of the polygons. A line is run from each point in the +x direction, and a
+        point is inside a polygon if it crosses that polygon's edges an odd number of times, so holes are left out.
+        The edges are sorted into bands of y, so each point is only checked against the edges in its band
+        :param x: An array of x coordinates
+        :param y: An array of y coordinates
+        :return: A boolean array, true for the points inside a polygon
+        """
+        inside = np.zeros(len(x), dtype=bool)
+        crossing = self.y1 != self.y2
+        if not crossing.any():
+            return inside
+        x1, y1, x2, y2 = self.x1[crossing], self.y1[crossing], self.x2[crossing], self.y2[crossing]
+        feature_ids = self.feature_ids[crossing]
+        feature_count = self.feature_ids.max() + 1
+        # a line from a point left of a polygon crosses it an even number of times, so those edges can be skipped
+        feature_x_min = np.inf * np.ones(feature_count)
+        np.minimum.at(feature_x_min, self.feature_ids, np.minimum(self.x1, self.x2))
+
+        y_min = min(y1.min(), y2.min())
+        y_max = max(y1.max(), y2.max())
+        band_count = int(max(1, min(np.sqrt(len(x1)), 4096)))
+        band_height = (y_max - y_min) / band_count
+        if band_height <= 0:
+            return inside
+
+        def band_of(values):
+            return np.clip(((values - y_min) / band_height).astype(np.int64), 0, band_count - 1)
+
+        first_bands = band_of(np.minimum(y1, y2))
+        last_bands = band_of(np.maximum(y1, y2))
+        band_spans = last_bands - first_bands + 1
+        band_edges = np.repeat(np.arange(len(x1)), band_spans)
+        edge_bands = np.repeat(first_bands, band_spans) + np.arange(len(band_edges)) - \
+            np.repeat(np.cumsum(band_spans) - band_spans, band_spans)
+        order = np.argsort(edge_bands, kind='mergesort')
+        band_edges = band_edges[order]
+        band_starts = np.searchsorted(edge_bands[order], np.arange(band_count + 1))
+
+        candidates = np.where((y >= y_min) & (y <= y_max))[0]
+        point_bands = band_of(y[candidates])
+        order = np.argsort(point_bands, kind='mergesort')
+        candidates = candidates[order]
+        point_starts = np.searchsorted(point_bands[order], np.arange(band_count + 1))
+
+        for band in range(band_count):
+            points = candidates[point_starts[band]:point_starts[band + 1]]
+            edges = band_edges[band_starts[band]:band_starts[band + 1]]
+            if len(points) == 0 or len(edges) == 0:
+                continue
+            chunk = max(1, BLOCK_PAIRS // len(edges))
+            for start in range(0, len(points), chunk):
+                chunk_points = points[start:start + chunk]
+                px = x[chunk_points][:, None]
+                py = y[chunk_points][:, None]
+                ex1, ey1, ex2, ey2 = x1[edges], y1[edges], x2[edges], y2[edges]
+                # an edge is crossed if it spans the point's y (counting its lower end but not its upper end) and
+                # crosses that y right of the point
+                spans = (ey1 > py) != (ey2 > py)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    crossing_x = ex1 + (py - ey1) * (ex2 - ex1) / (ey2 - ey1)
+                crosses = spans & (crossing_x > px) & (feature_x_min[feature_ids[edges]] <= px)
+                point_index, edge_index = np.nonzero(crosses)
+                if len(point_index) == 0:
+                    continue
+                # count the crossings of each (point, feature) pair
+                pairs = point_index.astype(np.int64) * feature_count + feature_ids[edges][edge_index]
+                pairs, counts = np.unique(pairs, return_counts=True)
+                odd = pairs[counts % 2 == 1] // feature_count
+                inside[chunk_points[odd]] = True
+        return inside
+
+
+def segment_distances(x, y, x1, y1, x2, y2):
+    """
+    Finds the distance from points to line segments, broadcasting the arrays against each other
+    :param x: The x coordinates of the points
+    :param y: The y coordinates of the points
+    :param x1: The x coordinates of the start of each segment
+    :param y1: The y coordinates of the start of each segment
+    :param x2: The x coordinates of the end of each segment
+    :param y2: The y coordinates of the end of each segment
+    :return: An array of distances
+    """
+    dx = x2 - x1
+    dy = y2 - y1
+    squared_length = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = ((x - x1) * dx + (y - y1) * dy) / squared_length
+    # segments with no length are points
+    fraction = np.clip(np.where(squared_length > 0, fraction, 0.0), 0.0, 1.0)
+    return np.hypot(x - (x1 + fraction * dx), y - (y1 + fraction * dy))
+
+
+def meters_per_unit(feature_class):
+    """
+    Finds how many meters are in a map unit of a feature class
+    :param feature_class: The feature class
+    :return: The number of meters in one map unit, or 1 if it isn't known
+    """
+    spatial_reference = arcpy.Describe(feature_class).spatialReference
+    return getattr(spatial_reference, 'metersPerUnit', None) or 1.0
+
+
+def read_feature_edges(feature_class, spacing_meters=SAMPLE_SPACING):
+    """
+    Reads the edges of every point, line or polygon in a feature class
+    :param feature_class: The feature class of the features to find the distance to
+    :param spacing_meters: How far apart to put points along the edges to search for the nearest edge
+    :return: A FeatureEdges, or None if there are no features
+    """
+    shape_type = arcpy.Describe(feature_class).shapeType
+    spacing = spacing_meters / meters_per_unit(feature_class)
+    edges = []
+    feature_ids = []
+    with arcpy.da.SearchCursor(feature_class, ['SHAPE@']) as cursor:
+        for feature_id, (shape,) in enumerate(cursor):
+            if shape is None:
+                continue
+            if shape_type in ("Point", "Multipoint"):
+                points = [shape.firstPoint] if shape_type == "Point" else list(shape)
+                for point in points:
+                    if point is not None:
+                        edges.append(np.array([[point.X, point.Y, point.X, point.Y]]))
+                        feature_ids.append(np.array([feature_id]))
+                continue
+            if getattr(shape, 'hasCurves', False):
+                shape = shape.densify("DISTANCE", spacing)
+            for part in shape:
+                path = []
+                # the rings of a polygon part are separated by None
+                for point in list(part) + [None]:
+                    if point is not None:
+                        path.append((point.X, point.Y))
+                        continue
+                    if len(path) == 1:
+                        path.append(path[0])
+                    if len(path) > 1:
+                        path = np.array(path, dtype=np.float64)
+                        edges.append(np.column_stack((path[:-1], path[1:])))
+                        feature_ids.append(np.repeat(feature_id, len(path) - 1))
+                    path = []
+    if len(edges) == 0:
+        return None
+    edges = np.concatenate(edges)
+    return FeatureEdges(edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3], np.concatenate(feature_ids),
+                        shape_type == "Polygon", spacing)
+
+
+def sample_reach_blocks(in_network, spacing_meters=SAMPLE_SPACING, block_points=BLOCK_POINTS):
+    """
+    Puts points evenly along each reach, no more than a spacing apart, including both ends of each part. The points
+    are given a block of reaches at a time, with about a block of points in each, and a reach is never split between
+    blocks
+    :param in_network: A polyline feature class with a ReachID field
+    :param spacing_meters: The largest distance between points along a reach
+    :param block_points: About how many points to put in each block
+    :return: A generator of blocks, each an array of ReachIDs, an array of the index of the reach of each point in
+        that array, and arrays of the x and y coordinates of the points. Every reach is in a block, even if it has no
+        points
+    """
+    spacing = spacing_meters / meters_per_unit(in_network)
+    reach_ids = []
+    point_reaches = []
+    points = []
+    point_count = 0
+    with arcpy.da.SearchCursor(in_network, ['ReachID', 'SHAPE@']) as cursor:
+        for reach_id, shape in cursor:
+            reach_index = len(reach_ids)
+            reach_ids.append(reach_id)
+            if shape is not None:
+                if getattr(shape, 'hasCurves', False):
+                    shape = shape.densify("DISTANCE", spacing)
+                for part in shape:
+                    vertices = np.array([(point.X, point.Y) for point in part if point is not None],
+                                        dtype=np.float64)
+                    if len(vertices) == 0:
+                        continue
+                    along = np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(vertices, axis=0).T))))
+                    distances = np.linspace(0.0, along[-1], int(np.ceil(along[-1] / spacing)) + 1)
+                    points.append(np.column_stack((np.interp(distances, along, vertices[:, 0]),
+                                                   np.interp(distances, along, vertices[:, 1]))))
+                    point_reaches.append(np.repeat(reach_index, len(distances)))
+                    point_count += len(distances)
+            if point_count >= block_points:
+                yield sample_block(reach_ids, point_reaches, points)
+                reach_ids, point_reaches, points, point_count = [], [], [], 0
+    if len(reach_ids) > 0:
+        yield sample_block(reach_ids, point_reaches, points)
+
+
+def sample_block(reach_ids, point_reaches, points):
+    """
+    Joins the points of a block of reaches into arrays
+    :param reach_ids: A list of the ReachIDs of the block
+    :param point_reaches: A list of arrays of the index of the reach of each point
+    :param points: A list of arrays of (x, y) points
+    :return: An array of ReachIDs, an array of the index of the reach of each point, and arrays of the x and y
+        coordinates of the points
+    """
+    reach_ids = np.array(reach_ids, dtype=np.int64)
+    if len(points) == 0:
+        return reach_ids, np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    points = np.concatenate(points)
+    return reach_ids, np.concatenate(point_reaches), points[:, 0], points[:, 1]
+
+
+def reduce_by_reach(values, point_reaches, reach_count, stat_types):
+    """
+    Finds statistics of point values for each reach
+    :param values: An array of a value at each point
+    :param point_reaches: An array of the index of the reach of each point
+    :param reach_count: The number of reaches
+    :param stat_types: A list of DISTANCE_STATS to find
+    :return: A dictionary of arrays keyed by the stat types. Reaches with no points are NaN
+    """
+    counts = np.bincount(point_reaches, minlength=reach_count)
+    has_points = counts > 0
+    stats = {}
+    for stat_type in stat_types:
+        result = np.nan * np.ones(reach_count)
+        if stat_type == "MEAN":
+            sums = np.bincount(point_reaches, weights=values, minlength=reach_count)
+            result[has_points] = sums[has_points] / counts[has_points]
+        elif stat_type in ("MINIMUM", "MAXIMUM"):
+            order = np.lexsort((values, point_reaches))
+            starts = np.searchsorted(point_reaches[order], np.arange(reach_count))
+            ends = np.searchsorted(point_reaches[order], np.arange(reach_count), side='right')
+            picks = starts if stat_type == "MINIMUM" else ends - 1
+            result[has_points] = values[order][picks[has_points]]
+        else:
+            raise Exception("The distance statistic " + str(stat_type) + " is not one of " +
+                            ", ".join(DISTANCE_STATS))
+        stats[stat_type] = result
+    return stats
+
+
+def reach_distances(in_network, feature_class, stat_types, spacing_meters=SAMPLE_SPACING):
+    """
+    Finds statistics of the distance from points along each reach to the nearest feature
+    :param in_network: A polyline feature class with a ReachID field
+    :param feature_class: The point, line or polygon features to find the distance to
+    :param stat_types: A list of DISTANCE_STATS to find
+    :param spacing_meters: How far apart to put points along the reaches and the features' edges
+    :return: An array of ReachIDs, and a dictionary of arrays of the distances in map units, keyed by the stat types,
+        or None if there are no features
+    """
+    edges = read_feature_edges(feature_class, spacing_meters)
+    if edges is None:
+        with arcpy.da.SearchCursor(in_network, ['ReachID']) as cursor:
+            return np.array([row[0] for row in cursor], dtype=np.int64), None
+
+    # the points along the reaches are sampled and found the distance of a block at a time, so only one block's
+    # points are held at once
+    reach_id_blocks = []
+    stat_blocks = dict((stat_type, []) for stat_type in stat_types)
+    for reach_ids, point_reaches, x, y in sample_reach_blocks(in_network, spacing_meters):
+        reach_id_blocks.append(reach_ids)
+        stats = reduce_by_reach(edges.distances(x, y), point_reaches, len(reach_ids), stat_types)
+        for stat_type in stat_types:
+            stat_blocks[stat_type].append(stats[stat_type])
+    if len(reach_id_blocks) == 0:
+        return np.zeros(0, dtype=np.int64), dict((stat_type, np.zeros(0)) for stat_type in stat_types)
+    return np.concatenate(reach_id_blocks), dict((stat_type, np.concatenate(stat_blocks[stat_type]))
+                                                 for stat_type in stat_types)
+
+
+def raster_reach_distances(feature_class, buffer, stat_types, index_folder, cell_size=SAMPLE_SPACING, cache=None):
+    """
+    Finds statistics of a Euclidean distance raster of the features in each reach's buffer, the way BRAT found the
+    iPC distances before this engine. It's kept to check this engine against
+    :param feature_class: The features to find the distance to
+    :param buffer: A polygon feature class of buffers with a ReachID field
+    :param stat_types: A list of ZonalEngine.ZONAL_STATS to find
+    :param index_folder: The folder to keep the zonal indexes of the buffers in
+    :param cell_size: The cell size of the distance raster
+    :param cache: An optional ProjectCache to keep the distance raster in
+    :return: An array of ReachIDs, and a dictionary of arrays keyed by the stat types
+    """
+    from arcpy.sa import EucDistance
+    if cache is None:
+        distance_raster = EucDistance(feature_class, cell_size=cell_size)
+    else:
+        # the distance raster covers the current extent, so it's part of the key
+        distance_raster = cache.fetch("EucDistance", [feature_class],
+                                      {"cell_size": cell_size, "extent": arcpy.env.extent},
+                                      lambda out_path: EucDistance(feature_class, cell_size=cell_size).save(out_path))
+    return ZonalEngine.zonal_statistics(buffer, distance_raster, stat_types, index_folder)
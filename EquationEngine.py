@@ -0,0 +1,245 @@
+# -------------------------------------------------------------------------------
+# Name:        Equation Engine
+# Purpose:     Compiles user given streamflow equations once, checks that they only use arithmetic, a few NumPy
+#              functions and known variables, and evaluates them on arrays in chunks
+#
+# Created:     10/2026
+# -------------------------------------------------------------------------------
+
+import ast
+import math
+import numbers
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 65536
+
+# the functions an equation can call, by the name it calls them with
+ALLOWED_FUNCTIONS = {
+    'log': np.log,
+    'log10': np.log10,
+    'exp': np.exp,
+    'sqrt': np.sqrt,
+    'abs': np.abs,
+    'minimum': np.minimum,
+    'maximum': np.maximum
+}
+
+ALLOWED_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+
+# the most bits a whole number raised to a whole number power can have. Python works these out exactly, so something
+# like 9**9**9 would take forever, and anything larger than a float can hold is of no use in a streamflow equation
+MAX_INTEGER_POWER_BITS = 1024
+
+# compiled equations are kept for the life of the process, so a batch run over many basins parses each equation once
+_compiled_equations = {}
+
+
+class CompiledEquation(object):
+    """
+    An equation that has been parsed, checked and compiled, and can be evaluated on arrays
+    """
+    def __init__(self, text, variable_names):
+        """
+        :param text: The equation, written as a Python expression, such as "14.7 * (DAsqm ** 0.815)"
+        :param variable_names: The names of the variables the equation is allowed to use
+        """
+        self.text = text.strip()
+        try:
+            tree = ast.parse(self.text, mode='eval')
+        except SyntaxError:
+            raise Exception("The equation \"" + self.text + "\" could not be read")
+
+        self.variables = sorted(check_equation_tree(tree, self.text, variable_names))
+        tree = ast.fix_missing_locations(ConstantFolder(self.text).visit(tree))
+        self.code = compile(tree, '<equation>', 'eval')
+
+    def evaluate(self, variables, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Evaluates the equation a chunk of rows at a time, so that each intermediate array is at most one chunk long
+        :param variables: A dictionary of the values to use for each variable, keyed by name. Values can be arrays
+            of the same length, or single numbers
+        :param chunk_size: How many rows are evaluated at a time
+        :return: An array of the equation's value for each row, or a single value if no variable is an array
+        """
+        missing_variables = [name for name in self.variables if name not in variables]
+        if len(missing_variables) > 0:
+            raise Exception("The equation \"" + self.text + "\" uses " + ", ".join(missing_variables) +
+                            ", which were not given")
+
+        namespace = dict(ALLOWED_FUNCTIONS)
+        array_variables = {}
+        for name in self.variables:
+            if np.ndim(variables[name]) > 0:
+                array_variables[name] = np.asarray(variables[name])
+            else:
+                namespace[name] = variables[name]
+
+        if len(array_variables) == 0:
+            return self._evaluate_chunk(namespace)
+
+        lengths = set(len(values) for values in array_variables.values())
+        if len(lengths) > 1:
+            raise Exception("The variables of the equation \"" + self.text + "\" are not all the same length")
+        length = lengths.pop()
+
+        out = None
+        for start in range(0, max(length, 1), chunk_size):
+            stop = min(start + chunk_size, length)
+            for name, values in array_variables.items():
+                namespace[name] = values[start:stop]
+            chunk = self._evaluate_chunk(namespace)
+            if out is None:
+                out = np.empty(length, dtype=np.result_type(chunk))
+            out[start:stop] = chunk
+        return out
+
+    def _evaluate_chunk(self, namespace):
+        """
+        Runs the compiled equation with nothing but the allowed functions and the given variables in scope
+        :param namespace: A dictionary of the functions and variable values to use
+        :return: The value of the equation
+        """
+        with np.errstate(all='ignore'):
+            return eval(self.code, {'__builtins__': {}}, namespace)
+
+
+class ConstantFolder(ast.NodeTransformer):
+    """
+    Replaces parts of an equation that only use numbers, such as (10 ** -7.2182), with their value, so that they
+    are calculated once rather than once per chunk
+    """
+    def __init__(self, text):
+        """
+        :param text: The equation, for error messages
+        """
+        super(ConstantFolder, self).__init__()
+        self.text = text
+
+    def generic_visit(self, node):
+        node = super(ConstantFolder, self).generic_visit(node)
+        if not isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Call)):
+            return node
+        operands = _operands(node)
+        if len(operands) == 0 or any(_number_value(operand) is None for operand in operands):
+            return node
+
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+            # a whole number power is worked out exactly, whether it's folded here or left for each chunk, so a huge
+            # one is refused rather than left to hang the tool
+            base, exponent = _number_value(node.left), _number_value(node.right)
+            if isinstance(base, numbers.Integral) and isinstance(exponent, numbers.Integral) and abs(base) > 1 and \
+                    exponent * math.log(abs(base), 2) > MAX_INTEGER_POWER_BITS:
+                raise Exception("The equation \"" + self.text + "\" raises " + str(base) + " to the power of " +
+                                str(exponent) + ", which is too large to calculate")
+
+        # anything that can't be calculated is left alone, so that the error comes up when the equation is used
+        try:
+            value = eval(compile(ast.fix_missing_locations(ast.Expression(node)), '<equation>', 'eval'),
+                         {'__builtins__': {}}, dict(ALLOWED_FUNCTIONS))
+        except (ArithmeticError, ValueError, TypeError):
+            return node
+        if isinstance(value, numbers.Real) and not isinstance(value, bool):
+            return ast.copy_location(_number_node(float(value) if isinstance(value, np.floating) else value), node)
+        return node
+
+
+def compile_equation(text, variable_names):
+    """
+    Compiles an equation, or returns the already compiled version of it
+    :param text: The equation, written as a Python expression
+    :param variable_names: The names of the variables the equation is allowed to use
+    :return: A CompiledEquation
+    """
+    key = (text.strip(), tuple(sorted(variable_names)))
+    if key not in _compiled_equations:
+        _compiled_equations[key] = CompiledEquation(text, variable_names)
+    return _compiled_equations[key]
+
+
+def evaluate_equation(text, variables, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Evaluates an equation, using only the given variables
+    :param text: The equation, written as a Python expression, such as "14.7 * (DAsqm ** 0.815)"
+    :param variables: A dictionary of the values to use for each variable, keyed by name
+    :param chunk_size: How many rows are evaluated at a time
+    :return: An array of the equation's value for each row
+    """
+    return compile_equation(text, variables.keys()).evaluate(variables, chunk_size)
+
+
+def check_equation_tree(tree, text, variable_names):
+    """
+    Makes sure an equation only uses numbers, arithmetic operators, the allowed functions and the given variables
+    :param tree: The parsed equation
+    :param text: The equation, for error messages
+    :param variable_names: The names of the variables the equation is allowed to use
+    :return: The set of variable names the equation uses
+    """
+    used_variables = set()
+    function_nodes = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in ALLOWED_FUNCTIONS:
+                raise Exception("The equation \"" + text + "\" calls a function that is not allowed. Allowed " +
+                                "functions are " + ", ".join(sorted(ALLOWED_FUNCTIONS)))
+            if node.keywords or getattr(node, 'starargs', None) or getattr(node, 'kwargs', None):
+                raise Exception("The equation \"" + text + "\" passes keyword arguments to " + node.func.id)
+            function_nodes.add(node.func)
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node in function_nodes:
+                continue
+            if node.id not in variable_names:
+                raise Exception("The equation \"" + text + "\" uses \"" + node.id + "\", which is not a known " +
+                                "variable. Known variables are " + ", ".join(sorted(variable_names)))
+            used_variables.add(node.id)
+        elif isinstance(node, ALLOWED_OPERATORS) or _number_value(node) is not None:
+            continue
+        elif not isinstance(node, (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Load)):
+            raise Exception("The equation \"" + text + "\" uses " + type(node).__name__ + ", which is not " +
+                            "allowed. Equations can only use numbers, + - * / **, parentheses, the functions " +
+                            ", ".join(sorted(ALLOWED_FUNCTIONS)) + " and the variables " +
+                            ", ".join(sorted(variable_names)))
+    return used_variables
+
+
+def _operands(node):
+    """
+    Lists the nodes an operator or function call works on
+    :param node: A BinOp, UnaryOp or Call node
+    :return: A list of nodes
+    """
+    if isinstance(node, ast.BinOp):
+        return [node.left, node.right]
+    elif isinstance(node, ast.UnaryOp):
+        return [node.operand]
+    return node.args
+
+
+def _number_value(node):
+    """
+    Gets the number a node holds
+    :param node: An AST node
+    :return: The number, or None if the node isn't a number
+    """
+    if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+        value = node.value
+    elif not hasattr(ast, 'Constant') and isinstance(node, ast.Num):
+        value = node.n
+    else:
+        return None
+    if isinstance(value, numbers.Real) and not isinstance(value, bool):
+        return value
+    return None
+
+
+def _number_node(value):
+    """
+    Makes an AST node holding a number
+    :param value: The number
+    :return: An AST node
+    """
+    if hasattr(ast, 'Constant'):
+        return ast.Constant(value)
+    return ast.Num(value)
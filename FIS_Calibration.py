@@ -0,0 +1,275 @@
+# -------------------------------------------------------------------------------
+# Name:        FIS Calibration
+# Purpose:     Tunes the output membership function breakpoints of the combined FIS so that modeled capacity agrees
+#              with surveyed dam densities, and saves them as a profile Comb_FIS can load
+#
+# Created:     10/2026
+# -------------------------------------------------------------------------------
+
+import arcpy
+import csv
+import hashlib
+import multiprocessing
+import numpy as np
+import os
+from SupportingFunctions import load_columns, make_folder
+from FuzzyEngine import breakpoint_ranges, use_python_executable
+import Comb_FIS
+import Capacity_Validation
+reload(Comb_FIS)
+reload(Capacity_Validation)
+
+INPUTS_FILE = "Calibration_Inputs.npz"
+REPORT_FILE = "Calibration_Electivity.csv"
+
+# added to both densities before comparing them, in dams/km, so that categories with no dams can still be compared
+DENSITY_OFFSET = 0.1
+
+
+def main(in_network, out_folder, max_da_thresh, profile_name="Calibrated_Comb_FIS", spread=0.5, population=48,
+         generations=20, occupancy=1.0, workers=1, seed=None):
+    """
+    Searches for the output breakpoints of the combined FIS that make the modeled existing dam density of each
+    capacity category closest to the surveyed dam density, and saves them as a profile
+    :param in_network: The output of the capacity validation tool, with e_DamCt and the combined FIS inputs
+    :param out_folder: The folder to save the profile, the cached inputs and the electivity report in
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+    :param profile_name: The name of the profile file to make
+    :param spread: How far each breakpoint can move, as a fraction of its value
+    :param population: How many breakpoint sets are tried in each generation
+    :param generations: How many generations to run
+    :param occupancy: The share of modeled capacity the surveyed dams are expected to fill
+    :param workers: How many processes to evaluate breakpoint sets in
+    :param seed: The random seed
+    :return: The path to the profile
+    """
+    profile_name = profile_name if profile_name else "Calibrated_Comb_FIS"
+    spread = float(spread) if spread else 0.5
+    population = int(population) if population else 48
+    generations = int(generations) if generations else 20
+    occupancy = float(occupancy) if occupancy else 1.0
+    workers = int(workers) if workers else 1
+    seed = int(seed) if seed not in [None, "", "None"] else None
+    make_folder(os.path.dirname(out_folder), os.path.basename(out_folder))
+
+    inputs_path = cache_inputs(in_network, out_folder)
+    output = Comb_FIS.build_comb_fis().output
+    parameters = breakpoint_ranges(output, spread)
+    default_values = np.array([point for point, low, high in parameters])
+
+    evaluator = CandidateEvaluator(inputs_path, parameters, float(max_da_thresh), occupancy, workers)
+    try:
+        best_values, best_error = search(evaluator, parameters, population, generations,
+                                         np.random.RandomState(seed))
+        default_error = evaluator.evaluate(default_values.reshape(1, -1))[0]
+    finally:
+        evaluator.close()
+    arcpy.AddMessage("Calibration error went from " + str(round(default_error, 4)) + " with the default " +
+                     "breakpoints to " + str(round(best_error, 4)))
+
+    changes = dict(((output.name, point), float(value)) for (point, low, high), value in zip(parameters, best_values))
+    profile_path = os.path.join(out_folder, profile_name + ".json")
+    Comb_FIS.save_profile(profile_path, Comb_FIS.build_comb_fis().with_breakpoints(changes),
+                          "Output breakpoints calibrated against the surveyed dams on " + in_network,
+                          {"calibration_error": best_error, "default_error": default_error, "occupancy": occupancy,
+                           "max_da_thresh": float(max_da_thresh)})
+    write_report(os.path.join(out_folder, REPORT_FILE), inputs_path, float(max_da_thresh), changes)
+    arcpy.AddMessage("Saved the calibrated profile to " + profile_path)
+    return profile_path
+
+
+def cache_inputs(in_network, out_folder):
+    """
+    Runs the combined FIS rules on the network once and saves the activation of each output term. The output
+    breakpoints don't change which rules fire, so every breakpoint set can be defuzzified from the same activations.
+    The saved inputs are reused as long as the values read from the network are the same, so a network that has been
+    edited, including one in a geodatabase, is always run again
+    :param in_network: The network with e_DamCt and the combined FIS inputs
+    :param out_folder: The folder to save the inputs in
+    :return: The path to the saved inputs
+    """
+    inputs_path = os.path.join(out_folder, INPUTS_FILE)
+    fields = ["ReachID", "oVC_EX", "iHyd_SP2", "iHyd_SPLow", "iGeo_Slope", "iGeo_DA", "iGeo_Len", "e_DamCt"]
+    columns = load_columns(in_network, fields)
+    source = columns_hash(columns, fields)
+    if os.path.exists(inputs_path) and str(np.load(inputs_path)['source']) == source:
+        arcpy.AddMessage("Using the cached FIS inputs in " + inputs_path)
+        return inputs_path
+
+    arcpy.AddMessage("Running the combined FIS rules on " + in_network + "...")
+    activation = Comb_FIS.run_comb_fis(columns["oVC_EX"], columns["iHyd_SP2"], columns["iHyd_SPLow"],
+                                       columns["iGeo_Slope"], Comb_FIS.build_comb_fis().fire_rules)
+    np.savez(inputs_path, activation=activation, oVC_EX=columns["oVC_EX"], iGeo_DA=columns["iGeo_DA"],
+             iGeo_Len=columns["iGeo_Len"], e_DamCt=columns["e_DamCt"], source=np.array(source))
+    return inputs_path
+
+
+def columns_hash(columns, fields):
+    """
+    Finds a hash of the values in a set of columns, so that saved results can be matched to the inputs they came from
+    :param columns: A dictionary of arrays, keyed by field
+    :param fields: The fields to hash, in order
+    :return: The hex digest of the columns
+    """
+    md5 = hashlib.md5()
+    for field in fields:
+        values = np.ascontiguousarray(columns[field])
+        md5.update((field + " " + str(values.dtype) + " " + str(len(values))).encode('utf-8'))
+        md5.update(values)
+    return md5.hexdigest()
+
+
+def search(evaluator, parameters, population, generations, random_state):
+    """
+    Searches for the best breakpoints with the cross-entropy method: each generation is drawn around the best
+    quarter of the one before it, and every generation is evaluated as one batch
+    :param evaluator: A CandidateEvaluator
+    :param parameters: A list of (breakpoint, low, high) tuples
+    :param population: How many breakpoint sets are tried in each generation
+    :param generations: How many generations to run
+    :param random_state: The numpy RandomState to draw from
+    :return: A tuple of (best breakpoint values, their calibration error)
+    """
+    lows = np.array([low for point, low, high in parameters])
+    highs = np.array([high for point, low, high in parameters])
+    elite_count = max(2, population // 4)
+
+    # the first generation covers the whole range, and includes the default breakpoints
+    candidates = lows + random_state.rand(population, len(parameters)) * (highs - lows)
+    candidates[0] = [point for point, low, high in parameters]
+
+    best_values = None
+    best_error = np.inf
+    for generation in range(generations):
+        errors = evaluator.evaluate(candidates)
+        order = np.argsort(errors)
+        if errors[order[0]] < best_error:
+            best_values = candidates[order[0]].copy()
+            best_error = float(errors[order[0]])
+        arcpy.AddMessage("Generation " + str(generation + 1) + " of " + str(generations) + ": best calibration " +
+                         "error " + str(round(best_error, 4)))
+
+        elite = candidates[order[:elite_count]]
+        mean = elite.mean(axis=0)
+        deviation = np.maximum(elite.std(axis=0), (highs - lows) * 0.01)
+        candidates = np.clip(mean + deviation * random_state.normal(size=(population, len(parameters))), lows, highs)
+        candidates[0] = best_values
+
+    return best_values, best_error
+
+
+class CandidateEvaluator(object):
+    """
+    Evaluates batches of output breakpoint sets, split across a process pool that loads the cached inputs once
+    """
+
+    def __init__(self, inputs_path, parameters, max_da_thresh, occupancy, workers=1):
+        """
+        :param inputs_path: The path to the inputs saved by cache_inputs()
+        :param parameters: A list of (breakpoint, low, high) tuples
+        :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+        :param occupancy: The share of modeled capacity the surveyed dams are expected to fill
+        :param workers: How many processes to use. 1 evaluates in this process
+        """
+        self.workers = workers
+        worker_args = (inputs_path, parameters, max_da_thresh, occupancy)
+        if workers > 1:
+            use_python_executable()
+            self.pool = multiprocessing.Pool(workers, _init_worker, worker_args)
+        else:
+            self.pool = None
+            _init_worker(*worker_args)
+
+    def evaluate(self, candidates):
+        """
+        Finds the calibration error of each breakpoint set
+        :param candidates: An array with one row per breakpoint set
+        :return: An array of calibration errors
+        """
+        if self.pool is None:
+            return _evaluate_batch(candidates)
+        batches = np.array_split(candidates, min(self.workers, len(candidates)))
+        return np.concatenate(self.pool.map(_evaluate_batch, batches))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+def calibration_error(length, surveyed_dams, dam_count, occ, occupancy):
+    """
+    Compares the modeled and surveyed dam density of each capacity category, weighted by the share of the network
+    in the category
+    :param length: An array of reach lengths, in meters
+    :param surveyed_dams: An array of the number of surveyed dams on each reach
+    :param dam_count: An array of modeled existing dam counts, with one row per breakpoint set
+    :param occ: An array of modeled existing dam capacity, with one row per breakpoint set
+    :param occupancy: The share of modeled capacity the surveyed dams are expected to fill
+    :return: An array of errors, one per breakpoint set
+    """
+    table = Capacity_Validation.electivity_by_category(length, surveyed_dams, dam_count, occ)
+    share = table['length'] / np.sum(length)
+    has_length = table['length'] > 0
+    surveyed_density = np.where(has_length, table['surveyed_density'], 0.0)
+    modeled_density = np.where(has_length, table['modeled_density'], 0.0)
+    log_ratio = np.log((surveyed_density + DENSITY_OFFSET) / (occupancy * modeled_density + DENSITY_OFFSET))
+    return np.sum(share * log_ratio ** 2, axis=1)
+
+
+def write_report(report_path, inputs_path, max_da_thresh, changes):
+    """
+    Writes the electivity table of the default and calibrated breakpoints side by side
+    :param report_path: The CSV file to write
+    :param inputs_path: The path to the inputs saved by cache_inputs()
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+    :param changes: The calibrated breakpoints
+    :return:
+    """
+    inputs = np.load(inputs_path)
+    tables = []
+    for fis in [Comb_FIS.build_comb_fis(), Comb_FIS.build_comb_fis().with_breakpoints(changes)]:
+        occ = Comb_FIS.finish_comb_capacity(fis.defuzzify(inputs['activation']), inputs['oVC_EX'],
+                                            inputs['iGeo_DA'], max_da_thresh, fis.output)
+        tables.append(Capacity_Validation.electivity_by_category(inputs['iGeo_Len'], inputs['e_DamCt'],
+                                                                 Comb_FIS.count_dams(occ, inputs['iGeo_Len']), occ))
+
+    with open(report_path, 'wb') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["Category", "Length", "SurveyedDams", "DefaultDams", "CalibratedDams", "SurveyedDens",
+                         "DefaultDens", "CalibratedDens", "DefaultElectivity", "CalibratedElectivity"])
+        for i, category in enumerate(Capacity_Validation.CAPACITY_CATEGORIES):
+            writer.writerow([category, tables[0]['length'][0, i], tables[0]['surveyed_dams'][0, i],
+                             tables[0]['modeled_dams'][0, i], tables[1]['modeled_dams'][0, i],
+                             tables[0]['surveyed_density'][0, i], tables[0]['modeled_density'][0, i],
+                             tables[1]['modeled_density'][0, i], tables[0]['electivity'][0, i],
+                             tables[1]['electivity'][0, i]])
+
+
+# the inputs each worker loads once, in _init_worker, and uses for every batch it is given
+_worker_state = {}
+
+
+def _init_worker(inputs_path, parameters, max_da_thresh, occupancy):
+    inputs = np.load(inputs_path)
+    fis = Comb_FIS.build_comb_fis()
+    _worker_state.update(dict((name, inputs[name]) for name in ['activation', 'oVC_EX', 'iGeo_DA', 'iGeo_Len',
+                                                                'e_DamCt']))
+    _worker_state.update({
+        'fis': fis,
+        'points': [point for point, low, high in parameters],
+        'max_da_thresh': max_da_thresh,
+        'occupancy': occupancy
+    })
+
+
+def _evaluate_batch(candidates):
+    state = _worker_state
+    occ = np.zeros((len(candidates), len(state['oVC_EX'])))
+    for i, values in enumerate(candidates):
+        fis = state['fis'].with_breakpoints(dict(((state['fis'].output.name, point), value)
+                                                 for point, value in zip(state['points'], values)))
+        occ[i] = Comb_FIS.finish_comb_capacity(fis.defuzzify(state['activation']), state['oVC_EX'],
+                                               state['iGeo_DA'], state['max_da_thresh'], fis.output)
+    dam_count = Comb_FIS.count_dams(occ, state['iGeo_Len'])
+    return calibration_error(state['iGeo_Len'], state['e_DamCt'], dam_count, occ, state['occupancy'])
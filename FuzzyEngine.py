@@ -0,0 +1,791 @@
+# -------------------------------------------------------------------------------
+# Name:        Fuzzy Engine
+# Purpose:     Evaluates the BRAT fuzzy inference systems for every reach at once with NumPy arrays
+#
+# Created:     10/2026
+# -------------------------------------------------------------------------------
+
+import os
+import sys
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+import skfuzzy as fuzz
+from skfuzzy import control as ctrl
+
+
+# the number of reaches evaluated at once, which bounds the size of the temporary (reaches x points) arrays
+DEFAULT_CHUNK_SIZE = 20000
+
+# the engine integrates the aggregated output exactly, while skfuzzy samples it on the output universe, so the two
+# can differ slightly where the edges of two output terms cross between samples. With a 0.01 step on the density
+# universe the largest difference we have seen is about 0.002 dams/km
+SKFUZZY_TOLERANCE = 0.005
+
+
+class FuzzyVariable(object):
+    """
+    An input or output variable of a fuzzy inference system, with its universe and membership functions
+    """
+
+    def __init__(self, name, universe, terms):
+        """
+        :param name: The name of the variable (e.g., 'ovc')
+        :param universe: A tuple of (start, stop, step), the same arguments given to np.arange for skfuzzy
+        :param terms: A list of tuples of (term name, membership function name, breakpoints), where the membership
+            function name is either 'trimf' or 'trapmf'
+        """
+        self.name = name
+        self.universe = universe
+        self.terms = [(term_name, mf_name, list(breakpoints)) for term_name, mf_name, breakpoints in terms]
+
+        # skfuzzy clips inputs and outputs to the last sampled value of the universe, not its stop value
+        sampled = np.arange(universe[0], universe[1], universe[2])
+        self.min_value = float(sampled[0])
+        self.max_value = float(sampled[-1])
+
+    def term_names(self):
+        return [term[0] for term in self.terms]
+
+    def trapezoids(self):
+        """
+        Expresses every membership function as a trapezoid, since a triangle is a trapezoid with a point for a top
+        :return: A list of (a, b, c, d) tuples, in the same order as the terms
+        """
+        trapezoids = []
+        for term_name, mf_name, breakpoints in self.terms:
+            if mf_name == 'trimf':
+                a, b, d = breakpoints
+                trapezoids.append((float(a), float(b), float(b), float(d)))
+            elif mf_name == 'trapmf':
+                trapezoids.append(tuple(float(point) for point in breakpoints))
+            else:
+                raise Exception("Membership function " + str(mf_name) + " is not supported by the fuzzy engine")
+        return trapezoids
+
+
+class ProfileFISBuilder(object):
+    """
+    Builds the FIS saved in a profile file. Unlike a lambda, it can be given to pool workers as a fis_builder
+    """
+
+    def __init__(self, load_profile, profile_path):
+        """
+        :param load_profile: A module level function that reads a profile file and returns a FuzzyInferenceSystem
+        :param profile_path: The path to the profile file
+        """
+        self.load_profile = load_profile
+        self.profile_path = profile_path
+
+    def __call__(self):
+        return self.load_profile(self.profile_path)
+
+
+class FuzzyInferenceSystem(object):
+    """
+    A Mamdani fuzzy inference system (min for AND, 1 - x for NOT, max aggregation, centroid defuzzification),
+    described by a rule table so that it can be evaluated either with skfuzzy or with the vectorized engine
+    """
+
+    def __init__(self, inputs, output, rules):
+        """
+        :param inputs: A list of FuzzyVariable objects, in the order that input arrays will be given
+        :param output: The FuzzyVariable for the consequent
+        :param rules: A list of (antecedents, consequent) tuples. The antecedents are a tuple with one entry per
+            input, holding the term name, the term name prefixed with '~' for its complement, or None if the input is
+            not part of the rule. The consequent is the output term name
+        """
+        self.inputs = inputs
+        self.output = output
+        self.rules = rules
+        self._check_rules()
+        self._build_output_geometry()
+
+    def _check_rules(self):
+        for antecedents, consequent in self.rules:
+            if len(antecedents) != len(self.inputs):
+                raise Exception("Rule " + str(antecedents) + " does not have one antecedent per input")
+            for variable, term in zip(self.inputs, antecedents):
+                if term is not None and term.lstrip('~') not in variable.term_names():
+                    raise Exception("Term " + term + " is not defined for input " + variable.name)
+            if consequent not in self.output.term_names():
+                raise Exception("Term " + consequent + " is not defined for output " + self.output.name)
+
+    def fingerprint(self):
+        """
+        Makes a hash of the universes, membership functions, and rules, so that anything derived from this FIS (like
+        a lookup table) can be cached and reused only while the rule base stays the same
+        :return: A hex string
+        """
+        description = []
+        for variable in self.inputs + [self.output]:
+            description.append((variable.name, tuple(variable.universe), [(term_name, mf_name, tuple(breakpoints))
+                                                                         for term_name, mf_name, breakpoints
+                                                                         in variable.terms]))
+        description.append([(tuple(antecedents), consequent) for antecedents, consequent in self.rules])
+        return hashlib.md5(repr(description).encode('utf-8')).hexdigest()
+
+    def _build_output_geometry(self):
+        """
+        Finds every point on the output universe where the aggregated output could bend, regardless of how strongly
+        each term fires. The points that do depend on firing strength are found per reach in _defuzzify
+        """
+        self._out_trapezoids = np.array(self.output.trapezoids(), dtype=np.float64)
+        lo = self.output.min_value
+        hi = self.output.max_value
+
+        points = [lo, hi]
+        points.extend(self._out_trapezoids.flatten().tolist())
+
+        # where the edges of two different terms cross each other
+        edges = []
+        for a, b, c, d in self._out_trapezoids:
+            if b > a:
+                edges.append((a, b, 1.0))
+            if d > c:
+                edges.append((c, d, -1.0))
+        for i in range(len(edges)):
+            for j in range(i + 1, len(edges)):
+                point = _edge_intersection(edges[i], edges[j])
+                if point is not None:
+                    points.append(point)
+
+        points = np.unique(np.clip(np.array(points, dtype=np.float64), lo, hi))
+        self._fixed_points = points
+
+    def fuzzify(self, input_arrays):
+        """
+        Finds the membership of every input value in each of its terms
+        :param input_arrays: A list of arrays, one per input, all the same length
+        :return: A dictionary keyed by (input index, term name), holding arrays of membership values
+        """
+        memberships = {}
+        for index, (variable, values) in enumerate(zip(self.inputs, input_arrays)):
+            values = np.clip(np.asarray(values, dtype=np.float64), variable.min_value, variable.max_value)
+            for term_name, trapezoid in zip(variable.term_names(), variable.trapezoids()):
+                memberships[(index, term_name)] = trapezoid_membership(values, *trapezoid)
+        return memberships
+
+    def fire_rules(self, input_arrays):
+        """
+        Finds how strongly each output term is activated
+        :param input_arrays: A list of arrays, one per input, all the same length
+        :return: An array of shape (number of values, number of output terms)
+        """
+        memberships = self.fuzzify(input_arrays)
+        length = len(input_arrays[0])
+        out_terms = self.output.term_names()
+        activation = np.zeros((length, len(out_terms)), dtype=np.float64)
+
+        for antecedents, consequent in self.rules:
+            firing = None
+            for index, term in enumerate(antecedents):
+                if term is None:
+                    continue
+                if term.startswith('~'):
+                    value = 1.0 - memberships[(index, term[1:])]
+                else:
+                    value = memberships[(index, term)]
+                firing = value if firing is None else np.fmin(firing, value)
+            column = out_terms.index(consequent)
+            np.fmax(activation[:, column], firing, activation[:, column])
+
+        return activation
+
+    def evaluate(self, input_arrays, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Runs the fuzzy inference system on every set of inputs
+        :param input_arrays: A list of arrays, one per input, all the same length
+        :param chunk_size: How many values to defuzzify at once. Bounds the memory used by the temporary arrays
+        :return: An array of defuzzified output values
+        """
+        input_arrays = [np.asarray(values, dtype=np.float64) for values in input_arrays]
+        length = len(input_arrays[0])
+        out = np.zeros(length, dtype=np.float64)
+        for start in range(0, length, chunk_size):
+            stop = min(start + chunk_size, length)
+            activation = self.fire_rules([values[start:stop] for values in input_arrays])
+            out[start:stop] = self._defuzzify(activation)
+        return out
+
+    def defuzzify(self, activation, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Defuzzifies output term activations from fire_rules(). Activations don't depend on the output membership
+        functions, so they can be found once and defuzzified with as many versions of the output as needed
+        :param activation: An array of shape (number of values, number of output terms)
+        :param chunk_size: How many values to defuzzify at once
+        :return: An array of defuzzified output values
+        """
+        out = np.zeros(activation.shape[0], dtype=np.float64)
+        for start in range(0, activation.shape[0], chunk_size):
+            out[start:start + chunk_size] = self._defuzzify(activation[start:start + chunk_size])
+        return out
+
+    def _defuzzify(self, activation):
+        """
+        Takes the centroid of the aggregated output for each row of activations. The aggregated output is the max of
+        each output term clipped at its activation, so it is piecewise linear, and the centroid can be integrated
+        exactly once we know every point where it bends
+        :param activation: An array of shape (number of values, number of output terms)
+        :return: An array of centroids, with 0 where no rule fired
+        """
+        lo = self.output.min_value
+        hi = self.output.max_value
+        a, b, c, d = [self._out_trapezoids[:, i] for i in range(4)]
+        rows = activation.shape[0]
+
+        # where each term's edges reach each activation level, which covers both the clip points of each term and
+        # the points where one term's edge crosses another term's flat top
+        heights = activation[:, :, np.newaxis]
+        rising = a + heights * (b - a)
+        falling = d - heights * (d - c)
+        points = np.concatenate((np.tile(self._fixed_points, (rows, 1)),
+                                 rising.reshape(rows, -1), falling.reshape(rows, -1)), axis=1)
+        points = np.sort(np.clip(points, lo, hi), axis=1)
+
+        # aggregated membership at each point
+        membership = np.zeros_like(points)
+        for term in range(activation.shape[1]):
+            term_mf = trapezoid_membership(points, a[term], b[term], c[term], d[term])
+            np.fmax(membership, np.fmin(term_mf, activation[:, term:term + 1]), membership)
+
+        # exact integrals of a piecewise linear function, segment by segment
+        x0 = points[:, :-1]
+        x1 = points[:, 1:]
+        y0 = membership[:, :-1]
+        y1 = membership[:, 1:]
+        width = x1 - x0
+        area = np.sum(width * (y0 + y1) / 2.0, axis=1)
+        moment = np.sum(width * (x0 * (2.0 * y0 + y1) + x1 * (y0 + 2.0 * y1)) / 6.0, axis=1)
+
+        centroid = np.zeros(rows, dtype=np.float64)
+        fired = area > 0
+        centroid[fired] = moment[fired] / area[fired]
+        return centroid
+
+    def with_breakpoints(self, changes):
+        """
+        Makes a copy of this FIS with some membership function breakpoints moved. A breakpoint is moved in every term
+        of its variable that uses it, so that terms which share an edge keep sharing it
+        :param changes: A dictionary of new breakpoint values, keyed by (variable name, old breakpoint value)
+        :return: A new FuzzyInferenceSystem with the same rules
+        """
+        variables = []
+        for variable in self.inputs + [self.output]:
+            terms = []
+            for term_name, mf_name, breakpoints in variable.terms:
+                terms.append((term_name, mf_name, [changes.get((variable.name, point), point)
+                                                   for point in breakpoints]))
+            variables.append(FuzzyVariable(variable.name, variable.universe, terms))
+        return FuzzyInferenceSystem(variables[:-1], variables[-1], self.rules)
+
+    def build_control_system(self):
+        """
+        Builds the same fuzzy inference system with skfuzzy, for checking the engine against
+        :return: A skfuzzy ControlSystem. Its inputs are labeled with the input names and its output 'result'
+        """
+        antecedents = []
+        for variable in self.inputs:
+            antecedent = ctrl.Antecedent(np.arange(*variable.universe), variable.name)
+            _add_skfuzzy_terms(antecedent, variable)
+            antecedents.append(antecedent)
+        consequent = ctrl.Consequent(np.arange(*self.output.universe), 'result')
+        _add_skfuzzy_terms(consequent, self.output)
+
+        rules = []
+        for antecedent_terms, consequent_term in self.rules:
+            condition = None
+            for antecedent, term in zip(antecedents, antecedent_terms):
+                if term is None:
+                    continue
+                if term.startswith('~'):
+                    term_condition = ~antecedent[term[1:]]
+                else:
+                    term_condition = antecedent[term]
+                condition = term_condition if condition is None else condition & term_condition
+            rules.append(ctrl.Rule(condition, consequent[consequent_term]))
+
+        return ctrl.ControlSystem(rules)
+
+    def evaluate_with_skfuzzy(self, input_arrays, control_system=None):
+        """
+        Runs the fuzzy inference system with skfuzzy, one set of inputs at a time
+        :param input_arrays: A list of arrays, one per input, all the same length
+        :param control_system: A ControlSystem from build_control_system, so it doesn't need to be rebuilt
+        :return: An array of defuzzified output values
+        """
+        if control_system is None:
+            control_system = self.build_control_system()
+        simulation = ctrl.ControlSystemSimulation(control_system)
+
+        out = np.zeros(len(input_arrays[0]))
+        for i in range(len(out)):
+            for variable, values in zip(self.inputs, input_arrays):
+                simulation.input[variable.name] = values[i]
+            simulation.compute()
+            out[i] = simulation.output['result']
+        return out
+
+
+class LookupTable2D(object):
+    """
+    The output of a two input FIS, tabulated on a regular grid and interpolated bilinearly
+    """
+
+    def __init__(self, x_values, y_values, grid, max_error):
+        """
+        :param x_values: The grid coordinates of the first input
+        :param y_values: The grid coordinates of the second input
+        :param grid: The FIS output at each (x, y) grid point, with shape (len(x_values), len(y_values))
+        :param max_error: The largest difference found between the interpolated and exact FIS output
+        """
+        self.x_values = x_values
+        self.y_values = y_values
+        self.grid = grid
+        self.max_error = max_error
+
+    def interpolate(self, x, y):
+        """
+        Finds the FIS output for every pair of inputs by bilinear interpolation between grid points
+        :param x: An array of values for the first input
+        :param y: An array of values for the second input
+        :return: An array of interpolated outputs
+        """
+        x_index, x_weight = _grid_position(self.x_values, x)
+        y_index, y_weight = _grid_position(self.y_values, y)
+        grid = self.grid
+        return ((1.0 - x_weight) * (1.0 - y_weight) * grid[x_index, y_index] +
+                x_weight * (1.0 - y_weight) * grid[x_index + 1, y_index] +
+                (1.0 - x_weight) * y_weight * grid[x_index, y_index + 1] +
+                x_weight * y_weight * grid[x_index + 1, y_index + 1])
+
+
+class MemoizedEvaluator(object):
+    """
+    Evaluates a FIS once per unique set of quantized inputs, and remembers the results in a bounded LRU cache so
+    that later calls (like the second model run) can reuse them
+    """
+
+    def __init__(self, evaluate_function, resolutions, max_size=500000):
+        """
+        :param evaluate_function: A function that takes a list of input arrays and returns an array of outputs, like
+            FuzzyInferenceSystem.evaluate
+        :param resolutions: A list with one resolution per input. Inputs are rounded to the nearest multiple of their
+            resolution before evaluation. A resolution of None or 0 means the input is used as is
+        :param max_size: The most sets of inputs to remember. The least recently used are forgotten first
+        """
+        self.evaluate_function = evaluate_function
+        self.resolutions = resolutions
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.lookups = 0
+        self.evaluations = 0
+
+    def evaluate(self, input_arrays):
+        """
+        Finds the FIS output for every set of inputs, evaluating only the ones that aren't already known
+        :param input_arrays: A list of arrays, one per input, all the same length
+        :return: An array of outputs
+        """
+        quantized = []
+        for values, resolution in zip(input_arrays, self.resolutions):
+            values = np.asarray(values, dtype=np.float64)
+            if resolution:
+                values = np.round(values / resolution) * resolution
+            quantized.append(values)
+
+        unique_inputs, inverse = unique_rows(np.column_stack(quantized))
+        unique_out = np.zeros(len(unique_inputs), dtype=np.float64)
+
+        missing = []
+        for i, key in enumerate(map(tuple, unique_inputs)):
+            value = self.cache.pop(key, None)
+            if value is None:
+                missing.append(i)
+            else:
+                # putting it back moves it to the most recently used end
+                self.cache[key] = value
+                unique_out[i] = value
+
+        if len(missing) > 0:
+            missing = np.array(missing)
+            new_out = self.evaluate_function([unique_inputs[missing, j] for j in range(unique_inputs.shape[1])])
+            unique_out[missing] = new_out
+            for key, value in zip(map(tuple, unique_inputs[missing]), new_out):
+                self.cache[key] = value
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+        self.lookups += len(inverse)
+        self.evaluations += len(missing)
+        return unique_out[inverse]
+
+    def hit_rate(self):
+        """
+        The fraction of lookups that didn't need their own FIS evaluation
+        :return: A number between 0 and 1
+        """
+        if self.lookups == 0:
+            return 0.0
+        return 1.0 - float(self.evaluations) / self.lookups
+
+    def report(self):
+        return ("FIS memo: " + str(self.evaluations) + " evaluations for " + str(self.lookups) + " reaches (" +
+                str(round(100 * self.hit_rate(), 1)) + "% hit rate)")
+
+
+def make_evaluator(fis_builder, use_skfuzzy=False, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Makes a function that runs a FIS on a list of input arrays, either in this process or across a process pool
+    :param fis_builder: A module level function that returns a FuzzyInferenceSystem, like Comb_FIS.build_comb_fis
+    :param use_skfuzzy: If True, runs the FIS through skfuzzy one set of inputs at a time
+    :param workers: How many processes to split the reaches between. 1 evaluates in this process
+    :param chunk_size: How many reaches are evaluated at once, and how many go to a worker at a time
+    :return: A function that takes a list of input arrays and returns an array of outputs
+    """
+    if workers > 1:
+        def evaluate(input_arrays):
+            return evaluate_in_pool(fis_builder, input_arrays, workers, chunk_size, use_skfuzzy)
+        return evaluate
+
+    fis = fis_builder()
+    if use_skfuzzy:
+        control_system = fis.build_control_system()
+
+        def evaluate(input_arrays):
+            return fis.evaluate_with_skfuzzy(input_arrays, control_system)
+        return evaluate
+
+    def evaluate(input_arrays):
+        return fis.evaluate(input_arrays, chunk_size)
+    return evaluate
+
+
+def evaluate_in_pool(fis_builder, input_arrays, workers, chunk_size=DEFAULT_CHUNK_SIZE, use_skfuzzy=False):
+    """
+    Splits the reaches into chunks and runs the FIS on them in a process pool. Each worker builds the FIS once, and
+    the chunks are put back in their original order, so the output lines up with the ReachID array the inputs came
+    from and is the same as running the FIS in one process
+    :param fis_builder: A module level function that returns a FuzzyInferenceSystem, like Comb_FIS.build_comb_fis
+    :param input_arrays: A list of arrays, one per input, all the same length
+    :param workers: How many processes to use
+    :param chunk_size: How many reaches go to a worker at a time
+    :param use_skfuzzy: If True, the workers run the FIS through skfuzzy one set of inputs at a time
+    :return: An array of outputs
+    """
+    evaluator = PoolEvaluator(fis_builder, workers, chunk_size, use_skfuzzy)
+    try:
+        return evaluator.evaluate(input_arrays)
+    finally:
+        evaluator.close()
+
+
+class PoolEvaluator(object):
+    """
+    Runs a FIS on batches of inputs across a process pool that is started once, so that a run that evaluates many
+    batches, like the capacity uncertainty ensemble, doesn't start new workers (which each import arcpy again on
+    Windows) for every batch
+    """
+
+    def __init__(self, fis_builder, workers, chunk_size=DEFAULT_CHUNK_SIZE, use_skfuzzy=False):
+        """
+        :param fis_builder: A module level function that returns a FuzzyInferenceSystem, like Comb_FIS.build_comb_fis
+        :param workers: How many processes to use. 1 evaluates in this process
+        :param chunk_size: How many reaches are evaluated at once, and how many go to a worker at a time
+        :param use_skfuzzy: If True, runs the FIS through skfuzzy one set of inputs at a time
+        """
+        self.chunk_size = chunk_size
+        if workers > 1:
+            use_python_executable()
+            self.pool = multiprocessing.Pool(workers, _init_worker, (fis_builder, use_skfuzzy))
+            self.evaluate_here = None
+        else:
+            self.pool = None
+            self.evaluate_here = make_evaluator(fis_builder, use_skfuzzy, chunk_size=chunk_size)
+
+    def evaluate(self, input_arrays):
+        """
+        Runs the FIS on every set of inputs. The chunks are put back in their original order, so the output is the
+        same as running the FIS in one process
+        :param input_arrays: A list of arrays, one per input, all the same length
+        :return: An array of outputs
+        """
+        if self.pool is None:
+            return self.evaluate_here(input_arrays)
+        input_arrays = [np.asarray(values, dtype=np.float64) for values in input_arrays]
+        length = len(input_arrays[0])
+        chunks = [(start, [values[start:start + self.chunk_size] for values in input_arrays])
+                  for start in range(0, length, self.chunk_size)]
+
+        out = np.zeros(length, dtype=np.float64)
+        for start, chunk_out in self.pool.imap_unordered(_evaluate_chunk, chunks):
+            out[start:start + len(chunk_out)] = chunk_out
+        return out
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+# the FIS each pool worker builds once, in _init_worker, and uses for every chunk it is given
+_worker_fis = None
+_worker_control_system = None
+
+
+def _init_worker(fis_builder, use_skfuzzy):
+    global _worker_fis, _worker_control_system
+    _worker_fis = fis_builder()
+    if use_skfuzzy:
+        _worker_control_system = _worker_fis.build_control_system()
+
+
+def _evaluate_chunk(chunk):
+    start, input_arrays = chunk
+    if _worker_control_system is not None:
+        return start, _worker_fis.evaluate_with_skfuzzy(input_arrays, _worker_control_system)
+    return start, _worker_fis.evaluate(input_arrays)
+
+
+def use_python_executable():
+    """
+    Inside ArcMap, sys.executable is ArcMap itself, which can't be used to start worker processes, so we point
+    multiprocessing at the Python interpreter that ships with it
+    """
+    if not os.path.basename(sys.executable).lower().startswith('python'):
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+
+
+def breakpoint_ranges(variable, spread):
+    """
+    Finds how far each breakpoint of a variable can move without passing the breakpoints next to it
+    :param variable: A FuzzyVariable
+    :param spread: How far a breakpoint can move, as a fraction of its value
+    :return: A list of (breakpoint, low, high) tuples, for every distinct breakpoint that isn't an end of the universe
+    """
+    points = sorted(set(float(point) for term in variable.terms for point in term[2]) |
+                    set([variable.min_value, float(variable.universe[1])]))
+    ranges = []
+    for i in range(1, len(points) - 1):
+        point = points[i]
+        # stop halfway to the next breakpoint on each side, so the terms keep their order
+        low = max(point - abs(point) * spread, (points[i - 1] + point) / 2.0)
+        high = min(point + abs(point) * spread, (point + points[i + 1]) / 2.0)
+        ranges.append((point, low, high))
+    return ranges
+
+
+def universe_resolutions(fis):
+    """
+    The step of each input universe, which is the finest resolution skfuzzy itself distinguishes
+    :param fis: A FuzzyInferenceSystem
+    :return: A list of resolutions, one per input
+    """
+    return [variable.universe[2] for variable in fis.inputs]
+
+
+def read_memo_resolutions(text, fis):
+    """
+    Reads the resolutions to quantize a FIS's inputs to when memoizing
+    :param text: A list of resolutions, or text like "1;10;1;0.001" with one resolution per input, where None or 0
+        uses an input as is. None or an empty string uses the step of each input universe
+    :param fis: The FuzzyInferenceSystem the resolutions are for
+    :return: A list of resolutions, one per input
+    """
+    if text is None or text == "None" or text == "":
+        return universe_resolutions(fis)
+    if not isinstance(text, list):
+        text = [resolution.strip() for resolution in text.split(';')]
+    if len(text) != len(fis.inputs):
+        raise Exception("The FIS has " + str(len(fis.inputs)) + " inputs (" +
+                        ", ".join(variable.name for variable in fis.inputs) + "), but " + str(len(text)) +
+                        " memo resolutions were given")
+    resolutions = []
+    for resolution in text:
+        if resolution is None or resolution == "None" or resolution == "":
+            resolutions.append(None)
+        else:
+            resolutions.append(float(resolution))
+    return resolutions
+
+
+def fis_definition(fis):
+    """
+    Describes a FIS with lists and dictionaries, so that it can be saved as JSON
+    :param fis: A FuzzyInferenceSystem
+    :return: A dictionary with the inputs, output and rules of the FIS
+    """
+    return {
+        "inputs": [_variable_definition(variable) for variable in fis.inputs],
+        "output": _variable_definition(fis.output),
+        "rules": [{"if": list(antecedents), "then": consequent} for antecedents, consequent in fis.rules]
+    }
+
+
+def fis_from_definition(definition):
+    """
+    Builds a FIS from a description made by fis_definition(). The FIS checks its own rules as it is built
+    :param definition: A dictionary with the inputs, output and rules of the FIS
+    :return: A FuzzyInferenceSystem
+    """
+    try:
+        inputs = [_variable_from_definition(variable) for variable in definition["inputs"]]
+        output = _variable_from_definition(definition["output"])
+        rules = [(tuple(rule["if"]), rule["then"]) for rule in definition["rules"]]
+    except (KeyError, TypeError, ValueError) as error:
+        raise Exception("The FIS definition could not be read: " + repr(error))
+    return FuzzyInferenceSystem(inputs, output, rules)
+
+
+def _variable_definition(variable):
+    return {
+        "name": variable.name,
+        "universe": list(variable.universe),
+        "terms": [{"name": term_name, "mf": mf_name, "points": list(breakpoints)}
+                  for term_name, mf_name, breakpoints in variable.terms]
+    }
+
+
+def _variable_from_definition(definition):
+    terms = [(term["name"], term["mf"], term["points"]) for term in definition["terms"]]
+    return FuzzyVariable(definition["name"], tuple(definition["universe"]), terms)
+
+
+def unique_rows(array):
+    """
+    Finds the unique rows of a 2D array
+    :param array: A 2D array
+    :return: A tuple of (unique rows, index of the unique row for each original row)
+    """
+    if len(array) == 0:
+        return array, np.zeros(0, dtype=np.int64)
+    order = np.lexsort(array.T[::-1])
+    sorted_rows = array[order]
+    is_new = np.ones(len(array), dtype=bool)
+    is_new[1:] = np.any(sorted_rows[1:] != sorted_rows[:-1], axis=1)
+    group = np.cumsum(is_new) - 1
+    inverse = np.empty(len(array), dtype=np.int64)
+    inverse[order] = group
+    return sorted_rows[is_new], inverse
+
+
+def build_lookup_table(fis, step=0.005, cache_folder=None):
+    """
+    Tabulates the output of a two input FIS over the whole of both input universes. If a cache folder is given, the
+    table is saved there under the FIS fingerprint, and loaded from there the next time the same FIS asks for it
+    :param fis: A FuzzyInferenceSystem with two inputs
+    :param step: The spacing of the grid
+    :param cache_folder: Where to keep tables between runs. If None, the table is always rebuilt
+    :return: A LookupTable2D
+    """
+    if len(fis.inputs) != 2:
+        raise Exception("Lookup tables can only be built for a FIS with two inputs")
+
+    cache_file = None
+    if cache_folder is not None:
+        cache_file = os.path.join(cache_folder, "FIS_" + fis.fingerprint() + "_" + repr(step) + ".npz")
+        if os.path.exists(cache_file):
+            cached = np.load(cache_file)
+            return LookupTable2D(cached['x_values'], cached['y_values'], cached['grid'], float(cached['max_error']))
+
+    x_values = _grid_values(fis.inputs[0], step)
+    y_values = _grid_values(fis.inputs[1], step)
+    x_grid, y_grid = np.meshgrid(x_values, y_values, indexing='ij')
+    grid = fis.evaluate([x_grid.ravel(), y_grid.ravel()]).reshape(x_grid.shape)
+
+    # bilinear interpolation is least accurate in the middle of each cell, so that's where we check it
+    x_centers = (x_values[:-1] + x_values[1:]) / 2.0
+    y_centers = (y_values[:-1] + y_values[1:]) / 2.0
+    x_grid, y_grid = np.meshgrid(x_centers, y_centers, indexing='ij')
+    exact = fis.evaluate([x_grid.ravel(), y_grid.ravel()])
+    lookup_table = LookupTable2D(x_values, y_values, grid, 0.0)
+    lookup_table.max_error = float(np.max(np.abs(lookup_table.interpolate(x_grid.ravel(), y_grid.ravel()) - exact)))
+
+    if cache_file is not None:
+        np.savez(cache_file, x_values=x_values, y_values=y_values, grid=grid, max_error=lookup_table.max_error)
+
+    return lookup_table
+
+
+def _grid_values(variable, step):
+    """
+    Spaces grid points evenly from the lowest to the highest value of a variable, no further than step apart
+    :param variable: A FuzzyVariable
+    :param step: The largest allowed spacing
+    :return: An array of grid coordinates
+    """
+    count = int(np.ceil(round((variable.max_value - variable.min_value) / step, 6))) + 1
+    return np.linspace(variable.min_value, variable.max_value, max(count, 2))
+
+
+def _grid_position(grid_values, values):
+    """
+    Finds which grid cell each value falls in, and how far across the cell it is
+    :param grid_values: The evenly spaced grid coordinates
+    :param values: An array of values, which are clipped to the grid
+    :return: A tuple of (index of the lower grid point, fraction of the way to the next grid point)
+    """
+    values = np.clip(np.asarray(values, dtype=np.float64), grid_values[0], grid_values[-1])
+    spacing = (grid_values[-1] - grid_values[0]) / (len(grid_values) - 1)
+    position = (values - grid_values[0]) / spacing
+    index = np.clip(np.floor(position).astype(np.int64), 0, len(grid_values) - 2)
+    return index, position - index
+
+
+def trapezoid_membership(x, a, b, c, d):
+    """
+    Membership in a trapezoid, equal to fuzz.trapmf (or fuzz.trimf when b == c) evaluated on a fine enough universe
+    :param x: An array of values
+    :param a: Where the membership starts to rise
+    :param b: Where the membership reaches 1
+    :param c: Where the membership starts to fall
+    :param d: Where the membership reaches 0
+    :return: An array of membership values, the same shape as x
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if b > a:
+        left = (x - a) / (b - a)
+    else:
+        left = np.where(x < a, 0.0, 1.0)
+    if d > c:
+        right = (d - x) / (d - c)
+    else:
+        right = np.where(x > d, 0.0, 1.0)
+    return np.clip(np.fmin(left, right), 0.0, 1.0)
+
+
+def _edge_intersection(first_edge, second_edge):
+    """
+    Finds where two membership function edges cross, if they do
+    :param first_edge: A tuple of (start, end, direction), with direction 1 for a rising edge and -1 for a falling one
+    :param second_edge: Same as first_edge
+    :return: The x value where they cross, or None
+    """
+    first_slope = first_edge[2] / (first_edge[1] - first_edge[0])
+    second_slope = second_edge[2] / (second_edge[1] - second_edge[0])
+    if first_slope == second_slope:
+        return None
+    first_zero = first_edge[0] if first_edge[2] > 0 else first_edge[1]
+    second_zero = second_edge[0] if second_edge[2] > 0 else second_edge[1]
+    # first_slope * (x - first_zero) == second_slope * (x - second_zero)
+    x = (first_slope * first_zero - second_slope * second_zero) / (first_slope - second_slope)
+    low = max(min(first_edge[0], first_edge[1]), min(second_edge[0], second_edge[1]))
+    high = min(max(first_edge[0], first_edge[1]), max(second_edge[0], second_edge[1]))
+    if low <= x <= high:
+        return x
+    return None
+
+
+def _add_skfuzzy_terms(fuzzy_variable, variable):
+    """
+    Adds the membership functions of a FuzzyVariable to a skfuzzy Antecedent or Consequent
+    :param fuzzy_variable: The skfuzzy Antecedent or Consequent
+    :param variable: The FuzzyVariable that describes it
+    :return:
+    """
+    for term_name, mf_name, breakpoints in variable.terms:
+        if mf_name == 'trimf':
+            fuzzy_variable[term_name] = fuzz.trimf(fuzzy_variable.universe, breakpoints)
+        else:
+            fuzzy_variable[term_name] = fuzz.trapmf(fuzzy_variable.universe, breakpoints)
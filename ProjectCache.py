@@ -0,0 +1,238 @@
+# -------------------------------------------------------------------------------
+# Name:        Project Cache
+# Purpose:     Keeps rasters and feature classes derived from a project's inputs, keyed by a hash of the input files'
+#              contents and the parameters they were made with, so that later runs can reuse them
+#
+# Created:     10/2026
+# -------------------------------------------------------------------------------
+
+import arcpy
+import glob
+import hashlib
+import json
+import os
+import time
+
+# the version of the cache. Entries made by another version are not used
+CACHE_VERSION = 1
+
+# the most space the cache can take up, in bytes, before the entries used least recently are deleted
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+# how much of a file is hashed at a time
+HASH_CHUNK_BYTES = 1024 * 1024
+
+MANIFEST_NAME = "CacheManifest.json"
+
+# files that ArcGIS rewrites next to a dataset without changing its data, such as metadata, statistics, pyramids and
+# locks, which are left out of its hash
+IGNORED_SUFFIXES = (".xml", ".ovr", ".rrd", ".lock")
+
+
+class ProjectCache(object):
+    """
+    A folder of derived datasets, each named by a hash of the contents of the files it was made from and the
+    operation and parameters that made it. A manifest keeps the size and last use of every entry, and when the cache
+    grows past its size limit the entries used least recently are deleted, other than the ones used since the cache
+    was opened, which may still be in use until end_session() is called. The hash of each input file is also kept
+    with its size and modified time, so unchanged files aren't read again
+    """
+    def __init__(self, folder, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param folder: The folder to keep the cache in. It's made if it doesn't exist
+        :param max_bytes: The most space the cache can take up, in bytes
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.manifest_path = os.path.join(folder, MANIFEST_NAME)
+        self.entries = {}
+        self.file_hashes = {}
+        # the keys of the entries fetched or made since the cache was opened, which are never deleted until the session
+        # ends, since the paths handed out for them may still be in use
+        self.session_keys = set()
+        self.load_manifest()
+
+    def load_manifest(self):
+        """
+        Reads the manifest of the cache. A manifest that can't be read, or was made by another version, is started
+        over, and entries whose files are gone are dropped
+        :return:
+        """
+        try:
+            with open(self.manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get("version") != CACHE_VERSION:
+                return
+            self.entries = manifest.get("entries", {})
+            self.file_hashes = manifest.get("file_hashes", {})
+        except (IOError, OSError, ValueError):
+            return
+        for key in list(self.entries.keys()):
+            if not os.path.exists(os.path.join(self.folder, self.entries[key]["name"])):
+                del self.entries[key]
+
+    def save_manifest(self):
+        """
+        Writes the manifest of the cache, through a temporary file so that a run that stops part way through
+        doesn't leave it half written
+        :return:
+        """
+        self.file_hashes = dict((path, value) for path, value in self.file_hashes.items() if os.path.exists(path))
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, 'w') as manifest_file:
+            json.dump({"version": CACHE_VERSION, "entries": self.entries, "file_hashes": self.file_hashes},
+                      manifest_file, indent=1, sort_keys=True)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        os.rename(temp_path, self.manifest_path)
+
+    def file_hash(self, file_path):
+        """
+        Finds the md5 hash of a file's contents, reusing the hash found before if its size and modified time haven't
+        changed
+        :param file_path: The path to the file
+        :return: The hex digest of the file
+        """
+        file_path = os.path.abspath(file_path)
+        stats = os.stat(file_path)
+        known = self.file_hashes.get(file_path)
+        if known is not None and known[0] == stats.st_size and known[1] == stats.st_mtime:
+            return known[2]
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as data_file:
+            chunk = data_file.read(HASH_CHUNK_BYTES)
+            while chunk:
+                md5.update(chunk)
+                chunk = data_file.read(HASH_CHUNK_BYTES)
+        self.file_hashes[file_path] = [stats.st_size, stats.st_mtime, md5.hexdigest()]
+        return md5.hexdigest()
+
+    def dataset_hash(self, dataset):
+        """
+        Finds a hash of the contents of every file that makes up a dataset
+        :param dataset: The path to a raster or feature class
+        :return: The hex digest of the dataset, or None if it isn't stored as files, such as a feature class in a
+            geodatabase
+        """
+        files = dataset_files(str(dataset))
+        if len(files) == 0:
+            return None
+        md5 = hashlib.md5()
+        for file_path in files:
+            md5.update(os.path.basename(file_path).lower().encode('utf-8'))
+            md5.update(self.file_hash(file_path).encode('utf-8'))
+        return md5.hexdigest()
+
+    def key(self, operation, inputs, parameters):
+        """
+        Finds the key of an operation on a set of inputs
+        :param operation: The name of the operation
+        :param inputs: A list of the paths to the datasets the operation reads
+        :param parameters: A dictionary of the parameters of the operation
+        :return: The hex digest key, or None if one of the inputs can't be hashed
+        """
+        md5 = hashlib.md5()
+        md5.update(("BRAT cache " + str(CACHE_VERSION) + " " + operation).encode('utf-8'))
+        for dataset in inputs:
+            digest = self.dataset_hash(dataset)
+            if digest is None:
+                return None
+            md5.update(digest.encode('utf-8'))
+        md5.update(repr(sorted((str(name), str(value)) for name, value in parameters.items())).encode('utf-8'))
+        return md5.hexdigest()
+
+    def fetch(self, operation, inputs, parameters, create, extension=".tif"):
+        """
+        Finds the output of an operation in the cache, or makes it and adds it to the cache
+        :param operation: The name of the operation, which begins the name of its output
+        :param inputs: A list of the paths to the datasets the operation reads
+        :param parameters: A dictionary of the parameters of the operation, other than its inputs
+        :param create: A function that takes an output path and saves the output of the operation to it
+        :param extension: The extension of the output, such as .tif or .shp
+        :return: The path to the output
+        """
+        key = self.key(operation, inputs, parameters)
+        if key is None:
+            # inputs that aren't stored as files can't be hashed, so their output is made every time
+            arcpy.AddMessage("The inputs to " + operation + " can't be cached, so it will be made again")
+            output = os.path.join(self.folder, operation + "_Uncached" + extension)
+            if arcpy.Exists(output):
+                arcpy.Delete_management(output)
+            create(output)
+            return output
+
+        name = operation + "_" + key + extension
+        output = os.path.join(self.folder, name)
+        if key in self.entries and arcpy.Exists(output):
+            arcpy.AddMessage("Using the cached " + operation + " from " + output)
+            self.session_keys.add(key)
+            self.entries[key]["last_used"] = time.time()
+            self.save_manifest()
+            return output
+
+        if arcpy.Exists(output):
+            arcpy.Delete_management(output)
+        try:
+            create(output)
+        except Exception:
+            # don't leave half made outputs to be mistaken for finished ones
+            if arcpy.Exists(output):
+                arcpy.Delete_management(output)
+            raise
+        self.entries[key] = {"name": name, "operation": operation, "last_used": time.time(),
+                             "bytes": sum(os.path.getsize(file_path) for file_path in dataset_files(output))}
+        self.session_keys.add(key)
+        self.evict()
+        self.save_manifest()
+        return output
+
+    def end_session(self):
+        """
+        Lets the entries used since the cache was opened be deleted again, and deletes the entries used least recently
+        until the cache fits in its size limit. Call it once the paths fetch() has handed out are no longer used
+        :return:
+        """
+        self.session_keys = set()
+        self.evict()
+        self.save_manifest()
+
+    def evict(self):
+        """
+        Deletes the entries used least recently until the cache fits in its size limit. Entries used in this session
+        are never deleted, so the cache can go over its limit until the session ends
+        :return:
+        """
+        total = sum(entry["bytes"] for entry in self.entries.values())
+        by_last_use = sorted(self.entries.keys(), key=lambda entry_key: self.entries[entry_key]["last_used"])
+        for entry_key in by_last_use:
+            if total <= self.max_bytes:
+                break
+            if entry_key in self.session_keys:
+                continue
+            entry = self.entries.pop(entry_key)
+            output = os.path.join(self.folder, entry["name"])
+            if arcpy.Exists(output):
+                arcpy.Delete_management(output)
+            total -= entry["bytes"]
+
+
+def dataset_files(dataset):
+    """
+    Finds the files that make up a dataset: every file in a folder, such as an ESRI grid, or every file next to a
+    file with the same base name, such as the .shp, .dbf and .prj of a shapefile or the .tif and .tfw of a raster.
+    Metadata, statistics and pyramid files are left out
+    :param dataset: The path to the dataset
+    :return: A sorted list of file paths, which is empty if the dataset isn't stored as files
+    """
+    if os.path.isdir(dataset):
+        files = []
+        for folder, folder_names, file_names in os.walk(dataset):
+            files.extend(os.path.join(folder, file_name) for file_name in file_names)
+    elif os.path.isfile(dataset):
+        files = [file_path for file_path in glob.glob(os.path.splitext(dataset)[0] + ".*")
+                 if os.path.isfile(file_path)] + [dataset]
+    else:
+        return []
+    return sorted(set(file_path for file_path in files if not file_path.lower().endswith(IGNORED_SUFFIXES)))
@@ -0,0 +1,350 @@
+# -------------------------------------------------------------------------------
+# Name:        Sensitivity Analysis
+# Purpose:     Finds how sensitive network-wide dam capacity is to the membership function breakpoints of the
+#              vegetation and combined FIS, with Sobol indices estimated from Saltelli sampling
+#
+# Created:     10/2026
+# -------------------------------------------------------------------------------
+
+import arcpy
+import csv
+import multiprocessing
+import numpy as np
+import os
+from collections import OrderedDict
+from SupportingFunctions import load_columns, make_folder
+from FuzzyEngine import breakpoint_ranges, unique_rows, use_python_executable
+import Veg_FIS
+import Comb_FIS
+reload(Veg_FIS)
+reload(Comb_FIS)
+
+# the fuzzy inference systems whose input breakpoints are sampled
+FIS_BUILDERS = OrderedDict([('veg', Veg_FIS.build_veg_fis), ('comb', Comb_FIS.build_comb_fis)])
+
+DESIGN_FILE = "Sensitivity_Design.npz"
+INPUTS_FILE = "Sensitivity_Inputs.npz"
+RESULTS_FILE = "Sensitivity_Results.csv"
+INDICES_FILE = "Sensitivity_Indices.csv"
+
+
+def main(in_network, out_folder, max_da_thresh, base_samples=64, spread=0.1, model_run='ex', sampling='lhs',
+         workers=1, seed=None):
+    """
+    Runs the vegetation and combined FIS over the whole network for many sets of input breakpoints, and finds the
+    first order and total Sobol index of each breakpoint for the network's total dam capacity. Results are saved as
+    each set finishes, so a run that stops can be started again with the same settings and pick up where it was
+    :param in_network: The BRAT network, with the iVeg, iHyd and iGeo fields
+    :param out_folder: The folder to keep the design, results and indices in
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+    :param base_samples: How many base samples to draw. The network is run base_samples * (parameters + 2) times
+    :param spread: How far each breakpoint can move, as a fraction of its value
+    :param model_run: Which capacity to analyze, either 'hpe' or 'ex'
+    :param sampling: How to draw the base samples, either 'lhs' (Latin hypercube), 'random', or 'sobol' if
+        scipy.stats.qmc can be imported
+    :param workers: How many processes to run samples in
+    :param seed: The random seed
+    :return: A list of (parameter name, first order index, total index) tuples
+    """
+    base_samples = int(base_samples) if base_samples else 64
+    spread = float(spread) if spread else 0.1
+    model_run = model_run.lower() if model_run else 'ex'
+    sampling = sampling.lower() if sampling else 'lhs'
+    workers = int(workers) if workers else 1
+    seed = int(seed) if seed not in [None, "", "None"] else None
+    make_folder(os.path.dirname(out_folder), os.path.basename(out_folder))
+
+    parameters = breakpoint_parameters(spread)
+    settings = repr((in_network, float(max_da_thresh), base_samples, spread, model_run, sampling, seed,
+                     [parameter[0] for parameter in parameters]))
+    design = load_design(out_folder, settings)
+    if design is None:
+        arcpy.AddMessage("Drawing " + str(base_samples) + " base samples of " + str(len(parameters)) +
+                         " breakpoints...")
+        design = saltelli_design(base_samples, parameters, sampling, np.random.RandomState(seed))
+        save_inputs(out_folder, in_network)
+        np.savez(os.path.join(out_folder, DESIGN_FILE), design=design, settings=np.array(settings))
+        results_path = os.path.join(out_folder, RESULTS_FILE)
+        if os.path.exists(results_path):
+            os.remove(results_path)
+
+    results = run_design(out_folder, design, parameters, max_da_thresh, model_run, workers)
+
+    indices = sobol_indices(results, base_samples, len(parameters))
+    write_indices(os.path.join(out_folder, INDICES_FILE), parameters, indices)
+    for name, first_order, total in sorted(indices_by_name(parameters, indices), key=lambda row: -row[2])[:10]:
+        arcpy.AddMessage(name + ": first order " + str(round(first_order, 3)) + ", total " + str(round(total, 3)))
+    return indices_by_name(parameters, indices)
+
+
+def breakpoint_parameters(spread):
+    """
+    Lists every input breakpoint of the vegetation and combined FIS that can be sampled
+    :param spread: How far each breakpoint can move, as a fraction of its value
+    :return: A list of (name, FIS name, variable name, breakpoint, low, high) tuples
+    """
+    parameters = []
+    for fis_name, fis_builder in FIS_BUILDERS.items():
+        for variable in fis_builder().inputs:
+            for point, low, high in breakpoint_ranges(variable, spread):
+                name = fis_name + "." + variable.name + "." + repr(point)
+                parameters.append((name, fis_name, variable.name, point, low, high))
+    return parameters
+
+
+def saltelli_design(base_samples, parameters, sampling, random_state):
+    """
+    Draws the parameter sets for estimating Sobol indices: the base matrices A and B, then A with each column in
+    turn taken from B
+    :param base_samples: How many rows A and B each have
+    :param parameters: A list of parameters from breakpoint_parameters()
+    :param sampling: One of sampling_options()
+    :param random_state: The numpy RandomState to draw from
+    :return: An array of parameter values, with base_samples * (parameters + 2) rows and one column per parameter
+    """
+    count = len(parameters)
+    if sampling == 'sobol':
+        qmc = load_qmc()
+        if qmc is None:
+            raise Exception("Sobol sampling needs scipy 1.7 or newer. Use Latin hypercube sampling instead")
+        unit = qmc.Sobol(2 * count, seed=random_state).random(base_samples)
+    elif sampling == 'lhs':
+        unit = latin_hypercube(base_samples, 2 * count, random_state)
+    elif sampling == 'random':
+        unit = random_state.rand(base_samples, 2 * count)
+    else:
+        raise Exception("Unknown sampling \"" + str(sampling) + "\". Options are " + ", ".join(sampling_options()))
+
+    a = unit[:, :count]
+    b = unit[:, count:]
+    blocks = [a, b]
+    for i in range(count):
+        ab = a.copy()
+        ab[:, i] = b[:, i]
+        blocks.append(ab)
+    unit = np.vstack(blocks)
+
+    lows = np.array([parameter[4] for parameter in parameters])
+    highs = np.array([parameter[5] for parameter in parameters])
+    return lows + unit * (highs - lows)
+
+
+def load_qmc():
+    """
+    Imports scipy's quasi-Monte Carlo module, which Sobol sampling needs. It was added in scipy 1.7, which the
+    Python 2.7 that comes with ArcMap can't have
+    :return: The scipy.stats.qmc module, or None if it can't be imported
+    """
+    try:
+        from scipy.stats import qmc
+    except ImportError:
+        return None
+    return qmc
+
+
+def sampling_options():
+    """
+    Lists the ways the base samples can be drawn here. Latin hypercube and random sampling only need numpy, and Sobol
+    sampling is added if scipy.stats.qmc can be imported
+    :return: A list of sampling options, with the default first
+    """
+    options = ['lhs', 'random']
+    if load_qmc() is not None:
+        options.append('sobol')
+    return options
+
+
+def latin_hypercube(samples, dimensions, random_state):
+    """
+    Draws a Latin hypercube sample on the unit cube, with one point in each of the samples strata of every dimension
+    :param samples: How many points to draw
+    :param dimensions: How many dimensions each point has
+    :param random_state: The numpy RandomState to draw from
+    :return: An array of shape (samples, dimensions)
+    """
+    strata = np.argsort(random_state.rand(samples, dimensions), axis=0)
+    return (strata + random_state.rand(samples, dimensions)) / float(samples)
+
+
+def sobol_indices(results, base_samples, count):
+    """
+    Estimates first order (Saltelli 2010) and total (Jansen) Sobol indices from the results of a Saltelli design
+    :param results: An array of the model output for each row of the design
+    :param base_samples: How many rows A and B each have
+    :param count: How many parameters were sampled
+    :return: A tuple of (first order indices, total indices) arrays
+    """
+    f_a = results[:base_samples]
+    f_b = results[base_samples:2 * base_samples]
+    f_ab = results[2 * base_samples:].reshape(count, base_samples)
+    variance = np.var(np.concatenate((f_a, f_b)))
+    if variance == 0:
+        arcpy.AddWarning("Network capacity was the same for every sample, so every sensitivity index is 0")
+        return np.zeros(count), np.zeros(count)
+
+    first_order = np.mean(f_b * (f_ab - f_a), axis=1) / variance
+    total = 0.5 * np.mean((f_a - f_ab) ** 2, axis=1) / variance
+    return first_order, total
+
+
+def indices_by_name(parameters, indices):
+    """
+    Pairs each parameter name with its indices
+    :param parameters: A list of parameters from breakpoint_parameters()
+    :param indices: A tuple of (first order indices, total indices) arrays
+    :return: A list of (parameter name, first order index, total index) tuples
+    """
+    return [(parameter[0], float(first_order), float(total))
+            for parameter, first_order, total in zip(parameters, indices[0], indices[1])]
+
+
+def write_indices(file_path, parameters, indices):
+    """
+    Writes the sensitivity indices to a CSV file
+    :param file_path: The CSV file to write
+    :param parameters: A list of parameters from breakpoint_parameters()
+    :param indices: A tuple of (first order indices, total indices) arrays
+    :return:
+    """
+    with open(file_path, 'wb') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["Parameter", "FIS", "Variable", "Breakpoint", "Low", "High", "FirstOrder", "Total"])
+        for parameter, first_order, total in zip(parameters, indices[0], indices[1]):
+            writer.writerow(list(parameter) + [first_order, total])
+
+
+def save_inputs(out_folder, in_network):
+    """
+    Reads the FIS inputs from the network once, and saves them for the workers to load
+    :param out_folder: The folder to save the inputs in
+    :param in_network: The BRAT network
+    :return:
+    """
+    fields = ["iVeg100EX", "iVeg_30EX", "iVeg100Hpe", "iVeg_30Hpe", "iHyd_SP2", "iHyd_SPLow", "iGeo_Slope",
+              "iGeo_DA", "iGeo_Len"]
+    columns = load_columns(in_network, fields)
+    np.savez(os.path.join(out_folder, INPUTS_FILE), **columns)
+
+
+def load_design(out_folder, settings):
+    """
+    Loads the design of an earlier run with the same settings, so that it can be resumed
+    :param out_folder: The folder the design was saved in
+    :param settings: The settings of this run
+    :return: The design array, or None if there is no design for these settings
+    """
+    design_path = os.path.join(out_folder, DESIGN_FILE)
+    if not os.path.exists(design_path) or not os.path.exists(os.path.join(out_folder, INPUTS_FILE)):
+        return None
+    saved = np.load(design_path)
+    if str(saved['settings']) != settings:
+        arcpy.AddWarning("The sensitivity analysis in " + out_folder + " used different settings, so it will be " +
+                         "started over")
+        return None
+    arcpy.AddMessage("Resuming the sensitivity analysis in " + out_folder)
+    return saved['design']
+
+
+def load_results(results_path, sample_count):
+    """
+    Loads the results of the samples that have already been run
+    :param results_path: The results CSV file
+    :param sample_count: How many samples the design has
+    :return: An array of results, with NaN for samples that haven't been run
+    """
+    results = np.ones(sample_count) * np.nan
+    if os.path.exists(results_path):
+        with open(results_path, 'rb') as csv_file:
+            for row in csv.reader(csv_file):
+                # a row cut short by the run stopping is run again
+                if len(row) == 2 and row[0].isdigit() and int(row[0]) < sample_count:
+                    try:
+                        results[int(row[0])] = float(row[1])
+                    except ValueError:
+                        continue
+    return results
+
+
+def run_design(out_folder, design, parameters, max_da_thresh, model_run, workers):
+    """
+    Runs every sample of the design that doesn't have a result yet, writing each result as soon as it's found
+    :param out_folder: The folder with the saved inputs and results
+    :param design: The array of parameter values for each sample
+    :param parameters: A list of parameters from breakpoint_parameters()
+    :param max_da_thresh: The drainage area value above which the stream is assumed to not support dam building
+    :param model_run: Which capacity to analyze, either 'hpe' or 'ex'
+    :param workers: How many processes to run samples in
+    :return: An array of the network's total dam capacity for each sample
+    """
+    results_path = os.path.join(out_folder, RESULTS_FILE)
+    results = load_results(results_path, len(design))
+    pending = [(i, design[i]) for i in np.flatnonzero(np.isnan(results))]
+    arcpy.AddMessage(str(len(design) - len(pending)) + " of " + str(len(design)) + " samples already run")
+    if len(pending) == 0:
+        return results
+
+    worker_args = (os.path.join(out_folder, INPUTS_FILE), parameters, float(max_da_thresh), model_run)
+    with open(results_path, 'ab') as csv_file:
+        writer = csv.writer(csv_file)
+        if workers > 1:
+            use_python_executable()
+            pool = multiprocessing.Pool(workers, _init_worker, worker_args)
+            try:
+                sample_results = pool.imap_unordered(_run_sample, pending)
+                _record_results(sample_results, results, writer, csv_file, len(pending))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _init_worker(*worker_args)
+            _record_results((_run_sample(sample) for sample in pending), results, writer, csv_file, len(pending))
+    return results
+
+
+def _record_results(sample_results, results, writer, csv_file, pending_count):
+    for done, (i, capacity) in enumerate(sample_results):
+        results[i] = capacity
+        writer.writerow([i, repr(capacity)])
+        csv_file.flush()
+        if (done + 1) % 100 == 0:
+            arcpy.AddMessage("Ran " + str(done + 1) + " of " + str(pending_count) + " samples")
+
+
+# the inputs each worker loads once, in _init_worker, and uses for every sample it is given
+_worker_state = {}
+
+
+def _init_worker(inputs_path, parameters, max_da_thresh, model_run):
+    inputs = np.load(inputs_path)
+    suffix = 'Hpe' if model_run == 'hpe' else 'EX'
+    veg_inputs = np.column_stack((np.clip(inputs['iVeg100' + suffix], 0, 4),
+                                  np.clip(inputs['iVeg_30' + suffix], 0, 4)))
+
+    # the vegetation inputs don't change between samples, so each unique pair is only run once per sample
+    unique_veg, veg_index = unique_rows(veg_inputs)
+    _worker_state.update({
+        'parameters': parameters,
+        'max_da_thresh': max_da_thresh,
+        'base_fis': dict((fis_name, fis_builder()) for fis_name, fis_builder in FIS_BUILDERS.items()),
+        'unique_veg': [unique_veg[:, 0], unique_veg[:, 1]],
+        'veg_index': veg_index,
+        'columns': dict((field, inputs[field]) for field in ["iHyd_SP2", "iHyd_SPLow", "iGeo_Slope", "iGeo_DA",
+                                                              "iGeo_Len"])
+    })
+
+
+def _run_sample(sample):
+    i, values = sample
+    state = _worker_state
+    changes = dict((fis_name, {}) for fis_name in FIS_BUILDERS)
+    for parameter, value in zip(state['parameters'], values):
+        changes[parameter[1]][(parameter[2], parameter[3])] = value
+    veg_fis = state['base_fis']['veg'].with_breakpoints(changes['veg'])
+    comb_fis = state['base_fis']['comb'].with_breakpoints(changes['comb'])
+
+    columns = state['columns']
+    ovc = Veg_FIS.reclassify_capacity(veg_fis.evaluate(state['unique_veg']))[state['veg_index']]
+    raw_out = Comb_FIS.run_comb_fis(ovc, columns["iHyd_SP2"], columns["iHyd_SPLow"], columns["iGeo_Slope"],
+                                    comb_fis.evaluate)
+    capacity = Comb_FIS.finish_comb_capacity(raw_out, ovc, columns["iGeo_DA"], state['max_da_thresh'])
+    return i, float(np.sum(capacity * (columns["iGeo_Len"] / 1000)))
@@ -10,6 +10,7 @@
 import os
 import arcpy
 import uuid
+import numpy as np
 
 
 def find_folder(folder_location, folder_name):
@@ -171,3 +172,95 @@ def write_xml_element_with_path(xml_file, base_element, xml_element_name, item_n
     xml_file.add_sub_element(new_element, "Name", item_name)
     relative_path = find_relative_path(path, project_root)
     xml_file.add_sub_element(new_element, "Path", relative_path)
+
+
+def parse_input_bool(given_input):
+    """
+    Takes an ArcMap bool input and coverts it to be usable in Python
+    :param given_input: The given ArcMap input
+    :return: Converted Bool
+    """
+    if given_input == 'false' or not given_input:
+        return False
+    else:
+        return True
+
+
+def load_columns(in_network, fields):
+    """
+    Reads several fields of a feature class into arrays with a single scan of its table, rather than one scan per
+    field
+    :param in_network: The feature class to read from
+    :param fields: A list of field names
+    :return: A dictionary of arrays, keyed by field name. ReachID is read as int64, text fields as strings, and
+        every other field as float64
+    """
+    table = arcpy.da.FeatureClassToNumPyArray(in_network, fields)
+    columns = {}
+    for field in fields:
+        if field == 'ReachID':
+            columns[field] = np.asarray(table[field], np.int64)
+        elif table[field].dtype.kind in 'SUO':
+            columns[field] = table[field]
+        else:
+            columns[field] = np.asarray(table[field], np.float64)
+    return columns
+
+
+def write_columns(in_network, reach_ids, columns, field_types=None):
+    """
+    Writes arrays of values to a feature class by ReachID, in a single UpdateCursor pass. Fields that don't exist
+    yet are added first
+    :param in_network: The feature class to write to
+    :param reach_ids: An array of ReachIDs, which the value arrays line up with
+    :param columns: A list of (field name, array of values) tuples
+    :param field_types: A dictionary of field types for fields that need to be added, keyed by field name. A type
+        can be given with a length as a tuple, such as ('TEXT', 30). Fields not in it are added as 'DOUBLE'
+    :return: The number of rows in the feature class that had no values to write
+    """
+    if field_types is None:
+        field_types = {}
+    field_names = [field_name for field_name, values in columns]
+
+    existing_fields = [f.name for f in arcpy.ListFields(in_network)]
+    for field_name in field_names:
+        if field_name not in existing_fields:
+            field_type = field_types.get(field_name, 'DOUBLE')
+            if isinstance(field_type, tuple):
+                arcpy.AddField_management(in_network, field_name, field_type[0], "", "", field_type[1])
+            else:
+                arcpy.AddField_management(in_network, field_name, field_type)
+
+    row_reach_ids = load_columns(in_network, ['ReachID'])['ReachID']
+    reach_ids = np.asarray(reach_ids, np.int64)
+    if len(reach_ids) == 0:
+        arcpy.AddWarning("There were no values to write to " + ", ".join(field_names) + " in " + in_network)
+        return len(row_reach_ids)
+
+    # find where each row of the feature class is in the value arrays, before opening the cursor
+    order = np.argsort(reach_ids, kind='mergesort')
+    sorted_reach_ids = reach_ids[order]
+    positions = np.clip(np.searchsorted(sorted_reach_ids, row_reach_ids), 0, len(reach_ids) - 1)
+    found = sorted_reach_ids[positions] == row_reach_ids
+    positions = order[positions]
+
+    missing_in_network = np.setdiff1d(reach_ids, row_reach_ids)
+    if len(missing_in_network) > 0:
+        arcpy.AddWarning(str(len(missing_in_network)) + " ReachIDs were not found in " + in_network + ", such as " +
+                         ", ".join(str(reach_id) for reach_id in missing_in_network[:5]))
+    missing_in_values = row_reach_ids[~found]
+    if len(missing_in_values) > 0:
+        arcpy.AddWarning(str(len(missing_in_values)) + " reaches in " + in_network + " had no values to write to " +
+                         ", ".join(field_names) + ", such as ReachIDs " +
+                         ", ".join(str(reach_id) for reach_id in missing_in_values[:5]))
+
+    row_values = [np.asarray(values)[positions].tolist() for field_name, values in columns]
+    with arcpy.da.UpdateCursor(in_network, ['ReachID'] + field_names) as cursor:
+        for i, row in enumerate(cursor):
+            if row[0] != row_reach_ids[i]:
+                raise Exception("The rows of " + in_network + " changed order while writing " +
+                                ", ".join(field_names))
+            if found[i]:
+                cursor.updateRow([row[0]] + [values[i] for values in row_values])
+
+    return len(missing_in_values)
@@ -15,6 +15,7 @@ import os
 import sys
 sys.path.append('C:/Users/a02046349/Desktop/pyBRAT')
 from SupportingFunctions import make_layer, make_folder, find_available_num_prefix, find_relative_path
+from EquationEngine import evaluate_equation
 import XMLBuilder
 reload(XMLBuilder)
 XMLBuilder = XMLBuilder.XMLBuilder
@@ -102,11 +103,20 @@ def main(
         Q2 = 14.7 * (DAsqm ** 0.815)
     """
 
+    # variables that custom equations can use
+    equation_variables = {
+        'DAsqm': DAsqm,
+        'ELEV_FT': ELEV_FT,
+        'LONGITUDE': LONGITUDE,
+        'LATITUDE': LATITUDE,
+        'JAN_PRECIP': JAN_PRECIP
+    }
+
     # set regional regression equations
     if region is None:
         region = 0
     if Qlow_eqtn is not None:
-        Qlow = eval(Qlow_eqtn)
+        Qlow = evaluate_equation(Qlow_eqtn, equation_variables)
     elif float(region) == 0:
         Qlow = (DAsqm**0.2098) + 1 # default
     elif float(region) == 21:
@@ -122,7 +132,7 @@ def main(
         return
 
     if Q2_eqtn is not None:
-        Q2 = eval(Q2_eqtn)
+        Q2 = evaluate_equation(Q2_eqtn, equation_variables)
     elif float(region) == 0:
         Q2 = 14.7 * (DAsqm**0.815) # default
     elif float(region) == 21:
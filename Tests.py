@@ -9,6 +9,23 @@
 
 
 import arcpy
+import numpy as np
+import os
+import shutil
+import tempfile
+import Comb_FIS
+import Veg_FIS
+from FuzzyEngine import SKFUZZY_TOLERANCE
+from EquationEngine import evaluate_equation
+import DistanceEngine
+import ZonalEngine
+import ProjectCache
+import Constraints_Opportunities
+
+
+# how many sets of inputs the FIS tools check against skfuzzy each time they run. skfuzzy takes about a tenth of a
+# second for each set of combined FIS inputs, so the tools only check a small sample
+QUICK_PARITY_SAMPLES = 40
 
 
 class TestException(Exception):
@@ -42,4 +59,447 @@ def report_exceptions(exceptions):
         arcpy.AddMessage("The following exceptions were raised during testing:")
         for exception in exceptions:
             arcpy.AddError(exception)
-            arcpy.AddMessage("")
\ No newline at end of file
+            arcpy.AddMessage("")
+
+def test_comb_fis_parity(input_arrays=None, tolerance=SKFUZZY_TOLERANCE, sample_size=300):
+    """
+    Makes sure that the vectorized combined capacity FIS gives the same output as running the FIS through skfuzzy
+    :param input_arrays: A list of oVC, iHyd_SP2, iHyd_SPLow, and iGeo_Slope arrays to test with. If None, a sample
+        of points on and between the membership function breakpoints is used
+    :param tolerance: The largest difference allowed between the two outputs
+    :param sample_size: How many sets of inputs to sample, if no input arrays are given
+    :return:
+    """
+    comb_fis = Comb_FIS.build_comb_fis()
+    if input_arrays is None:
+        input_arrays = sample_fis_inputs(comb_fis, sample_size)
+
+    check_fis_parity(comb_fis, input_arrays, tolerance, "combined capacity")
+
+
+def test_veg_fis_parity(input_arrays=None, tolerance=SKFUZZY_TOLERANCE, sample_size=300):
+    """
+    Makes sure that the vectorized vegetation FIS gives the same output as running the FIS through skfuzzy
+    :param input_arrays: A list of riparian and streamside vegetation arrays to test with. If None, a sample of points
+        on and between the membership function breakpoints is used
+    :param tolerance: The largest difference allowed between the two outputs
+    :param sample_size: How many sets of inputs to sample, if no input arrays are given
+    :return:
+    """
+    veg_fis = Veg_FIS.build_veg_fis()
+    if input_arrays is None:
+        input_arrays = sample_fis_inputs(veg_fis, sample_size)
+
+    check_fis_parity(veg_fis, input_arrays, tolerance, "vegetation")
+
+
+def sample_fis_inputs(fis, sample_size=300, seed=0):
+    """
+    Picks inputs for testing a FIS, half of them on or between membership function breakpoints, where the FIS is
+    most likely to go wrong, and half of them anywhere in the universe
+    :param fis: The FuzzyInferenceSystem to make inputs for
+    :param sample_size: How many sets of inputs to make
+    :param seed: The seed for the random number generator, so that the test is repeatable
+    :return: A list of arrays, one per input
+    """
+    random = np.random.RandomState(seed)
+    input_arrays = []
+    for variable in fis.inputs:
+        breakpoints = np.unique([point for term in variable.terms for point in term[2]])
+        midpoints = (breakpoints[:-1] + breakpoints[1:]) / 2.0
+        special_points = np.concatenate((breakpoints, midpoints))
+        on_breakpoints = random.choice(special_points, sample_size // 2)
+        anywhere = random.uniform(variable.min_value, variable.max_value, sample_size - sample_size // 2)
+        input_arrays.append(np.concatenate((on_breakpoints, anywhere)))
+    return input_arrays
+
+
+def check_fis_parity(fis, input_arrays, tolerance, fis_name):
+    """
+    Compares the vectorized engine to skfuzzy for a FIS, and raises an exception if they disagree
+    :param fis: The FuzzyInferenceSystem to check
+    :param input_arrays: A list of arrays, one per input
+    :param tolerance: The largest difference allowed between the two outputs
+    :param fis_name: What to call the FIS in the exception
+    :return:
+    """
+    engine_output = fis.evaluate(input_arrays)
+    skfuzzy_output = fis.evaluate_with_skfuzzy(input_arrays)
+    difference = np.abs(engine_output - skfuzzy_output)
+    worst = int(np.argmax(difference))
+    if difference[worst] > tolerance:
+        inputs = ", ".join(str(values[worst]) for values in input_arrays)
+        raise TestException("The vectorized " + fis_name + " FIS differs from skfuzzy by " + str(difference[worst]) +
+                            " for the inputs (" + inputs + ")")
+
+
+def test_equation_engine(da_sqm=None):
+    """
+    Makes sure that compiled streamflow equations give the same output as Python does, and that equations that
+    reach outside of arithmetic, or that can't be calculated in reasonable time, are refused
+    :param da_sqm: An array of drainage areas in square miles to test with. If None, a spread of values is used
+    :return:
+    """
+    if da_sqm is None:
+        da_sqm = np.logspace(-3, 4, 1000).astype(np.float32)
+    variables = {'DAsqm': da_sqm, 'ELEV_FT': 6027.722, 'PRECIP_IN': 23.674}
+
+    equations = ["(DAsqm ** 0.2098) + 1",
+                 "14.7 * (DAsqm ** 0.815)",
+                 "(10**-7.2182) * (DAsqm**1.013) * (ELEV_FT**1.1236) * (PRECIP_IN**1.4483)",
+                 "22.2 * (DAsqm ** 0.608) * ((42 - 40) ** 0.1)"]
+    for equation in equations:
+        expected = eval(equation, {'__builtins__': {}}, dict(variables))
+        if not np.allclose(evaluate_equation(equation, variables, chunk_size=77), expected, rtol=1e-6):
+            raise TestException("The compiled equation \"" + equation + "\" does not match Python's output")
+
+    # a whole number power too large to calculate would hang the tool, so it must be refused too
+    for equation in ["__import__('os').getcwd()", "DAsqm.__class__", "[x for x in DAsqm]", "DAsqm * 9**9**9"]:
+        try:
+            evaluate_equation(equation, variables)
+            refused = False
+        except Exception:
+            refused = True
+        if not refused:
+            raise TestException("The equation \"" + equation + "\" should have been refused")
+
+
+def test_distance_parity(network, feature, buffer, index_folder, buffer_distance=30.0, cache=None):
+    """
+    Makes sure that the distances the distance engine finds along each reach agree with the 5 m Euclidean distance
+    raster BRAT used to find in each reach's buffer. Every cell in a buffer is within the buffer distance of its reach,
+    so the two can't differ by more than that, plus half a cell and half the spacing between points
+    :param network: The stream network, with a ReachID field
+    :param feature: The features to find the distance to
+    :param buffer: The buffers of the network, with a ReachID field
+    :param index_folder: The folder to keep the zonal indexes of the buffers in
+    :param buffer_distance: The distance the buffers reach from the network, in map units
+    :param cache: An optional ProjectCache to keep the distance raster in, so it can be checked again quickly
+    :return:
+    """
+    spacing = DistanceEngine.SAMPLE_SPACING / DistanceEngine.meters_per_unit(network)
+    tolerance = buffer_distance + spacing * (np.sqrt(0.5) + 0.5)
+    reach_ids, vector = DistanceEngine.reach_distances(network, feature, ["MINIMUM", "MAXIMUM", "MEAN"])
+    if vector is None:
+        return
+    raster_ids, raster = DistanceEngine.raster_reach_distances(feature, buffer, ["MINIMUM", "MEAN"], index_folder,
+                                                               cache=cache)
+    order = np.argsort(raster_ids)
+    rows = order[np.clip(np.searchsorted(raster_ids[order], reach_ids), 0, len(raster_ids) - 1)]
+    found = (raster_ids[rows] == reach_ids) & ~np.isnan(vector["MEAN"]) & ~np.isnan(raster["MEAN"][rows])
+
+    min_difference = np.abs(vector["MINIMUM"] - raster["MINIMUM"][rows])[found]
+    mean_outside = np.maximum(vector["MINIMUM"] - tolerance - raster["MEAN"][rows],
+                              raster["MEAN"][rows] - vector["MAXIMUM"] - tolerance)[found]
+    arcpy.AddMessage("The vector and raster distances of " + str(found.sum()) + " reaches differ by " +
+                     str(np.mean(np.abs(vector["MEAN"] - raster["MEAN"][rows])[found])) + " on average")
+    if np.any(min_difference > tolerance) or np.any(mean_outside > 0):
+        raise TestException("The distances from the distance engine differ from the Euclidean distance raster by more "
+                            "than " + str(tolerance) + " for " +
+                            str(np.sum((min_difference > tolerance) | (mean_outside > 0))) + " reaches")
+
+
+def test_constraints_opportunities():
+    """
+    Makes sure that the rule tables of the constraints and opportunities model give the classes they're meant to, for
+    hand-built reaches that each meet one rule. Every reach starts from a base reach that meets no rule but the
+    medium-low restoration strategy, and changes only the fields its rule looks at
+    :return:
+    """
+    base = {'oVC_HPE': 20.0, 'oVC_EX': 20.0, 'oCC_HPE': 2.0, 'oCC_EX': 2.0, 'iGeo_Slope': 0.05, 'mCC_HisDep': 10.0,
+            'iPC_VLowLU': 50.0, 'iPC_HighLU': 50.0, 'oPC_Dist': 1000.0, 'iPC_LU': 0.1, 'iHyd_SPLow': 50.0,
+            'iHyd_SP2': 500.0, 'iPC_Canal': 1000.0}
+    # (changed fields, surveyed dam, conservation area, the classes the reach should get)
+    cases = [
+        ({}, False, False, {'oPBRC_UI': "Negligible Risk", 'oPBRC_UD': "Dam Building Possible", 'oPBRC_CR': "NA",
+                            'DamStrat': "4. Medium-low restoration potential"}),
+        ({'iPC_Canal': 10.0}, False, False, {'oPBRC_UI': "Major Risk", 'oPBRC_CR': "NA"}),
+        ({'oPC_Dist': 20.0, 'oCC_EX': 10.0}, False, False,
+         {'oPBRC_UI': "Major Risk", 'DamStrat': "5. Restoration with infrastructure modification"}),
+        ({'oPC_Dist': 20.0}, False, False, {'oPBRC_UI': "Considerable Risk"}),
+        ({'oPC_Dist': 200.0}, False, False, {'oPBRC_UI': "Minor Risk"}),
+        ({'iPC_LU': 0.5}, False, False,
+         {'oPBRC_UI': "Minor Risk", 'DamStrat': "6. Restoration with urban or agricultural modification"}),
+        ({'oCC_EX': 0.0}, False, False,
+         {'oPBRC_UI': "Negligible Risk", 'oPBRC_UD': "Stream Size Limited", 'DamStrat': "Other"}),
+        ({'oCC_EX': 0.0, 'iHyd_SP2': 3000.0}, False, False, {'oPBRC_UD': "Stream Power Limited"}),
+        ({'oCC_EX': 0.0, 'iPC_LU': 0.5}, False, False,
+         {'oPBRC_UI': "Negligible Risk", 'oPBRC_UD': "Anthropogenically Limited"}),
+        ({'oVC_HPE': 0.0, 'oVC_EX': 5.0}, False, False,
+         {'oPBRC_UD': "Potential Reservoir or Landuse Conversion"}),
+        ({'oVC_HPE': 0.0, 'oVC_EX': 0.0}, False, False, {'oPBRC_UD': "Naturally Vegetation Limited"}),
+        ({'iGeo_Slope': 0.3}, False, False, {'oPBRC_UD': "Slope Limited"}),
+        ({'oCC_EX': 10.0, 'mCC_HisDep': 1.0}, False, False,
+         {'oPBRC_CR': "Easiest - Low-Hanging Fruit", 'DamStrat': "3. High restoration potential"}),
+        ({'oCC_HPE': 10.0, 'iPC_VLowLU': 80.0, 'iPC_HighLU': 5.0, 'mCC_HisDep': 2.0}, False, False,
+         {'oPBRC_CR': "Straight Forward - Quick Return"}),
+        ({'oCC_HPE': 10.0, 'iPC_VLowLU': 80.0, 'iPC_HighLU': 5.0}, False, False,
+         {'oPBRC_CR': "Strategic - Long-Term Investment"}),
+        ({'oCC_HPE': 10.0, 'iPC_VLowLU': 80.0, 'iPC_HighLU': 5.0, 'oPC_Dist': 20.0}, False, False,
+         {'oPBRC_UI': "Considerable Risk", 'oPBRC_CR': "NA"}),
+        ({}, True, False, {'DamStrat': "1. Beaver conservation"}),
+        # a reach without land use isn't over any land use threshold
+        ({'iPC_LU': np.nan}, True, False, {'oPBRC_UI': "Negligible Risk", 'DamStrat': "1. Beaver conservation"}),
+        ({'oCC_EX': 25.0}, False, True, {'DamStrat': "2. Highest restoration potential - translocation"}),
+        ({'oVC_EX': 10.0}, False, False, {'DamStrat': "4a. Vegetation restoration first-priority"}),
+        ({'oCC_EX': 10.0, 'oVC_EX': 10.0}, False, False, {'DamStrat': "3a. Vegetation restoration first-priority"})
+    ]
+
+    columns = dict((field, np.array([case[0].get(field, value) for case in cases], dtype=np.float64))
+                   for field, value in base.items())
+    classes = Constraints_Opportunities.classify_constraints(columns)
+    classes['DamStrat'] = Constraints_Opportunities.classify_dam_strategies(
+        columns, np.array([case[1] for case in cases]), np.array([case[2] for case in cases]),
+        np.zeros(len(cases), dtype=bool))
+    names = dict((field, Constraints_Opportunities.decode_classes(field, codes)) for field, codes in classes.items())
+
+    for i, (changes, obs_dam, cons_area, expected) in enumerate(cases):
+        for field, class_name in sorted(expected.items()):
+            if names[field][i] != class_name:
+                raise TestException("The constraints and opportunities model gave " + field + " a class of \"" +
+                                    str(names[field][i]) + "\" instead of \"" + class_name + "\" for a reach with " +
+                                    str(changes) + ", a surveyed dam " + str(obs_dam) +
+                                    " and a conservation area " + str(cons_area))
+
+
+def test_zonal_engine():
+    """
+    Makes sure that the zonal engine finds the cells in each buffer and their statistics the way checking every cell
+    of the raster one at a time would, on a small made-up raster. The raster is added in blocks of a few rows, and
+    the index is saved and loaded again
+    :return:
+    """
+    grid = ZonalEngine.RasterGrid(100.0, 500.0, 2.0, 2.0, 40, 50)
+    square = np.array([[112.3, 431.7], [171.1, 431.7], [171.1, 487.9], [112.3, 487.9]])
+    hole = np.array([[131.9, 447.3], [150.5, 447.3], [150.5, 470.1], [131.9, 470.1]])
+    triangle = np.array([[160.4, 421.3], [197.7, 440.9], [178.2, 499.1]])
+    edge = np.array([[90.3, 410.7], [107.9, 410.7], [107.9, 451.3], [90.3, 451.3]])
+    outside = np.array([[300.1, 300.1], [310.7, 300.1], [310.7, 310.7]])
+    reach_ids = np.array([4, 1, 7, 3, 9], dtype=np.int64)
+    polygons = [[square, hole], [triangle], [edge], [outside], [square]]
+
+    for subcells in [1, 3]:
+        fine_grid = grid.subdivide(subcells)
+        for rings in polygons:
+            expected = np.flatnonzero(cells_inside(rings, fine_grid))
+            cells = ZonalEngine.polygon_cells(rings, fine_grid)
+            if len(cells) != len(expected) or np.any(cells != expected):
+                raise TestException("The zonal engine found " + str(len(cells)) + " cells in a polygon on a grid split "
+                                    + str(subcells) + " times, instead of " + str(len(expected)))
+
+        index = ZonalEngine.build_zonal_index(reach_ids, polygons, grid, subcells)
+        expected_weights = [cells_inside(rings, fine_grid).reshape(grid.rows, subcells, grid.cols, subcells)
+                            .sum(axis=(1, 3)).ravel() / float(subcells * subcells) for rings in polygons]
+        for i, weights in enumerate(expected_weights):
+            cells = index.cells[index.indptr[i]:index.indptr[i + 1]]
+            if np.any(cells != np.flatnonzero(weights)) or \
+                    np.any(np.abs(index.weights[index.indptr[i]:index.indptr[i + 1]] - weights[cells]) > 1e-12):
+                raise TestException("The zonal index of the buffer of reach " + str(reach_ids[i]) + " split " +
+                                    str(subcells) + " times has the wrong cells or weights")
+
+        random = np.random.RandomState(subcells)
+        values = random.uniform(-50.0, 50.0, (grid.rows, grid.cols))
+        values[random.rand(grid.rows, grid.cols) < 0.2] = np.nan
+        categories = np.floor(random.uniform(-1.0, 3.0, (grid.rows, grid.cols)))
+        categories[np.isnan(values)] = np.nan
+        stat_accumulator = ZonalEngine.ZonalAccumulator(index, ZonalEngine.ZONAL_STATS)
+        category_accumulator = ZonalEngine.ZonalAccumulator(index, [ZonalEngine.HISTOGRAM], 3)
+        for first_row in range(0, grid.rows, 7):
+            stat_accumulator.add_block(first_row, 0, values[first_row:first_row + 7])
+            category_accumulator.add_block(first_row, 0, categories[first_row:first_row + 7])
+        results = stat_accumulator.results()
+        shares = category_accumulator.results()[ZonalEngine.HISTOGRAM]
+
+        for i, weights in enumerate(expected_weights):
+            weights = weights.reshape(grid.rows, grid.cols)
+            has_data = (weights > 0) & ~np.isnan(values)
+            expected = {"COUNT": float(has_data.sum()), "MINIMUM": np.nan, "MAXIMUM": np.nan, "MEAN": np.nan}
+            expected_shares = np.empty(3, dtype=np.float64)
+            expected_shares.fill(np.nan)
+            if has_data.any():
+                expected["MINIMUM"] = values[has_data].min()
+                expected["MAXIMUM"] = values[has_data].max()
+                expected["MEAN"] = np.sum(values[has_data] * weights[has_data]) / np.sum(weights[has_data])
+                expected_shares = np.array([np.sum(weights[categories == category]) for category in range(3)]) / \
+                    weights.sum()
+            for stat_type in ZonalEngine.ZONAL_STATS:
+                if not values_match(results[stat_type][i], expected[stat_type]):
+                    raise TestException("The zonal engine found a " + stat_type + " of " + str(results[stat_type][i]) +
+                                        " in the buffer of reach " + str(reach_ids[i]) + " instead of " +
+                                        str(expected[stat_type]))
+            if not all(values_match(share, expected_share) for share, expected_share in zip(shares[i],
+                                                                                            expected_shares)):
+                raise TestException("The zonal engine found category shares of " + str(shares[i]) +
+                                    " in the buffer of reach " + str(reach_ids[i]) + " instead of " +
+                                    str(expected_shares))
+
+    key = ZonalEngine.index_key(reach_ids, polygons, grid)
+    moved = [[square, hole], [triangle + 0.5], [edge], [outside], [square]]
+    other_keys = [ZonalEngine.index_key(reach_ids, polygons, grid, 3),
+                  ZonalEngine.index_key(reach_ids, moved, grid),
+                  ZonalEngine.index_key(reach_ids[::-1], polygons, grid),
+                  ZonalEngine.index_key(reach_ids, polygons, ZonalEngine.RasterGrid(100.0, 500.0, 2.0, 2.0, 40, 51))]
+    if ZonalEngine.index_key(reach_ids, list(polygons), grid) != key or key in other_keys:
+        raise TestException("The zonal index key doesn't change with exactly the buffers, grid and subcells")
+
+    folder = tempfile.mkdtemp()
+    try:
+        index_path = os.path.join(folder, "ZonalIndex_" + key + ".npz")
+        index.save(index_path)
+        loaded = ZonalEngine.load_zonal_index(index_path, grid)
+        if loaded is None or any(np.any(getattr(loaded, name) != getattr(index, name))
+                                 for name in ["reach_ids", "indptr", "cells", "weights"]):
+            raise TestException("The zonal index loaded from " + index_path + " differs from the one saved")
+        if ZonalEngine.load_zonal_index(index_path, grid.subdivide(2)) is not None:
+            raise TestException("A zonal index saved on one grid was loaded for another")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def cells_inside(rings, grid):
+    """
+    Finds which cells of a grid have their center inside a polygon, by counting how many of the polygon's edges a line
+    from each center to the right crosses
+    :param rings: A list of arrays of (x, y) vertices
+    :param grid: The RasterGrid to check the cells of
+    :return: An array of booleans, with one for each cell in flat index order
+    """
+    rows, cols = np.divmod(np.arange(grid.rows * grid.cols), grid.cols)
+    x = grid.x_min + (cols + 0.5) * grid.cell_width
+    y = grid.y_max - (rows + 0.5) * grid.cell_height
+    inside = np.zeros(len(x), dtype=bool)
+    for ring in rings:
+        for (x1, y1), (x2, y2) in zip(ring, np.roll(ring, -1, axis=0)):
+            if y1 == y2:
+                continue
+            crosses = ((y1 > y) != (y2 > y)) & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+            inside ^= crosses
+    return inside
+
+
+def values_match(value, expected, tolerance=1e-9):
+    """
+    Checks a value against the value it should be, where NaN is only matched by NaN
+    :param value: The value found
+    :param expected: The value it should be
+    :param tolerance: How far apart they can be
+    :return: True if they match
+    """
+    if np.isnan(expected):
+        return bool(np.isnan(value))
+    return abs(value - expected) <= tolerance
+
+
+def test_point_windows():
+    """
+    Makes sure that the statistics of the cells around each point agree with checking the distance to every cell of a
+    small made-up raster, whether the points are read as one block or as many small ones
+    :return:
+    """
+    grid = ZonalEngine.RasterGrid(100.0, 500.0, 2.0, 3.0, 60, 45)
+    random = np.random.RandomState(0)
+    values = random.uniform(-50.0, 50.0, (grid.rows, grid.cols))
+    values[random.rand(grid.rows, grid.cols) < 0.2] = np.nan
+    x = np.concatenate([random.uniform(90.0, 200.0, 200), [101.1, 189.9, 50.0, np.nan]])
+    y = np.concatenate([random.uniform(310.0, 510.0, 200), [499.2, 320.3, 400.0, 400.0]])
+    radius = 7.5
+
+    rows, cols = np.divmod(np.arange(grid.rows * grid.cols), grid.cols)
+    center_x = grid.x_min + (cols + 0.5) * grid.cell_width
+    center_y = grid.y_max - (rows + 0.5) * grid.cell_height
+    has_data = ~np.isnan(values.ravel())
+    expected = dict((stat_type, np.empty(len(x), dtype=np.float64)) for stat_type in ZonalEngine.ZONAL_STATS)
+    for stat_type in ZonalEngine.ZONAL_STATS:
+        expected[stat_type].fill(np.nan)
+    for i in range(len(x)):
+        with np.errstate(invalid='ignore'):
+            inside = ((center_x - x[i]) ** 2 + (center_y - y[i]) ** 2 <= radius * radius) & has_data
+        window_values = values.ravel()[inside]
+        expected["COUNT"][i] = len(window_values)
+        if len(window_values) > 0:
+            expected["MINIMUM"][i] = window_values.min()
+            expected["MAXIMUM"][i] = window_values.max()
+            expected["MEAN"][i] = window_values.mean()
+
+    def read_window(window):
+        row_start, row_stop, col_start, col_stop = window
+        if row_start < 0 or col_start < 0 or row_stop > grid.rows or col_stop > grid.cols:
+            raise TestException("The point windows read the cells " + str(window) + ", which are off the raster")
+        return row_start, values[row_start:row_stop]
+
+    for block_cells in [ZonalEngine.BLOCK_CELLS, 400]:
+        results = ZonalEngine.grid_window_statistics(grid, read_window, x, y, radius, ZonalEngine.ZONAL_STATS,
+                                                     block_cells)
+        for stat_type in ZonalEngine.ZONAL_STATS:
+            for i in range(len(x)):
+                if not values_match(results[stat_type][i], expected[stat_type][i]):
+                    raise TestException("The point windows found a " + stat_type + " of " +
+                                        str(results[stat_type][i]) + " around (" + str(x[i]) + ", " + str(y[i]) +
+                                        ") instead of " + str(expected[stat_type][i]) + ", reading " +
+                                        str(block_cells) + " cells at a time")
+
+
+def test_project_cache():
+    """
+    Makes sure that the project cache reuses an entry made from the same inputs and parameters, makes a new one when
+    they change, keeps every entry used in a session until it ends, and then deletes the entries used least recently
+    until it fits in its size limit, in a throwaway folder of small rasters
+    :return:
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        inputs = [os.path.join(folder, "Input.tif"), os.path.join(folder, "OtherInput.tif")]
+        save_test_raster(inputs[0], 1.0)
+        save_test_raster(inputs[1], 2.0)
+        created = []
+
+        def create(output):
+            save_test_raster(output, len(created))
+            created.append(output)
+
+        cache_folder = os.path.join(folder, "Cache")
+        cache = ProjectCache.ProjectCache(cache_folder)
+        key = cache.key("Test", inputs[:1], {"n": 1})
+        other_keys = [cache.key("Test", inputs[:1], {"n": 2}), cache.key("Other", inputs[:1], {"n": 1}),
+                      cache.key("Test", inputs[1:], {"n": 1}), cache.key("Test", inputs, {"n": 1})]
+        if cache.key("Test", inputs[:1], {"n": 1}) != key or key in other_keys or \
+                len(set(other_keys)) != len(other_keys):
+            raise TestException("The project cache key doesn't change with exactly the operation, inputs and "
+                                "parameters")
+
+        first = cache.fetch("Test", inputs[:1], {"n": 1}, create)
+        if cache.fetch("Test", inputs[:1], {"n": 1}, create) != first or len(created) != 1:
+            raise TestException("The project cache made an entry again instead of reusing it")
+
+        # room for one entry, but both are used in this session, so neither is deleted until it ends
+        cache.max_bytes = cache.entries[key]["bytes"] * 3 // 2
+        second = cache.fetch("Test", inputs[:1], {"n": 2}, create)
+        if len(created) != 2 or not arcpy.Exists(first) or not arcpy.Exists(second):
+            raise TestException("The project cache deleted an entry used in this session")
+        cache.end_session()
+        if arcpy.Exists(first) or not arcpy.Exists(second) or len(cache.entries) != 1:
+            raise TestException("The project cache didn't delete the entry used least recently at the end of its "
+                                "session")
+
+        # a cache opened again finds the entries kept in its manifest
+        cache = ProjectCache.ProjectCache(cache_folder, cache.max_bytes)
+        if cache.fetch("Test", inputs[:1], {"n": 2}, create) != second or len(created) != 2:
+            raise TestException("The project cache didn't reuse an entry made in an earlier session")
+        third = cache.fetch("Test", inputs[:1], {"n": 3}, create)
+        cache.end_session()
+        if arcpy.Exists(second) or not arcpy.Exists(third) or len(created) != 3:
+            raise TestException("The project cache didn't delete the entry used least recently at the end of its "
+                                "session")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def save_test_raster(output, value):
+    """
+    Saves a small raster with a gradient of values, for tests that need raster files
+    :param output: The path to save the raster to
+    :param value: The value the gradient starts from
+    :return:
+    """
+    array = float(value) + np.arange(100, dtype=np.float32).reshape(10, 10)
+    arcpy.NumPyArrayToRaster(array, arcpy.Point(0.0, 0.0), 1.0, 1.0).save(output)
@@ -0,0 +1,780 @@
+# -------------------------------------------------------------------------------
+# Name:        Zonal Engine
+# Purpose:     Finds statistics of the raster cells inside each reach's buffer, from a sparse index of the cells in
+#              every buffer that is built once per network and raster grid
+#
+# Created:     10/2026
+# -------------------------------------------------------------------------------
+
+import arcpy
+import hashlib
+import numpy as np
+import os
+
+# the version of the saved zonal index files. Indexes saved by another version are built again
+INDEX_VERSION = 1
+
+# the statistics that can be found, named as ZonalStatisticsAsTable names them
+ZONAL_STATS = ["MINIMUM", "MAXIMUM", "MEAN", "COUNT"]
+
+# the statistic that finds the share of each buffer covered by each of a list of categories, the way TabulateArea does
+HISTOGRAM = "HISTOGRAM"
+
+# about how many raster cells are read at a time
+BLOCK_CELLS = 4 * 1024 * 1024
+
+
+class RasterGrid(object):
+    def __init__(self, x_min, y_max, cell_width, cell_height, rows, cols, spatial_reference=""):
+        """
+        The layout of a raster's cells
+        :param x_min: The x coordinate of the left edge of the raster
+        :param y_max: The y coordinate of the top edge of the raster
+        :param cell_width: The width of a cell, in map units
+        :param cell_height: The height of a cell, in map units
+        :param rows: The number of rows of cells
+        :param cols: The number of columns of cells
+        :param spatial_reference: The name of the raster's spatial reference
+        """
+        self.x_min = float(x_min)
+        self.y_max = float(y_max)
+        self.cell_width = float(cell_width)
+        self.cell_height = float(cell_height)
+        self.rows = int(rows)
+        self.cols = int(cols)
+        self.spatial_reference = spatial_reference
+
+    def key(self):
+        """
+        Describes the grid as text, so that indexes built on the same grid can be found again
+        :return: A string
+        """
+        return "%r %r %r %r %d %d %s" % (self.x_min, self.y_max, self.cell_width, self.cell_height, self.rows,
+                                         self.cols, self.spatial_reference)
+
+    def subdivide(self, subcells):
+        """
+        Makes the grid with each cell split into subcells x subcells smaller cells
+        :param subcells: How many times to split each cell along each side
+        :return: A RasterGrid
+        """
+        return RasterGrid(self.x_min, self.y_max, self.cell_width / subcells, self.cell_height / subcells,
+                          self.rows * subcells, self.cols * subcells, self.spatial_reference)
+
+
+class ZonalIndex(object):
+    def __init__(self, reach_ids, indptr, cells, weights, grid):
+        """
+        A sparse matrix with a row for each reach's buffer and a column for each cell of a raster grid, holding how
+        much of each cell is inside the buffer. It's stored as compressed rows, so the cells of reach i are
+        cells[indptr[i]:indptr[i + 1]]
+        :param reach_ids: An array of the ReachID of each row
+        :param indptr: An array of where each reach's cells start, with one more value than there are reaches
+        :param cells: An array of the flat index (row * cols + col) of each cell in a buffer
+        :param weights: An array of the share of each cell that is inside its buffer
+        :param grid: The RasterGrid the cells are on
+        """
+        self.reach_ids = np.asarray(reach_ids, np.int64)
+        self.indptr = np.asarray(indptr, np.int64)
+        self.cells = np.asarray(cells, np.int64)
+        self.weights = np.asarray(weights, np.float64)
+        self.grid = grid
+
+    def window(self):
+        """
+        Finds the smallest block of the raster that holds every indexed cell, so that only it needs to be read
+        :return: A (row start, row stop, column start, column stop) tuple
+        """
+        if len(self.cells) == 0:
+            return 0, 0, 0, 0
+        rows, cols = np.divmod(self.cells, self.grid.cols)
+        return int(rows.min()), int(rows.max()) + 1, int(cols.min()), int(cols.max()) + 1
+
+    def save(self, file_path):
+        """
+        Saves the index, so that it can be loaded instead of built again
+        :param file_path: The .npz file to save to
+        :return:
+        """
+        grid = self.grid
+        np.savez(file_path, version=INDEX_VERSION, reach_ids=self.reach_ids, indptr=self.indptr, cells=self.cells,
+                 weights=self.weights, grid=np.array([grid.x_min, grid.y_max, grid.cell_width, grid.cell_height,
+                                                      grid.rows, grid.cols], dtype=np.float64))
+
+
+class ZonalAccumulator(object):
+    def __init__(self, index, stat_types, category_count=0):
+        """
+        Gathers statistics of the cells in each reach's buffer as the blocks of a raster are read, so that several
+        indexes can share one scan of a raster
+        :param index: The ZonalIndex of the buffers
+        :param stat_types: A list of statistics, from ZONAL_STATS, or HISTOGRAM if there are categories
+        :param category_count: How many categories the HISTOGRAM has. Its cell values are the index of each cell's
+            category, or -1 for cells with data in none of them
+        """
+        for stat_type in stat_types:
+            if stat_type not in ZONAL_STATS and not (stat_type == HISTOGRAM and category_count > 0):
+                raise Exception("Unknown zonal statistic \"" + str(stat_type) + "\". Options are " +
+                                ", ".join(ZONAL_STATS + ([HISTOGRAM] if category_count > 0 else [])))
+        self.index = index
+        self.stat_types = list(stat_types)
+        reach_count = len(index.reach_ids)
+        self.counts = np.zeros(reach_count, dtype=np.int64)
+        self.weight_sums = np.zeros(reach_count, dtype=np.float64)
+        self.value_sums = np.zeros(reach_count, dtype=np.float64)
+        self.minimums = np.empty(reach_count, dtype=np.float64)
+        self.minimums.fill(np.inf)
+        self.maximums = np.empty(reach_count, dtype=np.float64)
+        self.maximums.fill(-np.inf)
+
+        # the entries of every reach in order of their cell, so each block's entries are one slice
+        self.entry_reaches = np.repeat(np.arange(reach_count), np.diff(index.indptr))
+
+        # the weight of each category in each buffer, and of each whole buffer, which the shares are taken of
+        self.category_count = category_count
+        if category_count > 0:
+            self.category_weights = np.zeros(reach_count * category_count, dtype=np.float64)
+            self.buffer_weights = np.bincount(self.entry_reaches, index.weights, minlength=reach_count)
+        self.cell_order = np.argsort(index.cells, kind='mergesort')
+        self.cell_rows, self.cell_cols = np.divmod(index.cells[self.cell_order], index.grid.cols)
+
+    def add_block(self, first_row, first_col, values):
+        """
+        Adds the cells of a block of whole rows of the raster
+        :param first_row: The grid row of the first row of the block
+        :param first_col: The grid column of the first column of the block, which must be at or before the index's
+            window
+        :param values: An array of the block's values, with NaN where there is no data
+        :return:
+        """
+        start, stop = np.searchsorted(self.cell_rows, [first_row, first_row + values.shape[0]])
+        if start == stop:
+            return
+        cell_values = values[self.cell_rows[start:stop] - first_row, self.cell_cols[start:stop] - first_col]
+        has_data = ~np.isnan(cell_values)
+        entries = self.cell_order[start:stop][has_data]
+        cell_values = cell_values[has_data]
+        if len(entries) == 0:
+            return
+
+        reach_count = len(self.counts)
+        entry_reaches = self.entry_reaches[entries]
+        weights = self.index.weights[entries]
+        self.counts += np.bincount(entry_reaches, minlength=reach_count)
+        self.weight_sums += np.bincount(entry_reaches, weights, minlength=reach_count)
+        self.value_sums += np.bincount(entry_reaches, weights * cell_values, minlength=reach_count)
+        if self.category_count > 0:
+            categories = cell_values.astype(np.int64)
+            in_category = categories >= 0
+            self.category_weights += np.bincount(entry_reaches[in_category] * self.category_count +
+                                                 categories[in_category], weights[in_category],
+                                                 minlength=len(self.category_weights))
+
+        # group the block's values by reach, to find each reach's minimum and maximum in the block
+        reach_order = np.argsort(entry_reaches, kind='mergesort')
+        entry_reaches = entry_reaches[reach_order]
+        cell_values = cell_values[reach_order]
+        group_starts = np.flatnonzero(np.concatenate(([True], entry_reaches[1:] != entry_reaches[:-1])))
+        group_reaches = entry_reaches[group_starts]
+        self.minimums[group_reaches] = np.minimum(self.minimums[group_reaches],
+                                                  np.minimum.reduceat(cell_values, group_starts))
+        self.maximums[group_reaches] = np.maximum(self.maximums[group_reaches],
+                                                  np.maximum.reduceat(cell_values, group_starts))
+
+    def results(self):
+        """
+        Finds the statistics of the blocks added so far
+        :return: A dictionary of arrays with the statistic of each reach, keyed by statistic. HISTOGRAM is a 2D array
+            with a row for each reach and the share of its buffer in each category. Reaches with no cells with data
+            are NaN, except for COUNT, which is 0
+        """
+        covered = self.weight_sums > 0
+        results = {}
+        for stat_type in self.stat_types:
+            if stat_type == "COUNT":
+                results[stat_type] = self.counts.astype(np.float64)
+                continue
+            if stat_type == HISTOGRAM:
+                shares = np.empty((len(self.counts), self.category_count), dtype=np.float64)
+                shares.fill(np.nan)
+                shares[covered] = self.category_weights.reshape(shares.shape)[covered] / \
+                    self.buffer_weights[covered, None]
+                results[stat_type] = shares
+                continue
+            result = np.empty(len(self.counts), dtype=np.float64)
+            result.fill(np.nan)
+            if stat_type == "MEAN":
+                result[covered] = self.value_sums[covered] / self.weight_sums[covered]
+            elif stat_type == "MINIMUM":
+                result[covered] = self.minimums[covered]
+            elif stat_type == "MAXIMUM":
+                result[covered] = self.maximums[covered]
+            results[stat_type] = result
+        return results
+
+
+class ZonalRequest(object):
+    def __init__(self, buffer, raster, stat_types, field=None, subcells=1, categories=None):
+        """
+        Statistics to find of a raster in each of a set of buffers
+        :param buffer: A polygon feature class of buffers, with a ReachID field
+        :param raster: The path to a raster, or a Raster object
+        :param stat_types: A list of statistics, from ZONAL_STATS, or HISTOGRAM if categories are given
+        :param field: A field of the raster's attribute table to use the values of instead of the cell values, the
+            way Lookup does
+        :param subcells: How many times each cell is split along each side to find how much of it is in a buffer
+        :param categories: A list of values of the field (or of the cells, if there is no field) to find the share of
+            each buffer covered by, for HISTOGRAM
+        """
+        self.buffer = buffer
+        self.raster = raster
+        self.stat_types = list(stat_types)
+        self.field = field
+        self.subcells = subcells
+        self.categories = list(categories) if categories is not None else None
+
+    def values_key(self):
+        """
+        Finds the key of the values this request reads, so requests with the same field and categories share them
+        :return: A tuple of the field and the categories
+        """
+        return self.field, tuple(self.categories) if self.categories is not None else None
+
+
+def load_zonal_index(file_path, grid):
+    """
+    Loads an index saved by ZonalIndex.save()
+    :param file_path: The saved index
+    :param grid: The RasterGrid the index is expected to be on
+    :return: A ZonalIndex, or None if the file was saved by another version or on another grid
+    """
+    saved = np.load(file_path)
+    if "version" not in saved.files or int(saved["version"]) != INDEX_VERSION:
+        return None
+    saved_grid = RasterGrid(*saved["grid"], spatial_reference=grid.spatial_reference)
+    if saved_grid.key() != grid.key():
+        return None
+    return ZonalIndex(saved["reach_ids"], saved["indptr"], saved["cells"], saved["weights"], grid)
+
+
+def raster_grid(raster):
+    """
+    Gets the layout of a raster's cells
+    :param raster: The path to a raster, or a Raster object
+    :return: A RasterGrid
+    """
+    raster = arcpy.Raster(str(raster))
+    return RasterGrid(raster.extent.XMin, raster.extent.YMax, raster.meanCellWidth, raster.meanCellHeight,
+                      raster.height, raster.width, raster.spatialReference.name)
+
+
+def read_polygons(feature_class, densify_distance=None):
+    """
+    Reads the rings of every polygon in a feature class
+    :param feature_class: A polygon feature class with a ReachID field
+    :param densify_distance: How far apart to put vertices along true curves, which are otherwise read as their
+        end points only
+    :return: An array of ReachIDs, and a list with a list of rings for each polygon. Each ring is an array of
+        (x, y) vertices
+    """
+    reach_ids = []
+    polygons = []
+    with arcpy.da.SearchCursor(feature_class, ['ReachID', 'SHAPE@']) as cursor:
+        for reach_id, shape in cursor:
+            rings = []
+            if shape is not None:
+                if densify_distance and getattr(shape, 'hasCurves', False):
+                    shape = shape.densify("DISTANCE", densify_distance)
+                for part in shape:
+                    ring = []
+                    for point in part:
+                        # the rings of a part are separated by None
+                        if point is None:
+                            if len(ring) > 0:
+                                rings.append(np.array(ring, dtype=np.float64))
+                            ring = []
+                        else:
+                            ring.append((point.X, point.Y))
+                    if len(ring) > 0:
+                        rings.append(np.array(ring, dtype=np.float64))
+            reach_ids.append(reach_id)
+            polygons.append(rings)
+    return np.array(reach_ids, dtype=np.int64), polygons
+
+
+def polygon_cells(rings, grid):
+    """
+    Finds the cells of a grid whose centers are inside a polygon, the same way the Spatial Analyst tools rasterize
+    zones. Each row of cells is scanned across, and cells are inside between every other crossing of the polygon's
+    edges, so holes are left out
+    :param rings: A list of arrays of (x, y) vertices
+    :param grid: The RasterGrid to find cells on
+    :return: An array of the flat index of each cell, in increasing order
+    """
+    rings = [ring for ring in rings if len(ring) > 2]
+    if len(rings) == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.concatenate([ring for ring in rings])
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    x1, y1 = starts[:, 0], starts[:, 1]
+    x2, y2 = ends[:, 0], ends[:, 1]
+
+    # the rows whose cell centers are within the polygon's extent
+    first_row = max(int(np.ceil((grid.y_max - max(y1.max(), y2.max())) / grid.cell_height - 0.5)), 0)
+    last_row = min(int(np.floor((grid.y_max - min(y1.min(), y2.min())) / grid.cell_height - 0.5)), grid.rows - 1)
+    if last_row < first_row:
+        return np.zeros(0, dtype=np.int64)
+    rows = np.arange(first_row, last_row + 1)
+    y = (grid.y_max - (rows + 0.5) * grid.cell_height)[:, np.newaxis]
+
+    crosses = (y1 > y) != (y2 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = np.where(crosses, x1 + (y - y1) * (x2 - x1) / (y2 - y1), np.inf)
+    crossings.sort(axis=1)
+
+    # cell c is inside a span if its center, x_min + (c + 0.5) * cell_width, is from the span's start up to its end
+    run_rows = []
+    run_starts = []
+    run_stops = []
+    for k in range(0, int(crosses.sum(axis=1).max()), 2):
+        lefts, rights = crossings[:, k], crossings[:, k + 1]
+        spans = np.isfinite(rights)
+        col_starts = np.ceil((lefts[spans] - grid.x_min) / grid.cell_width - 0.5)
+        col_stops = np.ceil((rights[spans] - grid.x_min) / grid.cell_width - 0.5)
+        run_rows.append(rows[spans])
+        run_starts.append(np.clip(col_starts, 0, grid.cols).astype(np.int64))
+        run_stops.append(np.clip(col_stops, 0, grid.cols).astype(np.int64))
+    if len(run_rows) == 0:
+        return np.zeros(0, dtype=np.int64)
+    run_rows = np.concatenate(run_rows)
+    run_starts = np.concatenate(run_starts)
+    lengths = np.maximum(np.concatenate(run_stops) - run_starts, 0)
+
+    run_offsets = np.cumsum(lengths) - lengths
+    cols = np.repeat(run_starts - run_offsets, lengths) + np.arange(lengths.sum())
+    cells = np.repeat(run_rows, lengths) * grid.cols + cols
+    cells.sort()
+    return cells
+
+
+def build_zonal_index(reach_ids, polygons, grid, subcells=1):
+    """
+    Builds the index of which cells are in each reach's buffer
+    :param reach_ids: An array of the ReachID of each polygon
+    :param polygons: A list with a list of rings for each polygon, as given by read_polygons()
+    :param grid: The RasterGrid of the rasters the index will be used with
+    :param subcells: How many times each cell is split along each side to find how much of it is in a buffer. With
+        1, a cell is entirely in a buffer if its center is, which matches ZonalStatisticsAsTable
+    :return: A ZonalIndex
+    """
+    subcells = int(subcells)
+    fine_grid = grid.subdivide(subcells) if subcells > 1 else grid
+    indptr = [0]
+    all_cells = []
+    all_weights = []
+    for rings in polygons:
+        cells = polygon_cells(rings, fine_grid)
+        if subcells > 1:
+            fine_rows, fine_cols = np.divmod(cells, fine_grid.cols)
+            cells, counts = np.unique((fine_rows // subcells) * grid.cols + fine_cols // subcells,
+                                      return_counts=True)
+            weights = counts / float(subcells * subcells)
+        else:
+            weights = np.ones(len(cells), dtype=np.float64)
+        all_cells.append(cells)
+        all_weights.append(weights)
+        indptr.append(indptr[-1] + len(cells))
+
+    if len(all_cells) == 0:
+        return ZonalIndex(reach_ids, indptr, [], [], grid)
+    return ZonalIndex(reach_ids, indptr, np.concatenate(all_cells), np.concatenate(all_weights), grid)
+
+
+def index_key(reach_ids, polygons, grid, subcells=1):
+    """
+    Finds a hash of everything an index is built from, so that a saved index is only reused for the same buffers on
+    the same grid
+    :param reach_ids: An array of the ReachID of each polygon
+    :param polygons: A list with a list of rings for each polygon
+    :param grid: The RasterGrid the index is built on
+    :param subcells: How many times each cell is split along each side
+    :return: A hex string
+    """
+    key = hashlib.md5()
+    key.update((str(INDEX_VERSION) + " " + grid.key() + " " + str(subcells)).encode('utf-8'))
+    key.update(np.ascontiguousarray(reach_ids, np.int64))
+    for rings in polygons:
+        key.update(str(len(rings)).encode('utf-8'))
+        for ring in rings:
+            key.update(np.ascontiguousarray(ring, np.float64))
+    return key.hexdigest()
+
+
+def zonal_index(buffer, raster, index_folder, subcells=1):
+    """
+    Gets the index of which cells of a raster's grid are in each buffer. It's loaded from the index folder if it has
+    already been built for these buffers on this grid, so rasters that share a grid share an index
+    :param buffer: A polygon feature class of buffers, with a ReachID field
+    :param raster: The raster the index will be used with
+    :param index_folder: The folder that indexes are saved in
+    :param subcells: How many times each cell is split along each side to find how much of it is in a buffer
+    :return: A ZonalIndex
+    """
+    grid = raster_grid(raster)
+    reach_ids, polygons = read_polygons(buffer, min(grid.cell_width, grid.cell_height) / 2)
+    key = index_key(reach_ids, polygons, grid, subcells)
+    index_path = os.path.join(index_folder, "ZonalIndex_" + key + ".npz")
+    if os.path.exists(index_path):
+        index = load_zonal_index(index_path, grid)
+        if index is not None:
+            return index
+
+    index = build_zonal_index(reach_ids, polygons, grid, subcells)
+    index.save(index_path)
+    return index
+
+
+def read_raster_blocks(raster, grid, window, block_cells=BLOCK_CELLS):
+    """
+    Reads a window of a raster a block of rows at a time. The raster is read with GDAL if it's installed and can open
+    the raster, and with arcpy if not
+    :param raster: The path to a raster, or a Raster object
+    :param grid: The RasterGrid of the raster
+    :param window: A (row start, row stop, column start, column stop) tuple
+    :param block_cells: About how many cells to read at a time
+    :return: A generator of (first row, array of values) tuples. The arrays are float64, with NaN where the raster has
+        no data
+    """
+    row_start, row_stop, col_start, col_stop = window
+    if row_stop <= row_start or col_stop <= col_start:
+        return
+    block_rows = max(1, int(block_cells) // (col_stop - col_start))
+    dataset = gdal_dataset(raster, grid)
+    if dataset is not None:
+        band = dataset.GetRasterBand(1)
+        no_data = band.GetNoDataValue()
+    else:
+        raster = arcpy.Raster(str(raster))
+        no_data = raster.noDataValue
+
+    for first_row in range(row_start, row_stop, block_rows):
+        rows = min(block_rows, row_stop - first_row)
+        if dataset is not None:
+            array = band.ReadAsArray(col_start, first_row, col_stop - col_start, rows)
+        else:
+            lower_left = arcpy.Point(grid.x_min + col_start * grid.cell_width,
+                                     grid.y_max - (first_row + rows) * grid.cell_height)
+            array = arcpy.RasterToNumPyArray(raster, lower_left, col_stop - col_start, rows)
+        values = array.astype(np.float64)
+        if no_data is not None:
+            values[array == no_data] = np.nan
+        yield first_row, values
+
+
+def gdal_dataset(raster, grid):
+    """
+    Opens a raster with GDAL, if GDAL is installed and lays the raster out on the same grid as arcpy
+    :param raster: The path to a raster, or a Raster object
+    :param grid: The RasterGrid arcpy gives for the raster
+    :return: A GDAL dataset, or None if the raster should be read with arcpy
+    """
+    try:
+        from osgeo import gdal
+    except ImportError:
+        return None
+    dataset = gdal.Open(str(raster))
+    if dataset is None:
+        return None
+    x_min, cell_width, x_skew, y_max, y_skew, cell_height = dataset.GetGeoTransform()
+    tolerance = grid.cell_width * 1e-6
+    if x_skew != 0 or y_skew != 0 or dataset.RasterXSize != grid.cols or dataset.RasterYSize != grid.rows or \
+            abs(x_min - grid.x_min) > tolerance or abs(y_max - grid.y_max) > tolerance or \
+            abs(cell_width - grid.cell_width) > tolerance or abs(-cell_height - grid.cell_height) > tolerance:
+        return None
+    return dataset
+
+
+def read_attribute_table(raster, field):
+    """
+    Reads the values of a field of a raster's attribute table, for each cell value
+    :param raster: The path to a raster, or a Raster object
+    :param field: The name of the field, in any case
+    :return: A list of cell values, and a list of the field's value for each
+    """
+    fields = dict((f.name.upper(), f.name) for f in arcpy.ListFields(str(raster)))
+    if field.upper() not in fields:
+        raise Exception("The raster " + str(raster) + " has no field named \"" + field + "\" in its attribute table")
+    cell_values = []
+    field_values = []
+    with arcpy.da.SearchCursor(str(raster), [fields.get("VALUE", "Value"), fields[field.upper()]]) as cursor:
+        for cell_value, field_value in cursor:
+            cell_values.append(cell_value)
+            field_values.append(field_value)
+    return cell_values, field_values
+
+
+def attribute_lookup(raster, field):
+    """
+    Reads the values of a numeric field of a raster's attribute table, for each cell value
+    :param raster: The path to a raster, or a Raster object
+    :param field: The name of the field, in any case
+    :return: A sorted array of cell values, and an array of the field's value for each, which is NaN where the field
+        is empty
+    """
+    cell_values, field_values = read_attribute_table(raster, field)
+    field_values = [np.nan if field_value is None else field_value for field_value in field_values]
+    order = np.argsort(cell_values)
+    return np.asarray(cell_values, np.float64)[order], np.asarray(field_values, np.float64)[order]
+
+
+def category_lookup(raster, field, categories):
+    """
+    Finds the category of each cell value, from a field of a raster's attribute table or from the cell values
+    themselves
+    :param raster: The path to a raster, or a Raster object
+    :param field: The name of the field, in any case, or None to use the cell values
+    :param categories: A list of the values of the field that are categories
+    :return: A sorted array of cell values, and an array of the index of each one's category, which is -1 for cells
+        in none of them
+    """
+    if field is None:
+        cell_values = list(categories)
+        field_values = list(categories)
+    else:
+        cell_values, field_values = read_attribute_table(raster, field)
+    category_indexes = [categories.index(field_value) if field_value in categories else -1
+                        for field_value in field_values]
+    order = np.argsort(cell_values)
+    return np.asarray(cell_values, np.float64)[order], np.asarray(category_indexes, np.float64)[order]
+
+
+def map_values(values, lookup, missing=np.nan):
+    """
+    Replaces cell values with the values of a raster attribute table field. NaN stays NaN
+    :param values: An array of cell values
+    :param lookup: A tuple of a sorted array of cell values and an array of field values, from attribute_lookup()
+    :param missing: The value given to values that aren't in the table
+    :return: An array of field values
+    """
+    cell_values, field_values = lookup
+    mapped = np.empty(values.shape, dtype=np.float64)
+    mapped.fill(missing)
+    mapped[np.isnan(values)] = np.nan
+    if len(cell_values) == 0:
+        return mapped
+    positions = np.clip(np.searchsorted(cell_values, values), 0, len(cell_values) - 1)
+    found = cell_values[positions] == values
+    mapped[found] = field_values[positions[found]]
+    return mapped
+
+
+def run_zonal_requests(requests, index_folder):
+    """
+    Finds the statistics of several rasters in several sets of buffers. Each raster is read once, in blocks, however
+    many buffer sets and statistics it's needed for
+    :param requests: A list of ZonalRequests
+    :param index_folder: The folder that indexes are saved in
+    :return: A list with an (array of ReachIDs, dictionary of arrays keyed by statistic) tuple for each request.
+        Buffers with no cells with data are NaN, except for COUNT, which is 0
+    """
+    results = [None] * len(requests)
+    rasters = []
+    for request in requests:
+        if str(request.raster) not in rasters:
+            rasters.append(str(request.raster))
+
+    for raster in rasters:
+        raster_requests = [i for i, request in enumerate(requests) if str(request.raster) == raster]
+        grid = raster_grid(raster)
+        accumulators = {}
+        lookups = {}
+        for i in raster_requests:
+            request = requests[i]
+            index = zonal_index(request.buffer, raster, index_folder, request.subcells)
+            accumulators[i] = ZonalAccumulator(index, request.stat_types,
+                                               len(request.categories) if request.categories is not None else 0)
+            key = request.values_key()
+            if key in lookups or key == (None, None):
+                continue
+            if request.categories is not None:
+                # cells in none of the categories still have data, so they count towards their buffer
+                lookups[key] = (category_lookup(raster, request.field, request.categories), -1.0)
+            else:
+                lookups[key] = (attribute_lookup(raster, request.field), np.nan)
+
+        windows = [accumulator.index.window() for accumulator in accumulators.values()
+                   if len(accumulator.index.cells) > 0]
+        if len(windows) > 0:
+            window = (min(w[0] for w in windows), max(w[1] for w in windows), min(w[2] for w in windows),
+                      max(w[3] for w in windows))
+            for first_row, values in read_raster_blocks(raster, grid, window):
+                field_values = {(None, None): values}
+                for key, (lookup, missing) in lookups.items():
+                    field_values[key] = map_values(values, lookup, missing)
+                for i in raster_requests:
+                    accumulators[i].add_block(first_row, window[2], field_values[requests[i].values_key()])
+
+        for i in raster_requests:
+            results[i] = (accumulators[i].index.reach_ids, accumulators[i].results())
+    return results
+
+
+def zonal_statistics(buffer, raster, stat_types, index_folder):
+    """
+    Finds statistics of the raster cells in each buffer, in one scan of the raster. Overlapping buffers each get all
+    of their cells
+    :param buffer: A polygon feature class of buffers, with a ReachID field
+    :param raster: The path to a raster, or a Raster object
+    :param stat_types: A list of statistics, from ZONAL_STATS
+    :param index_folder: The folder that indexes are saved in
+    :return: An array of ReachIDs, and a dictionary of arrays of each statistic, keyed by statistic. Buffers with no
+        cells with data are NaN, except for COUNT, which is 0
+    """
+    return run_zonal_requests([ZonalRequest(buffer, raster, stat_types)], index_folder)[0]
+
+
+def read_reach_points(in_network):
+    """
+    Reads the start, middle and end point of every reach straight from its geometry, where FeatureVerticesToPoints
+    would put its START, MID and END points
+    :param in_network: A polyline feature class with a ReachID field
+    :return: An array of ReachIDs, and a dictionary of (x array, y array) tuples keyed by START, MID and END. Reaches
+        with no geometry are NaN
+    """
+    reach_ids = []
+    coordinates = []
+    with arcpy.da.SearchCursor(in_network, ['ReachID', 'SHAPE@']) as cursor:
+        for reach_id, shape in cursor:
+            reach_ids.append(reach_id)
+            if shape is None or shape.firstPoint is None:
+                coordinates.append((np.nan,) * 6)
+                continue
+            midpoint = shape.positionAlongLine(0.5, True).firstPoint
+            coordinates.append((shape.firstPoint.X, shape.firstPoint.Y, midpoint.X, midpoint.Y, shape.lastPoint.X,
+                                shape.lastPoint.Y))
+    coordinates = np.array(coordinates, dtype=np.float64).reshape(-1, 6)
+    points = {"START": (coordinates[:, 0], coordinates[:, 1]),
+              "MID": (coordinates[:, 2], coordinates[:, 3]),
+              "END": (coordinates[:, 4], coordinates[:, 5])}
+    return np.array(reach_ids, dtype=np.int64), points
+
+
+def point_window_statistics(raster, x, y, radius_meters, stat_types, block_cells=BLOCK_CELLS):
+    """
+    Finds statistics of the raster cells within a distance of each of a set of points, which are the cells a buffer
+    around the point would hold. Points are taken in order of their row, and each group of points is read as one
+    block of the raster with the cells around every point in it, so the raster is read about once however many points
+    there are
+    :param raster: The path to a raster, or a Raster object
+    :param x: An array of the x coordinate of each point
+    :param y: An array of the y coordinate of each point
+    :param radius_meters: The radius of the window around each point, in meters
+    :param stat_types: A list of statistics, from ZONAL_STATS
+    :param block_cells: About how many cells to read or sample at a time
+    :return: A dictionary of arrays with the statistic of each point, keyed by statistic. Points with no cells with
+        data are NaN, except for COUNT, which is 0
+    """
+    grid = raster_grid(raster)
+    meters_per_unit = getattr(arcpy.Raster(str(raster)).spatialReference, 'metersPerUnit', None) or 1.0
+
+    def read_window(window):
+        return next(read_raster_blocks(raster, grid, window, (window[1] - window[0]) * (window[3] - window[2])))
+
+    return grid_window_statistics(grid, read_window, x, y, radius_meters / meters_per_unit, stat_types, block_cells)
+
+
+def grid_window_statistics(grid, read_window, x, y, radius, stat_types, block_cells=BLOCK_CELLS):
+    """
+    Finds statistics of the cells of a grid within a distance of each of a set of points, reading the cells with a
+    function, so that point_window_statistics() works the same on a raster and on an array
+    :param grid: The RasterGrid of the cells
+    :param read_window: A function that takes a (row start, row stop, column start, column stop) window and gives a
+        (first row, array of values) tuple of the window's cells, with NaN where there is no data
+    :param x: An array of the x coordinate of each point
+    :param y: An array of the y coordinate of each point
+    :param radius: The radius of the window around each point, in map units
+    :param stat_types: A list of statistics, from ZONAL_STATS
+    :param block_cells: About how many cells to read or sample at a time
+    :return: A dictionary of arrays with the statistic of each point, keyed by statistic. Points with no cells with
+        data are NaN, except for COUNT, which is 0
+    """
+    for stat_type in stat_types:
+        if stat_type not in ZONAL_STATS:
+            raise Exception("Unknown zonal statistic \"" + str(stat_type) + "\". Options are " + ", ".join(ZONAL_STATS))
+    x = np.asarray(x, np.float64)
+    y = np.asarray(y, np.float64)
+    point_count = len(x)
+
+    # the cells around a point's cell that could have their center within the radius of the point
+    reach_rows = int(np.ceil(radius / grid.cell_height)) + 1
+    reach_cols = int(np.ceil(radius / grid.cell_width)) + 1
+    row_offsets, col_offsets = np.mgrid[-reach_rows:reach_rows + 1, -reach_cols:reach_cols + 1]
+    row_offsets = row_offsets.ravel()
+    col_offsets = col_offsets.ravel()
+
+    with np.errstate(invalid='ignore'):
+        point_rows = np.floor((grid.y_max - y) / grid.cell_height)
+        point_cols = np.floor((x - grid.x_min) / grid.cell_width)
+        near_grid = (point_rows >= -reach_rows) & (point_rows < grid.rows + reach_rows) & \
+                    (point_cols >= -reach_cols) & (point_cols < grid.cols + reach_cols)
+    points = np.flatnonzero(near_grid)
+    points = points[np.argsort(point_rows[points], kind='mergesort')]
+    point_rows = np.where(near_grid, point_rows, 0).astype(np.int64)
+    point_cols = np.where(near_grid, point_cols, 0).astype(np.int64)
+
+    counts = np.zeros(point_count, dtype=np.int64)
+    sums = np.zeros(point_count, dtype=np.float64)
+    minimums = np.empty(point_count, dtype=np.float64)
+    minimums.fill(np.nan)
+    maximums = np.empty(point_count, dtype=np.float64)
+    maximums.fill(np.nan)
+
+    if len(points) > 0:
+        col_start = max(int(point_cols[points].min()) - reach_cols, 0)
+        col_stop = min(int(point_cols[points].max()) + reach_cols + 1, grid.cols)
+        points_per_group = max(1, int(block_cells) // len(row_offsets))
+        rows_per_group = max(1, int(block_cells) // max(col_stop - col_start, 1) - 2 * reach_rows)
+        start = 0
+        while start < len(points):
+            group = points[start:start + points_per_group]
+            group = group[point_rows[group] < point_rows[group[0]] + rows_per_group]
+            start += len(group)
+
+            row_start = max(int(point_rows[group].min()) - reach_rows, 0)
+            row_stop = min(int(point_rows[group].max()) + reach_rows + 1, grid.rows)
+            if row_stop <= row_start or col_stop <= col_start:
+                continue
+            window = (row_start, row_stop, col_start, col_stop)
+            first_row, values = read_window(window)
+
+            rows = point_rows[group][:, np.newaxis] + row_offsets
+            cols = point_cols[group][:, np.newaxis] + col_offsets
+            distances = (grid.x_min + (cols + 0.5) * grid.cell_width - x[group][:, np.newaxis]) ** 2 + \
+                        (grid.y_max - (rows + 0.5) * grid.cell_height - y[group][:, np.newaxis]) ** 2
+            inside = (distances <= radius * radius) & (rows >= row_start) & (rows < row_stop) & \
+                     (cols >= col_start) & (cols < col_stop)
+            window_values = np.empty(rows.shape, dtype=np.float64)
+            window_values.fill(np.nan)
+            window_values[inside] = values[rows[inside] - first_row, cols[inside] - col_start]
+
+            has_data = ~np.isnan(window_values)
+            covered = has_data.any(axis=1)
+            counts[group] = has_data.sum(axis=1)
+            sums[group] = np.where(has_data, window_values, 0.0).sum(axis=1)
+            minimums[group[covered]] = np.where(has_data, window_values, np.inf)[covered].min(axis=1)
+            maximums[group[covered]] = np.where(has_data, window_values, -np.inf)[covered].max(axis=1)
+
+    results = {}
+    for stat_type in stat_types:
+        if stat_type == "COUNT":
+            results[stat_type] = counts.astype(np.float64)
+        elif stat_type == "MINIMUM":
+            results[stat_type] = minimums
+        elif stat_type == "MAXIMUM":
+            results[stat_type] = maximums
+        else:
+            result = np.empty(point_count, dtype=np.float64)
+            result.fill(np.nan)
+            result[counts > 0] = sums[counts > 0] / counts[counts > 0]
+            results[stat_type] = result
+    return results
@@ -13,152 +13,229 @@ import arcpy
 import numpy as np
 import os
 import sys
-from SupportingFunctions import make_layer, make_folder, find_available_num_prefix, find_relative_path
+import json
+from SupportingFunctions import make_layer, make_folder, find_available_num_prefix, find_relative_path, load_columns, \
+    write_columns
+from EquationEngine import evaluate_equation
 import XMLBuilder
 reload(XMLBuilder)
 XMLBuilder = XMLBuilder.XMLBuilder
 
 
-def main(in_network, region, q_low_eqtn, q2_eqtn):
+def main(in_network, region, q_low_eqtn, q2_eqtn, region_field=None, region_polygons=None,
+         region_polygon_field=None, regional_curves=None):
     """
     The main function, adds all hydrologic attributes to the BRAT table
     :param in_network: The input BRAT table to add hydrologic values to
-    :param region: The optional region code to identify an already existing equation
+    :param region: The optional region code to identify an already existing equation. Used for every reach when
+        no region field or polygons are given, and for reaches without a region when they are
     :param q_low_eqtn: The Qlow equation to be calculated
     :param q2_eqtn: The Q2 equation to be calculated
+    :param region_field: An optional field in the network holding the region code of each reach
+    :param region_polygons: An optional polygon feature class of hydrologic regions
+    :param region_polygon_field: The field in the region polygons holding the region code
+    :param regional_curves: The registry file of regional curve equations. Defaults to RegionalCurves.json
     :return:
     """
     if region is None or region == "None":
         region = 0
     else:
-        region = int(region)
+        region = int(float(region))
     if q_low_eqtn == "None":
         q_low_eqtn = None
     if q2_eqtn == "None":
         q2_eqtn = None
 
-    scratch = 'in_memory'
-
     arcpy.env.overwriteOutput = True
 
-    # create segid array for joining output to input network
-    segid_np = arcpy.da.FeatureClassToNumPyArray(in_network, "ReachID")
-    segid = np.asarray(segid_np, np.int64)
+    # create segid array for joining output to input network, and arrays for input network drainage area
+    # ("iGeo_DA") and slope ("iGeo_Slope")
+    columns = load_columns(in_network, ["ReachID", "iGeo_DA", "iGeo_Slope"])
+    segid = columns["ReachID"]
+    da = columns["iGeo_DA"].astype(np.float32)
+
+    if region_field or region_polygons:
+        region = find_reach_regions(in_network, segid, region, region_field, region_polygons, region_polygon_field)
+
+    arcpy.AddMessage("Adding Qlow and Q2 to network...")
+    q_low, q2 = calculate_discharge(da, region, q_low_eqtn, q2_eqtn, load_regional_curves(regional_curves))
+
+    arcpy.AddMessage("Adding stream power to network...")
+    q2, sp_low, sp2 = calculate_stream_power(q_low, q2, columns["iGeo_Slope"])
+
+    # check for and delete if output fields already included in flowline network
+    remove_existing_output(in_network)
+    # join discharge and stream power output to the flowline network
+    write_columns(in_network, segid, [("iHyd_QLow", q_low), ("iHyd_Q2", q2), ("iHyd_SPLow", sp_low),
+                                      ("iHyd_SP2", sp2)])
 
-    # create array for input network drainage area ("iGeo_DA")
-    da_array = arcpy.da.FeatureClassToNumPyArray(in_network, "iGeo_DA")
-    da = np.asarray(da_array, np.float32)
+    make_layers(in_network)
+
+    # add equations to XML
+    # if q_low_eqtn is not None and q2_eqtn is not None and region is not None:
+    #    xml_add_equations(in_network, region, q_low_eqtn, q2_eqtn)
+
+    run_tests()
+
+
+def run_tests():
+    """
+    Makes sure that the equation engine the discharge equations are run through matches Python, and refuses equations
+    it shouldn't run
+    :return:
+    """
+    from Tests import test_equation_engine, report_exceptions, TestException
+    test_exceptions = []
+
+    try:
+        test_equation_engine()
+    except TestException as e:
+        test_exceptions.append(str(e))
+
+    report_exceptions(test_exceptions)
+
+
+def calculate_discharge(da, region, q_low_eqtn=None, q2_eqtn=None, regional_curves=None):
+    """
+    Calculates baseflow (Qlow) and annual peak streamflow (Q2) from drainage area. Reaches are grouped by region,
+    and each region's equations are evaluated once over its group
+    :param da: An array of drainage areas, in square kilometers
+    :param region: The region code to identify an already existing equation, either one code for every reach or an
+        array with a code for each reach. Regions that aren't in the registry use the generic equations (region 0)
+    :param q_low_eqtn: The Qlow equation to be calculated, in terms of DAsqm. Overrides the regions' equations
+    :param q2_eqtn: The Q2 equation to be calculated, in terms of DAsqm. Overrides the regions' equations
+    :param regional_curves: A dictionary of regional curve equations from load_regional_curves(). Defaults to the
+        ones in RegionalCurves.json
+    :return: Arrays of Qlow and Q2, in cubic feet per second
+    """
+    if regional_curves is None:
+        regional_curves = load_regional_curves()
 
     # convert drainage area (in square kilometers) to square miles
     # note: this assumes that streamflow equations are in US customary units (e.g., inches, feet)
-
-    # TODO Why do these get need to be initialized? Is it necessary to set them to zero first?
-    DAsqm = np.zeros_like(da)
     DAsqm = da * 0.3861021585424458
 
     # create Qlow and Q2
-    q_low = np.zeros_like(da)
-    q2 = np.zeros_like(da)
-
-    arcpy.AddMessage("Adding Qlow and Q2 to network...")
+    q_low = np.zeros_like(DAsqm)
+    q2 = np.zeros_like(DAsqm)
 
-    # --regional curve equations for Qlow (baseflow) and Q2 (annual peak streamflow)--
-    # # # Add in regional curve equations here # # #
     if q_low_eqtn is not None:
         arcpy.AddMessage("Evaluating qlow...")
-        q_low = eval(q_low_eqtn)
-    elif region == 101:  # example 1 (box elder county)
-        q_low = 0.019875 * (DAsqm ** 0.6634) * (10 ** (0.6068 * 2.04))
-    elif region == 102:  # example 2 (upper green generic)
-        q_low = 4.2758 * (DAsqm ** 0.299)
-    elif region == 24:  # oregon region 5
-        q_low = 0.000133 * (DAsqm ** 1.05) * (15.3 ** 2.1)
-    else:
-        q_low = (DAsqm ** 0.2098) + 1
-
     if q2_eqtn is not None:
         arcpy.AddMessage("Evaluating q2...")
-        q2 = eval(q2_eqtn)
-    elif region == 101:  # example 1 (box elder county)
-        q2 = 14.5 * DAsqm ** 0.328
-    elif region == 102:  # example 2 (upper green generic)
-        q2 = 22.2 * (DAsqm ** 0.608) * ((42 - 40) ** 0.1)
-    elif region == 24:  # oregon region 5
-        q2 = 0.000258 * (DAsqm ** 0.893) * (15.3 ** 3.15)
-    else:
-        q2 = 14.7 * (DAsqm ** 0.815)
-
-    # save segid, Qlow, Q2 as single table
-    columns = np.column_stack((segid, q_low, q2))
-    tmp_table = os.path.dirname(in_network) + "/ihyd_Q_Table.txt"
-    np.savetxt(tmp_table, columns, delimiter=",", header="ReachID, iHyd_QLow, iHyd_Q2", comments="")
-    ihyd_table = scratch + "/ihyd_table"
-    arcpy.CopyRows_management(tmp_table, ihyd_table)
-
-    # join Qlow and Q2 output to the flowline network
-    # create empty dictionary to hold input table field values
-    tbl_dict = {}
-    # add values to dictionary
-    with arcpy.da.SearchCursor(ihyd_table, ['ReachID', "iHyd_QLow", "iHyd_Q2"]) as cursor:
-        for row in cursor:
-            tbl_dict[row[0]] = [row[1], row[2]]
-    # check for and delete if output fields already included in flowline network
-    remove_existing_output(in_network)
-    # populate flowline network out field
-    arcpy.AddField_management(in_network, "iHyd_QLow", 'DOUBLE')
-    arcpy.AddField_management(in_network, "iHyd_Q2", 'DOUBLE')
-    with arcpy.da.UpdateCursor(in_network, ['ReachID', "iHyd_QLow", "iHyd_Q2"]) as cursor:
-        for row in cursor:
-            try:
-                a_key = row[0]
-                row[1] = tbl_dict[a_key][0]
-                row[2] = tbl_dict[a_key][1]
-                cursor.updateRow(row)
-            # TODO There should not be any blank exceptions. What error is this supposed to throw?
-            except:
-                pass
-    tbl_dict.clear()
-
-    # delete temporary table
-    arcpy.Delete_management(tmp_table)
-
-    # check that Q2 is greater than Qlow
-    # if not, re-calculate Q2 as Qlow + 0.001
-    with arcpy.da.UpdateCursor(in_network, ["iHyd_QLow", "iHyd_Q2"]) as cursor:
-        for row in cursor:
-            if row[1] < row[0]:
-                row[1] = row[0] + 0.001
-            else:
-                pass
-            cursor.updateRow(row)
 
-    arcpy.AddMessage("Adding stream power to network...")
+    # --regional curve equations for Qlow (baseflow) and Q2 (annual peak streamflow)--
+    # # # Add in regional curve equations to RegionalCurves.json # # #
+    regions = np.zeros(len(DAsqm), dtype=np.int64) + region
+    for region_code in np.unique(regions):
+        in_region = regions == region_code
+        if region_code in regional_curves:
+            curves = regional_curves[region_code]
+        else:
+            arcpy.AddWarning("Region " + str(region_code) + " is not in the regional curves registry, so the " +
+                             "generic equations were used for its " + str(np.count_nonzero(in_region)) + " reaches")
+            curves = regional_curves[0]
+        variables = {'DAsqm': DAsqm[in_region]}
+        q_low[in_region] = evaluate_equation(q_low_eqtn if q_low_eqtn is not None else curves['q_low'], variables)
+        q2[in_region] = evaluate_equation(q2_eqtn if q2_eqtn is not None else curves['q2'], variables)
+
+    return q_low, q2
+
+
+def load_regional_curves(registry_path=None):
+    """
+    Reads the registry of regional curve equations
+    :param registry_path: The path to the registry file. Defaults to RegionalCurves.json next to this script
+    :return: A dictionary of {'name', 'q_low', 'q2'} dictionaries, keyed by region code
+    """
+    if not registry_path or registry_path == "None":
+        registry_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "RegionalCurves.json")
+    with open(registry_path) as registry_file:
+        registry = json.load(registry_file)
 
-    # calculate Qlow and Q2 stream power
+    regional_curves = {}
+    for curves in registry["regions"]:
+        regional_curves[int(curves["region"])] = curves
+    if 0 not in regional_curves:
+        raise Exception("The regional curves registry " + registry_path + " needs generic equations for region 0")
+    return regional_curves
 
-    # where stream power =
-    # density of water (1000 kg/m3) * acceleration due to gravity (9.80665 m/s2) * discharge (m3/s) * channel slope
 
-    # note: we assume that discharge ("iHyd_QLow", "iHyd_Q2") was calculated in cubic feet per second
-    # and handle conversion to cubic meters per second (e.g., "iHyd_QLow" * 0.028316846592
-
-    arcpy.AddField_management(in_network, "iHyd_SPLow", "DOUBLE")
-    arcpy.AddField_management(in_network, "iHyd_SP2", "DOUBLE")
-    with arcpy.da.UpdateCursor(in_network, ["iGeo_Slope", "iHyd_QLow", "iHyd_SPLow", "iHyd_Q2", "iHyd_SP2"]) as cursor:
-        for row in cursor:
-            if row[0] < 0.001:
-                slope = 0.001
-            else:
-                slope = row[0]
-            row[2] = (1000 * 9.80665) * slope * (row[1] * 0.028316846592)
-            row[4] = (1000 * 9.80665) * slope * (row[3] * 0.028316846592)
-            cursor.updateRow(row)
+def find_reach_regions(in_network, reach_ids, default_region, region_field=None, region_polygons=None,
+                       region_polygon_field=None):
+    """
+    Finds the hydrologic region of each reach, either from a field in the network or from the region polygon each
+    reach has its center in
+    :param in_network: The input BRAT table
+    :param reach_ids: An array of ReachIDs to find regions for
+    :param default_region: The region code given to reaches that don't have one
+    :param region_field: A field in the network holding the region code of each reach
+    :param region_polygons: A polygon feature class of hydrologic regions, used if no region field is given
+    :param region_polygon_field: The field in the region polygons holding the region code
+    :return: An array of region codes, lined up with reach_ids
+    """
+    if not region_field and not region_polygon_field:
+        raise Exception("A region code field is needed to use the region polygons")
+    code_table, code_field = (in_network, region_field) if region_field else (region_polygons, region_polygon_field)
+    field_types = dict((field.name, field.type) for field in arcpy.ListFields(code_table))
+    if field_types.get(code_field) not in ["SmallInteger", "Integer", "Single", "Double"]:
+        raise Exception("The region code field \"" + str(code_field) + "\" in " + str(code_table) +
+                        " must be a number field, but it is a " + str(field_types.get(code_field)) + " field")
+
+    if region_field:
+        region_table = in_network
+        table_field = region_field
+    else:
+        region_table = 'in_memory/ihyd_region_join'
+        arcpy.SpatialJoin_analysis(in_network, region_polygons, region_table, 'JOIN_ONE_TO_ONE', 'KEEP_ALL',
+                                   match_option='HAVE_THEIR_CENTER_IN')
+        # the join renames the region field if the network already has a field with that name
+        table_field = region_polygon_field
+        if region_polygon_field in [f.name for f in arcpy.ListFields(in_network)]:
+            table_field = region_polygon_field + "_1"
+
+    table = arcpy.da.FeatureClassToNumPyArray(region_table, ["ReachID", table_field], null_value=-1)
+    table_ids = np.asarray(table["ReachID"], np.int64)
+    table_regions = np.asarray(table[table_field], np.float64)
+    if region_table != in_network:
+        arcpy.Delete_management(region_table)
+
+    # line the regions up with the reach IDs, and use the default region for any reach without one
+    order = np.argsort(table_ids, kind='mergesort')
+    positions = np.clip(np.searchsorted(table_ids[order], reach_ids), 0, len(table_ids) - 1)
+    regions = table_regions[order][positions]
+    no_region = (table_ids[order][positions] != reach_ids) | np.isnan(regions) | (regions < 0)
+    if np.any(no_region):
+        arcpy.AddWarning(str(np.count_nonzero(no_region)) + " reaches have no hydrologic region, so region " +
+                         str(default_region) + " was used for them")
+        regions[no_region] = default_region
+
+    return regions.astype(np.int64)
+
+
+def calculate_stream_power(q_low, q2, slope):
+    """
+    Calculates baseflow and annual peak stream power, making sure Q2 is greater than Qlow first
+    :param q_low: An array of baseflow discharges, in cubic feet per second
+    :param q2: An array of annual peak discharges, in cubic feet per second
+    :param slope: An array of reach slopes
+    :return: Arrays of the corrected Q2, baseflow stream power and annual peak stream power (in watts per meter)
+    """
+    # work in double precision, as the fields that hold the discharges are doubles
+    q_low = np.asarray(q_low, np.float64)
+    q2 = np.asarray(q2, np.float64)
 
-    make_layers(in_network)
+    # if Q2 is less than Qlow, re-calculate Q2 as Qlow + 0.001
+    q2 = np.where(q2 < q_low, q_low + 0.001, q2)
 
-    # add equations to XML
-    # if q_low_eqtn is not None and q2_eqtn is not None and region is not None:
-    #    xml_add_equations(in_network, region, q_low_eqtn, q2_eqtn)
+    # where stream power =
+    # density of water (1000 kg/m3) * acceleration due to gravity (9.80665 m/s2) * discharge (m3/s) * channel slope
+    # discharge is converted from cubic feet per second to cubic meters per second, and slope has a floor of 0.001
+    slope = np.where(slope < 0.001, 0.001, slope)
+    sp_low = (1000 * 9.80665) * slope * (q_low * 0.028316846592)
+    sp2 = (1000 * 9.80665) * slope * (q2 * 0.028316846592)
+
+    return q2, sp_low, sp2
 
 
 def remove_existing_output(in_network):